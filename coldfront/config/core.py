@@ -95,6 +95,16 @@ INVOICE_DEFAULT_STATUS = ENV.str("INVOICE_DEFAULT_STATUS", default="New")
 # ------------------------------------------------------------------------------
 ONDEMAND_URL = ENV.str("ONDEMAND_URL", default=None)
 
+# ------------------------------------------------------------------------------
+# User search. Additional sources are searched in parallel, each with a
+# deadline, and results are cached for a short time. Creating a user only drops
+# cached results in other processes if USER_SEARCH_CACHE is a shared cache
+# ------------------------------------------------------------------------------
+USER_SEARCH_TIMEOUT = ENV.float("USER_SEARCH_TIMEOUT", default=10)
+USER_SEARCH_MAX_WORKERS = ENV.int("USER_SEARCH_MAX_WORKERS", default=4)
+USER_SEARCH_CACHE = ENV.str("USER_SEARCH_CACHE", default="default")
+USER_SEARCH_CACHE_TIMEOUT = ENV.int("USER_SEARCH_CACHE_TIMEOUT", default=120)
+
 # ------------------------------------------------------------------------------
 # Default Strings. Override these in local_settings.py
 # ------------------------------------------------------------------------------
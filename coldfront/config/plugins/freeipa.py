@@ -13,6 +13,8 @@ FREEIPA_KTNAME = ENV.str("FREEIPA_KTNAME")
 FREEIPA_SERVER = ENV.str("FREEIPA_SERVER")
 FREEIPA_USER_SEARCH_BASE = ENV.str("FREEIPA_USER_SEARCH_BASE")
 FREEIPA_ENABLE_SIGNALS = False
+FREEIPA_CHECK_WORKERS = ENV.int("FREEIPA_CHECK_WORKERS", default=1)
+FREEIPA_BATCH_SIZE = ENV.int("FREEIPA_BATCH_SIZE", default=100)
 ADDITIONAL_USER_SEARCH_CLASSES = [
     "coldfront.plugins.freeipa.search.LDAPUserSearch",
 ]
@@ -13,3 +13,8 @@ IQUOTA_KEYTAB = ENV.str("IQUOTA_KEYTAB")
 IQUOTA_CA_CERT = ENV.str("IQUOTA_CA_CERT")
 IQUOTA_API_HOST = ENV.str("IQUOTA_API_HOST")
 IQUOTA_API_PORT = ENV.str("IQUOTA_API_PORT", default="8080")
+IQUOTA_TIMEOUT = ENV.int("IQUOTA_TIMEOUT", default=10)
+IQUOTA_MAX_WORKERS = ENV.int("IQUOTA_MAX_WORKERS", default=8)
+IQUOTA_CACHE = ENV.str("IQUOTA_CACHE", default="default")
+IQUOTA_CACHE_TIMEOUT = ENV.int("IQUOTA_CACHE_TIMEOUT", default=900)
+IQUOTA_CACHE_PREWARM_MINUTES = ENV.int("IQUOTA_CACHE_PREWARM_MINUTES", default=0)
@@ -26,5 +26,7 @@ LDAP_USER_SEARCH_PRIV_KEY_FILE = ENV.str("LDAP_USER_SEARCH_PRIV_KEY_FILE", defau
 LDAP_USER_SEARCH_CERT_FILE = ENV.str("LDAP_USER_SEARCH_CERT_FILE", default=None)
 LDAP_USER_SEARCH_CACERT_FILE = ENV.str("LDAP_USER_SEARCH_CACERT_FILE", default=None)
 LDAP_USER_SEARCH_CERT_VALIDATE_MODE = ENV.str("LDAP_USER_SEARCH_CERT_VALIDATE_MODE", default=None)
+LDAP_USER_SEARCH_POOL_SIZE = ENV.int("LDAP_USER_SEARCH_POOL_SIZE", default=4)
+LDAP_USER_SEARCH_POOL_IDLE_TIMEOUT = ENV.int("LDAP_USER_SEARCH_POOL_IDLE_TIMEOUT", default=300)
 
 ADDITIONAL_USER_SEARCH_CLASSES = ["coldfront.plugins.ldap_user_search.utils.LDAPUserSearch"]
@@ -20,6 +20,14 @@ PROJECT_OPENLDAP_USE_TLS = ENV.bool("PROJECT_OPENLDAP_USE_TLS", default=False)
 PROJECT_OPENLDAP_PRIV_KEY_FILE = ENV.str("PROJECT_OPENLDAP_PRIV_KEY_FILE", default=None)
 PROJECT_OPENLDAP_CERT_FILE = ENV.str("PROJECT_OPENLDAP_CERT_FILE", default=None)
 PROJECT_OPENLDAP_CACERT_FILE = ENV.str("PROJECT_OPENLDAP_CACERT_FILE", default=None)
+# Connection pool
+PROJECT_OPENLDAP_POOL_SIZE = ENV.int("PROJECT_OPENLDAP_POOL_SIZE", default=4)  # max idle connections kept open
+PROJECT_OPENLDAP_POOL_CHECK_INTERVAL = ENV.int(
+    "PROJECT_OPENLDAP_POOL_CHECK_INTERVAL", default=60
+)  # seconds a connection can be idle before it is checked with WhoAmI before reuse
+PROJECT_OPENLDAP_PAGE_SIZE = ENV.int(
+    "PROJECT_OPENLDAP_PAGE_SIZE", default=500
+)  # page size of the paged searches used by project_openldap_sync --bulk
 # OU, GID, Arhive and sync excludes
 PROJECT_OPENLDAP_OU = ENV.str("PROJECT_OPENLDAP_OU", default="")  # where projects will be stored
 PROJECT_OPENLDAP_GID_START = ENV.int(
@@ -11,6 +11,10 @@ SYSTEM_MONITOR_PANEL_TITLE = ENV.str("SYSMON_TITLE", default="HPC Cluster Status
 SYSTEM_MONITOR_ENDPOINT = ENV.str("SYSMON_ENDPOINT")
 SYSTEM_MONITOR_DISPLAY_MORE_STATUS_INFO_LINK = ENV.str("SYSMON_LINK", default=None)
 SYSTEM_MONITOR_DISPLAY_XDMOD_LINK = ENV.str("SYSMON_XDMOD_LINK", default=None)
+SYSTEM_MONITOR_RESPONSE_PARSER = ENV.str("SYSMON_PARSER", default="parse_html_using_beautiful_soup")
+SYSTEM_MONITOR_CACHE = ENV.str("SYSMON_CACHE", default="default")
+SYSTEM_MONITOR_REFRESH_MINUTES = ENV.int("SYSMON_REFRESH_MINUTES", default=5)
+SYSTEM_MONITOR_STALE_AFTER = ENV.int("SYSMON_STALE_AFTER", default=900)
 
 SETTINGS_EXPORT += [
     "SYSTEM_MONITOR_DISPLAY_MORE_STATUS_INFO_LINK",
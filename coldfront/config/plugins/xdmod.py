@@ -13,3 +13,7 @@ INSTALLED_APPS += [
 ]
 
 XDMOD_API_URL = ENV.str("XDMOD_API_URL")
+XDMOD_TIMEOUT = ENV.int("XDMOD_TIMEOUT", default=60)
+XDMOD_RETRIES = ENV.int("XDMOD_RETRIES", default=3)
+XDMOD_RETRY_BACKOFF = ENV.float("XDMOD_RETRY_BACKOFF", default=1.0)
+XDMOD_MAX_WORKERS = ENV.int("XDMOD_MAX_WORKERS", default=4)
@@ -222,19 +222,60 @@ class Allocation(TimeStampedModel):
             # Fallback
             return self.resources.first()
 
-    def get_attribute(self, name, expand=True, typed=True, extra_allocations=[]):
+    def get_attribute_index(self):
+        """
+        Returns:
+            dict[str, list[AllocationAttribute]]: the allocation's attributes keyed by allocation attribute type name, ordered by id (read from the prefetch cache when allocationattribute_set has been prefetched, otherwise loaded in a single query)
+        """
+
+        if "allocationattribute_set" in getattr(self, "_prefetched_objects_cache", {}):
+            attrs = sorted(self.allocationattribute_set.all(), key=lambda a: a.pk)
+        else:
+            attrs = self.allocationattribute_set.select_related("allocation_attribute_type__attribute_type").order_by(
+                "pk"
+            )
+
+        index = {}
+        for attr in attrs:
+            index.setdefault(attr.allocation_attribute_type.name, []).append(attr)
+        return index
+
+    def _get_attributes_by_name(self, name, attribute_index=None):
+        """
+        Params:
+            name (str): name of the allocation attribute type
+            attribute_index (dict): preloaded index as returned by get_attribute_index()
+
+        Returns:
+            list[AllocationAttribute]: the attributes with the specified name, ordered by id (no query is issued if attribute_index is given or allocationattribute_set has been prefetched)
+        """
+
+        if attribute_index is not None:
+            return attribute_index.get(name, [])
+
+        if "allocationattribute_set" in getattr(self, "_prefetched_objects_cache", {}):
+            return sorted(
+                [a for a in self.allocationattribute_set.all() if a.allocation_attribute_type.name == name],
+                key=lambda a: a.pk,
+            )
+
+        return list(self.allocationattribute_set.filter(allocation_attribute_type__name=name).order_by("pk"))
+
+    def get_attribute(self, name, expand=True, typed=True, extra_allocations=[], attribute_index=None):
         """
         Params:
             name (str): name of the allocation attribute type
             expand (bool): indicates whether or not to return the expanded value with attributes/parameters for attributes with a base type of 'Attribute Expanded Text'
             typed (bool): indicates whether or not to convert the attribute value to an int/ float/ str based on the base AttributeType name
             extra_allocations (list[Allocation]): allocations which are available to reference in the attribute list in addition to those associated with this AllocationAttribute
+            attribute_index (dict): optional preloaded index as returned by get_attribute_index() to read attributes from instead of the database
 
         Returns:
             str: the value of the first attribute found for this allocation with the specified name
         """
 
-        attr = self.allocationattribute_set.filter(allocation_attribute_type__name=name).first()
+        attrs = self._get_attributes_by_name(name, attribute_index=attribute_index)
+        attr = attrs[0] if attrs else None
         if attr:
             if expand:
                 return attr.expanded_value(extra_allocations=extra_allocations, typed=typed)
@@ -267,19 +308,20 @@ class Allocation(TimeStampedModel):
         usage.value = value
         usage.save()
 
-    def get_attribute_list(self, name, expand=True, typed=True, extra_allocations=[]):
+    def get_attribute_list(self, name, expand=True, typed=True, extra_allocations=[], attribute_index=None):
         """
         Params:
             name (str): name of the allocation
             expand (bool): indicates whether or not to return the expanded value with attributes/parameters for attributes with a base type of 'Attribute Expanded Text'
             typed (bool): indicates whether or not to convert the attribute value to an int/ float/ str based on the base AttributeType name
             extra_allocations (list[Allocation]): allocations which are available to reference in the attribute list in addition to those associated with this AllocationAttribute
+            attribute_index (dict): optional preloaded index as returned by get_attribute_index() to read attributes from instead of the database
 
         Returns:
             list: the list of values of the attributes found with specified name
         """
 
-        attr = self.allocationattribute_set.filter(allocation_attribute_type__name=name).all()
+        attr = self._get_attributes_by_name(name, attribute_index=attribute_index)
         if expand:
             return [a.expanded_value(typed=typed, extra_allocations=extra_allocations) for a in attr]
         else:
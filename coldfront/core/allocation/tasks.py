@@ -9,6 +9,7 @@ import logging
 
 from coldfront.core.allocation.models import Allocation, AllocationStatusChoice, AllocationUserStatusChoice
 from coldfront.core.user.models import User
+from coldfront.core.utils.choices import get_choice
 from coldfront.core.utils.common import import_from_settings
 from coldfront.core.utils.mail import send_email_template
 
@@ -36,7 +37,7 @@ EMAIL_ALLOCATION_EULA_IGNORE_OPT_OUT = import_from_settings("EMAIL_ALLOCATION_EU
 
 
 def update_statuses():
-    expired_status_choice = AllocationStatusChoice.objects.get(name="Expired")
+    expired_status_choice = get_choice(AllocationStatusChoice, "Expired")
     allocations_to_expire = Allocation.objects.filter(
         status__name__in=[
             "Active",
@@ -60,7 +61,7 @@ def send_eula_reminders():
             for allocation_user in allocation.allocationuser_set.all():
                 projectuser = allocation.project.projectuser_set.get(user=allocation_user.user)
                 if (
-                    allocation_user.status == AllocationUserStatusChoice.objects.get(name="PendingEULA")
+                    allocation_user.status == get_choice(AllocationUserStatusChoice, "PendingEULA")
                     and projectuser.status.name == "Active"
                 ):
                     should_send = (projectuser.enable_notifications) or (EMAIL_ALLOCATION_EULA_IGNORE_OPT_OUT)
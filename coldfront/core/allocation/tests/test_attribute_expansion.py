@@ -0,0 +1,93 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Unit tests for compiled attribute expansion"""
+
+from django.test import SimpleTestCase
+
+from coldfront.core import attribute_expansion
+
+
+class FakeAttributeHolder:
+    """Stands in for a Resource/Allocation, counting get_attribute() calls"""
+
+    def __init__(self, attributes):
+        self.attributes = attributes
+        self.lookups = 0
+
+    def get_attribute(self, name):
+        self.lookups += 1
+        return self.attributes.get(name)
+
+
+class CompileAttriblistTests(SimpleTestCase):
+    attriblist = "\n".join(
+        [
+            "# Comment lines and blank lines are skipped",
+            "",
+            "cores := :Core Usage (Hours)",
+            "cores /= 1000",
+            "cores (= floor",
+            "account := ALLOCATION:slurm_account_name",
+            "qos := 'normal'",
+            "qos |= 'ignored'",
+            "cluster := RESOURCE:slurm_cluster",
+            "total := :Core Usage (Hours)",
+            "bad statement",
+        ]
+    )
+
+    def setUp(self):
+        attribute_expansion.compile_attriblist.cache_clear()
+        self.allocation = FakeAttributeHolder({"Core Usage (Hours)": 12345, "slurm_account_name": "physics"})
+        self.resource = FakeAttributeHolder({"slurm_cluster": "hpc"})
+
+    def test_compile_skips_comments_and_invalid_statements(self):
+        """Test that only valid statements are compiled, with constants pre-evaluated"""
+        program = attribute_expansion.compile_attriblist(self.attriblist)
+        self.assertEqual(
+            [s.pname for s in program], ["cores", "cores", "cores", "account", "qos", "qos", "cluster", "total"]
+        )
+        self.assertEqual(program[1].kind, attribute_expansion.ARGUMENT_CONSTANT)
+        self.assertEqual(program[1].argument, 1000)
+        self.assertEqual(program[3].kind, attribute_expansion.ARGUMENT_REFERENCE)
+        self.assertEqual((program[3].source, program[3].argument), ("ALLOCATION:", "slurm_account_name"))
+
+    def test_compile_is_memoized(self):
+        """Test that compiling the same attriblist text twice returns the cached program"""
+        program = attribute_expansion.compile_attriblist(self.attriblist)
+        self.assertIs(attribute_expansion.compile_attriblist(self.attriblist), program)
+        self.assertEqual(attribute_expansion.compile_attriblist.cache_info().hits, 1)
+
+    def test_evaluate(self):
+        """Test that evaluating a program builds the expected parameter dictionary"""
+        apdict = attribute_expansion.make_attribute_parameter_dictionary(
+            "slurm_specs", self.attriblist, resources=[self.resource], allocations=[self.allocation]
+        )
+        self.assertEqual(
+            apdict,
+            {"cores": 12, "account": "physics", "qos": "normal", "cluster": "hpc", "total": 12345},
+        )
+        # Repeated references are resolved once per evaluation
+        self.assertEqual(self.allocation.lookups, 2)
+
+    def test_compile_cache_shared_between_attributes(self):
+        """Test that attributes with the same attriblist text share one compiled program"""
+        for name in ["slurm_specs", "slurm_user_specs"]:
+            attribute_expansion.make_attribute_parameter_dictionary(
+                name, self.attriblist, resources=[self.resource], allocations=[self.allocation]
+            )
+        info = attribute_expansion.compile_attriblist.cache_info()
+        self.assertEqual((info.misses, info.hits), (1, 1))
+
+    def test_expand_attribute(self):
+        """Test expanding a raw value with a compiled attriblist"""
+        expanded = attribute_expansion.expand_attribute(
+            "GrpTRESMins=cpu={cores}:QOS={qos}",
+            "slurm_specs",
+            self.attriblist,
+            resources=[self.resource],
+            allocations=[self.allocation],
+        )
+        self.assertEqual(expanded, "GrpTRESMins=cpu=12:QOS=normal")
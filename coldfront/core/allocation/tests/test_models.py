@@ -340,3 +340,56 @@ class AllocationModelExpiresInTests(TestCase):
             allocation: Allocation = AllocationFactory(end_date=self.four_years_after_mocked_today)
 
             self.assertEqual(allocation.expires_in, days_in_four_years_including_leap_year)
+
+
+class AllocationModelGetAttributeTests(TestCase):
+    """Tests for Allocation.get_attribute and Allocation.get_attribute_list"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.allocation = AllocationFactory()
+        cls.allocation.resources.add(ResourceFactory())
+        text_type = AAttributeTypeFactory(name="Text")
+        cls.group_type = AllocationAttributeTypeFactory(name="freeipa_group", attribute_type=text_type)
+        cls.quota_type = AllocationAttributeTypeFactory(name="Storage Quota (GB)")
+        AllocationAttributeFactory(allocation=cls.allocation, allocation_attribute_type=cls.group_type, value="grp-a")
+        AllocationAttributeFactory(allocation=cls.allocation, allocation_attribute_type=cls.group_type, value="grp-b")
+        AllocationAttributeFactory(allocation=cls.allocation, allocation_attribute_type=cls.quota_type, value="10")
+
+    def test_get_attribute_without_prefetch(self):
+        """Test that get_attribute queries the database when nothing is prefetched"""
+        self.assertEqual(self.allocation.get_attribute("freeipa_group"), "grp-a")
+        self.assertEqual(self.allocation.get_attribute("Storage Quota (GB)"), 10)
+        self.assertIsNone(self.allocation.get_attribute("missing"))
+        self.assertEqual(self.allocation.get_attribute_list("freeipa_group"), ["grp-a", "grp-b"])
+
+    def test_get_attribute_reads_prefetch_cache(self):
+        """Test that get_attribute and get_attribute_list issue no queries once attributes are prefetched"""
+        allocation = Allocation.objects.prefetch_related(
+            "resources__resourceattribute_set__resource_attribute_type__attribute_type",
+            "allocationattribute_set__allocation_attribute_type__attribute_type",
+        ).get(pk=self.allocation.pk)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(allocation.get_attribute("freeipa_group"), "grp-a")
+            self.assertEqual(allocation.get_attribute("Storage Quota (GB)"), 10)
+            self.assertEqual(allocation.get_attribute("Storage Quota (GB)", typed=False), "10")
+            self.assertIsNone(allocation.get_attribute("missing"))
+            self.assertEqual(allocation.get_attribute_list("freeipa_group"), ["grp-a", "grp-b"])
+            self.assertEqual(allocation.get_attribute_list("missing"), [])
+
+    def test_get_attribute_reads_attribute_index(self):
+        """Test that a preloaded attribute index is used instead of the database"""
+        with self.assertNumQueries(1):
+            index = self.allocation.get_attribute_index()
+
+        self.assertEqual(set(index), {"freeipa_group", "Storage Quota (GB)"})
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                self.allocation.get_attribute("freeipa_group", expand=False, attribute_index=index), "grp-a"
+            )
+            self.assertEqual(
+                self.allocation.get_attribute_list("freeipa_group", expand=False, attribute_index=index),
+                ["grp-a", "grp-b"],
+            )
+            self.assertIsNone(self.allocation.get_attribute("missing", attribute_index=index))
@@ -0,0 +1,86 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Unit tests for the allocation utils"""
+
+from django.test import TestCase
+
+from coldfront.core.allocation.models import AllocationAttributeUsage
+from coldfront.core.allocation.utils import bulk_set_usage
+from coldfront.core.test_helpers.factories import (
+    AAttributeTypeFactory,
+    AllocationAttributeFactory,
+    AllocationAttributeTypeFactory,
+    AllocationFactory,
+)
+
+
+class BulkSetUsageTests(TestCase):
+    """tests for bulk_set_usage"""
+
+    @classmethod
+    def setUpTestData(cls):
+        float_type = AAttributeTypeFactory(name="Float")
+        cls.hours = AllocationAttributeTypeFactory(name="Core Usage (Hours)", attribute_type=float_type, has_usage=True)
+        cls.storage = AllocationAttributeTypeFactory(
+            name="Storage Quota (GB)", attribute_type=float_type, has_usage=True
+        )
+        cls.no_usage = AllocationAttributeTypeFactory(name="Quota", attribute_type=float_type, has_usage=False)
+        cls.allocations = [AllocationFactory() for _ in range(3)]
+        cls.attributes = [
+            AllocationAttributeFactory(allocation=a, allocation_attribute_type=cls.hours, value="100")
+            for a in cls.allocations
+        ]
+        AllocationAttributeFactory(allocation=cls.allocations[0], allocation_attribute_type=cls.no_usage, value="1")
+
+    def usage(self, attribute):
+        return AllocationAttributeUsage.objects.get(allocation_attribute=attribute)
+
+    def test_sets_changed_usage(self):
+        a1, a2, a3 = self.allocations
+        AllocationAttributeUsage.objects.filter(allocation_attribute=self.attributes[1]).update(value=5)
+        changed = bulk_set_usage(
+            [
+                (a1.pk, "Core Usage (Hours)", "10.5"),
+                (a2.pk, "Core Usage (Hours)", 5),
+                (a3.pk, "Core Usage (Hours)", 7),
+            ]
+        )
+        self.assertEqual(changed, 2)
+        self.assertEqual(self.usage(self.attributes[0]).value, 10.5)
+        self.assertEqual(self.usage(self.attributes[1]).value, 5)
+        self.assertEqual(self.usage(self.attributes[2]).value, 7)
+
+    def test_history_only_for_changed_values(self):
+        a1, a2, _ = self.allocations
+        history = AllocationAttributeUsage.history.count()
+        bulk_set_usage([(a1.pk, "Core Usage (Hours)", 10), (a2.pk, "Core Usage (Hours)", 0)])
+        self.assertEqual(AllocationAttributeUsage.history.count(), history + 1)
+        self.assertEqual(AllocationAttributeUsage.history.latest("history_date").value, 10)
+
+    def test_creates_missing_usage(self):
+        a1 = self.allocations[0]
+        AllocationAttributeUsage.objects.filter(allocation_attribute=self.attributes[0]).delete()
+        self.assertEqual(bulk_set_usage([(a1.pk, "Core Usage (Hours)", 3)]), 1)
+        self.assertEqual(self.usage(self.attributes[0]).value, 3)
+
+    def test_skips_missing_and_non_usage_attributes(self):
+        a1 = self.allocations[0]
+        count = AllocationAttributeUsage.objects.count()
+        changed = bulk_set_usage([(a1.pk, "Quota", 3), (a1.pk, "Storage Quota (GB)", 3), (0, "Core Usage (Hours)", 3)])
+        self.assertEqual(changed, 0)
+        self.assertEqual(AllocationAttributeUsage.objects.count(), count)
+
+    def test_skips_usage_not_requested(self):
+        a1, a2, _ = self.allocations
+        AllocationAttributeFactory(allocation=a2, allocation_attribute_type=self.storage, value="1")
+        bulk_set_usage([(a1.pk, "Core Usage (Hours)", 3), (a2.pk, "Storage Quota (GB)", 4)])
+        self.assertEqual(self.usage(self.attributes[1]).value, 0)
+
+    def test_query_count(self):
+        """Attributes, usages, update and history are one query each"""
+        usages = [(a.pk, "Core Usage (Hours)", 42) for a in self.allocations]
+        # Plus the savepoint and its release
+        with self.assertNumQueries(6):
+            bulk_set_usage(usages)
@@ -2,11 +2,25 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import logging
+
+from django.db import transaction
 from django.db.models import Q
+from django.utils import timezone
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
 
-from coldfront.core.allocation.models import AllocationUser, AllocationUserStatusChoice
+from coldfront.core.allocation.models import (
+    AllocationAttribute,
+    AllocationAttributeUsage,
+    AllocationUser,
+    AllocationUserStatusChoice,
+)
 from coldfront.core.resource.models import Resource
 
+logger = logging.getLogger(__name__)
+
+BULK_USAGE_BATCH_SIZE = 1000
+
 
 def set_allocation_user_status_to_error(allocation_user_pk):
     allocation_user_obj = AllocationUser.objects.get(pk=allocation_user_pk)
@@ -66,3 +80,78 @@ def get_user_resources(user_obj):
 
 def test_allocation_function(allocation_pk):
     print("test_allocation_function", allocation_pk)
+
+
+def bulk_set_usage(usages, batch_size=BULK_USAGE_BATCH_SIZE):
+    """Set the usage of many allocation attributes at once, the bulk
+    equivalent of Allocation.set_usage().
+
+    Params:
+        usages (iterable): (allocation_id, attribute type name, value) tuples
+        batch_size (int): number of rows per query
+
+    Attributes are resolved in one query per batch of allocations and changed
+    usages are written with bulk_update, with their history rows created in
+    bulk. Usages whose value is unchanged are skipped, as are attributes that
+    do not exist or whose type has no usage. Everything is done in a single
+    transaction. Returns the number of usages created or updated.
+    """
+
+    values = {}
+    for allocation_id, name, value in usages:
+        values[(allocation_id, name)] = float(value)
+
+    if not values:
+        return 0
+
+    allocation_ids = sorted({allocation_id for allocation_id, _ in values})
+    names = {name for _, name in values}
+
+    with transaction.atomic():
+        # As in Allocation.set_usage() the first attribute of the type is used
+        attribute_ids = {}
+        for i in range(0, len(allocation_ids), batch_size):
+            attributes = (
+                AllocationAttribute.objects.filter(
+                    allocation_id__in=allocation_ids[i : i + batch_size],
+                    allocation_attribute_type__name__in=names,
+                    allocation_attribute_type__has_usage=True,
+                )
+                .order_by("pk")
+                .values_list("pk", "allocation_id", "allocation_attribute_type__name")
+            )
+            for pk, allocation_id, name in attributes:
+                if (allocation_id, name) in values:
+                    attribute_ids.setdefault((allocation_id, name), pk)
+
+        wanted = {pk: values[key] for key, pk in attribute_ids.items()}
+        pks = sorted(wanted)
+
+        now = timezone.now()
+        changed = []
+        for i in range(0, len(pks), batch_size):
+            for usage in AllocationAttributeUsage.objects.filter(allocation_attribute_id__in=pks[i : i + batch_size]):
+                value = wanted.pop(usage.allocation_attribute_id)
+                if usage.value != value:
+                    usage.value = value
+                    usage.modified = now
+                    changed.append(usage)
+
+        if changed:
+            bulk_update_with_history(
+                changed, AllocationAttributeUsage, ["value", "modified"], batch_size=batch_size, default_date=now
+            )
+
+        # Attributes without a usage row yet
+        created = [AllocationAttributeUsage(allocation_attribute_id=pk, value=value) for pk, value in wanted.items()]
+        if created:
+            bulk_create_with_history(created, AllocationAttributeUsage, batch_size=batch_size, default_date=now)
+
+    logger.info(
+        "Set usage of %s allocation attributes: %s updated, %s created, %s unchanged",
+        len(attribute_ids),
+        len(changed),
+        len(created),
+        len(attribute_ids) - len(changed) - len(created),
+    )
+    return len(changed) + len(created)
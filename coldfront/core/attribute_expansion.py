@@ -9,8 +9,10 @@
 # attributes.  Used in the expanded_value() method of AllocationAttribute
 # and ResourceAttribute.
 
+import functools
 import logging
 import math
+from collections import namedtuple
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +21,23 @@ logger = logging.getLogger(__name__)
 
 ATTRIBUTE_EXPANSION_TYPE_PREFIX = "Attribute Expanded"
 ATTRIBUTE_EXPANSION_ATTRIBLIST_SUFFIX = "_attriblist"
+# Number of distinct attriblist strings whose compiled form is memoized
+ATTRIBUTE_EXPANSION_COMPILE_CACHE_SIZE = 1024
+
+# Prefixes recognized on the argument of an attribute parameter statement
+ATTRIBUTE_PARAMETER_SOURCES = [":APDICT", "RESOURCE:", "ALLOCATION:", ":"]
+
+# Argument kinds of a compiled attribute parameter statement
+ARGUMENT_CONSTANT = "constant"
+ARGUMENT_REFERENCE = "reference"
+
+# A single compiled attribute parameter statement.  For ARGUMENT_CONSTANT
+# statements argument holds the already evaluated value (string/numeric
+# literal, or function name for the '(' opcode); for ARGUMENT_REFERENCE
+# statements argument is the parameter/attribute name to look up in source.
+AttributeParameterStatement = namedtuple(
+    "AttributeParameterStatement", ["parameter_string", "pname", "opcode", "kind", "source", "argument"]
+)
 
 
 def is_expandable_type(attribute_type):
@@ -70,8 +89,9 @@ def get_attriblist_str(attribute_name, resources=[], allocations=[]):
 def get_attribute_parameter_value(argument, attribute_parameter_dict, error_text, resources=[], allocations=[]):
     """Evaluates the argument for a attribute parameter statement.
 
-    This is called by process_attribute_parameter_string and handles
-    evaluating/dereferencing the argument portion of the statement.
+    This is called by compile_attribute_parameter_string to evaluate
+    constant arguments, and handles evaluating/dereferencing the argument
+    portion of the statement.
 
     The following argument types are recognized:
     APDICT:pname - expands to the value of a parameter named pname already
@@ -181,7 +201,7 @@ def get_attribute_parameter_value(argument, attribute_parameter_dict, error_text
 def process_attribute_parameter_operation(opcode, oldvalue, argument, error_text):
     """Process the specified operation for attribute_parameter_dict.
 
-    This is called by process_attribute_parameter_string and handles
+    This is called by evaluate_attribute_parameter_statement and handles
     performing the specifed operation on the parameter.  Oldvalue is
     the starting value of the parameter (or None if not previously
     defined), opcode is the one character operation to perform, and
@@ -259,6 +279,7 @@ def process_attribute_parameter_operation(opcode, oldvalue, argument, error_text
         if opcode == "(":
             if argument == "floor":
                 newval = math.floor(oldvalue)
+                return newval
             else:
                 logger.error(
                     "Unrecognized function named {} in {}= for {}, returning None".format(argument, opcode, error_text)
@@ -275,93 +296,228 @@ def process_attribute_parameter_operation(opcode, oldvalue, argument, error_text
         return None
 
 
-def process_attribute_parameter_string(
-    parameter_string, attribute_name, attribute_parameter_dict={}, resources=[], allocations=[]
-):
-    """Processes a single attribute parameter definition/statement.
+def compile_attribute_parameter_string(parameter_string, attribute_name=None):
+    """Compiles a single attribute parameter definition/statement.
 
-    This is called by make_attribute_parameter_dictionary, and handles
-    the processing of a single attribute parameter definition/statement
-    given by 'parameter_string' in the attribute parameter list.  The
-    passed attribute_parameter_dict, as well as passed lists of resources
-    and allocations, will be used when dereferencing parameters/attributes,
-    and the new value for any parameter will be stored back in the
-    attribute_parameter_dict, which is also returned.
+    This parses 'parameter_string' (see process_attribute_parameter_string
+    for the statement format) into an AttributeParameterStatement that can
+    be evaluated repeatedly by evaluate_attribute_parameter_statement
+    without being parsed again.  String and numeric constants are evaluated
+    here, while parameter and attribute references are left to be resolved
+    at evaluation time.
 
-    Attribute_name is just used in diagnostic messages.
+    Attribute_name is just used in diagnostic messages, and may be None.
 
-    Each statement should have the general form:
-    '<parameter_name> <op>= <argument>'
-    <parameter_name> is the name of the parameter in
-    attribute_parameter_dict to create/update.
-    <op> is a single character operator defining the operation to do
-    on the specified parameter.
-    <argument> is an additional argument to use in the operation.  Typically
-    it will be a numeric constant, a string constant, or the name of an
-    AllocationAttribute or ResourceAttribute (which is then replaced by
-    its (expanded if expandable) value).
-
-    See the methods get_attribute_parameter_value() and
-    process_attribute_parameter_operation() for more information about
-    the operations and argument values.
+    Returns None for comment lines, blank lines and invalid statements.
     """
 
+    for_attribute = "" if attribute_name is None else " for expanding attribute {}".format(attribute_name)
+
     # Strip leading/trailing white space
     parmstr = parameter_string.strip()
-    # Ignore comment lines/blank lines (return attribute_parameter_dict)
+    # Ignore comment lines/blank lines
     if not parmstr:
-        return attribute_parameter_dict
+        return None
     if parmstr.startswith("#"):
-        return attribute_parameter_dict
+        return None
 
     # Parse the parameter string to get pname, op, and argument
     tmp = parmstr.split("=", 1)
     if len(tmp) != 2:
         # No '=' found, so invalid format of parmstr
-        # Log error and return unmodified attribute_parameter_dict
         logger.error(
-            "Invalid parameter string '{pstr}', no '=', while "
-            "creating attribute parameter dictionary for expanding "
-            "attribute {aname}".format(aname=attribute_name, pstr=parameter_string)
+            "Invalid parameter string '{pstr}', no '=', while creating attribute parameter dictionary{aname}".format(
+                aname=for_attribute, pstr=parameter_string
+            )
         )
-        return attribute_parameter_dict
+        return None
     pname = tmp[0]
     argument = tmp[1].strip()
     # Remove opcode and remove trailing whitespace from pname
     opcode = pname[-1:]
     pname = pname[:-1].strip()
 
-    # Argument is a parameter/attribute/constant unless opcode is '('
-    # So get its value if parameter/attribute/constant
-    value = None
+    # Argument is the function name if opcode is '('
     if opcode == "(":
-        value = argument
-    else:
-        # Extra text to display in diagnostics if error occurs
-        error_text = "processing attribute_parameter_string={pstr} for expansion of attribute {aname}".format(
-            pstr=parameter_string, aname=attribute_name
+        return AttributeParameterStatement(parameter_string, pname, opcode, ARGUMENT_CONSTANT, None, argument)
+
+    # Argument is a parameter/attribute reference if it has a source prefix
+    if not argument.startswith("'"):
+        for asrc in ATTRIBUTE_PARAMETER_SOURCES:
+            if argument.startswith(asrc):
+                return AttributeParameterStatement(
+                    parameter_string, pname, opcode, ARGUMENT_REFERENCE, asrc, argument[len(asrc) :]
+                )
+
+    # Otherwise argument is a string or numeric constant
+    error_text = "processing attribute_parameter_string={pstr}{aname}".format(
+        pstr=parameter_string, aname=for_attribute
+    )
+    value = get_attribute_parameter_value(argument=argument, attribute_parameter_dict=None, error_text=error_text)
+    return AttributeParameterStatement(parameter_string, pname, opcode, ARGUMENT_CONSTANT, None, value)
+
+
+@functools.lru_cache(maxsize=ATTRIBUTE_EXPANSION_COMPILE_CACHE_SIZE)
+def compile_attriblist(attriblist_string):
+    """Compiles an attribute parameter string into a reusable program.
+
+    The attriblist_string is split into lines and each line compiled with
+    compile_attribute_parameter_string.  The result is a tuple of
+    AttributeParameterStatement, in order, which can be passed to
+    evaluate_attriblist.
+
+    Compiled programs are memoized by attriblist text, so the parsing cost
+    is paid once per distinct attriblist no matter how many attributes are
+    expanded with it.  As the program does not depend on the attribute being
+    expanded, diagnostics while compiling do not name the attribute.
+    """
+
+    program = []
+    for parmstr in map(str.strip, attriblist_string.splitlines()):
+        statement = compile_attribute_parameter_string(parmstr)
+        if statement is not None:
+            program.append(statement)
+    return tuple(program)
+
+
+def _resolve_attribute_parameter_reference(statement, attribute_parameter_dict, attribute_map, resources, allocations):
+    """Resolves the parameter/attribute referenced by a compiled statement.
+
+    Parameters in attribute_parameter_dict are checked first, then
+    allocations, then resources, as described in
+    get_attribute_parameter_value.  Attribute lookups are stored in
+    attribute_map (keyed by source and name) so each attribute is only
+    looked up once per evaluation.
+    """
+
+    source = statement.source
+    name = statement.argument
+
+    if source == ":" and name in attribute_parameter_dict:
+        return attribute_parameter_dict[name]
+
+    key = (source, name)
+    if key in attribute_map:
+        return attribute_map[key]
+
+    value = None
+    if source == ":" or source == "ALLOCATION:":
+        for alloc in allocations:
+            value = alloc.get_attribute(name)
+            if value is not None:
+                break
+
+    if value is None and (source == ":" or source == "RESOURCE:"):
+        for res in resources:
+            value = res.get_attribute(name)
+            if value is not None:
+                break
+
+    attribute_map[key] = value
+    return value
+
+
+def evaluate_attribute_parameter_statement(
+    statement, attribute_name, attribute_parameter_dict, attribute_map=None, resources=[], allocations=[]
+):
+    """Evaluates a compiled statement, updating attribute_parameter_dict.
+
+    Attribute_map is an optional dictionary of already resolved attribute
+    values keyed by (source, name), shared between the statements of a
+    single evaluation.
+    """
+
+    if attribute_map is None:
+        attribute_map = {}
+
+    # Extra text to display in diagnostics if error occurs
+    error_text = "processing attribute_parameter_string={pstr} for expansion of attribute {aname}".format(
+        pstr=statement.parameter_string, aname=attribute_name
+    )
+
+    if statement.kind == ARGUMENT_REFERENCE:
+        value = _resolve_attribute_parameter_reference(
+            statement, attribute_parameter_dict, attribute_map, resources, allocations
         )
-        value = get_attribute_parameter_value(
-            argument=argument,
-            attribute_parameter_dict=attribute_parameter_dict,
+    else:
+        value = statement.argument
+
+    # Perform the requested operation on the old value of the parameter
+    newval = process_attribute_parameter_operation(
+        opcode=statement.opcode,
+        oldvalue=attribute_parameter_dict.get(statement.pname),
+        argument=value,
+        error_text=error_text,
+    )
+    attribute_parameter_dict[statement.pname] = newval
+    return attribute_parameter_dict
+
+
+def evaluate_attriblist(program, attribute_name, resources=[], allocations=[]):
+    """Evaluates a program returned by compile_attriblist.
+
+    The statements are evaluated in order against the given resources and
+    allocations, and the resulting attribute parameter dictionary is
+    returned.  Each referenced attribute is looked up at most once per
+    evaluation.
+    """
+
+    apdict = dict()
+    attribute_map = dict()
+    for statement in program:
+        apdict = evaluate_attribute_parameter_statement(
+            statement,
+            attribute_name=attribute_name,
+            attribute_parameter_dict=apdict,
+            attribute_map=attribute_map,
             resources=resources,
             allocations=allocations,
-            error_text=error_text,
         )
+    return apdict
 
-    # Get the old value of the parameter
-    if pname in attribute_parameter_dict:
-        oldval = attribute_parameter_dict[pname]
-    else:
-        oldval = None
 
-    # Perform the requested operation
-    newval = process_attribute_parameter_operation(
-        opcode=opcode, oldvalue=oldval, argument=value, error_text=error_text
+def process_attribute_parameter_string(
+    parameter_string, attribute_name, attribute_parameter_dict={}, resources=[], allocations=[]
+):
+    """Processes a single attribute parameter definition/statement.
+
+    This handles the processing of a single attribute parameter
+    definition/statement given by 'parameter_string' in the attribute
+    parameter list.  The passed attribute_parameter_dict, as well as passed
+    lists of resources and allocations, will be used when dereferencing
+    parameters/attributes, and the new value for any parameter will be
+    stored back in the attribute_parameter_dict, which is also returned.
+
+    Attribute_name is just used in diagnostic messages.
+
+    Each statement should have the general form:
+    '<parameter_name> <op>= <argument>'
+    <parameter_name> is the name of the parameter in
+    attribute_parameter_dict to create/update.
+    <op> is a single character operator defining the operation to do
+    on the specified parameter.
+    <argument> is an additional argument to use in the operation.  Typically
+    it will be a numeric constant, a string constant, or the name of an
+    AllocationAttribute or ResourceAttribute (which is then replaced by
+    its (expanded if expandable) value).
+
+    See the methods get_attribute_parameter_value() and
+    process_attribute_parameter_operation() for more information about
+    the operations and argument values.
+    """
+
+    statement = compile_attribute_parameter_string(parameter_string, attribute_name=attribute_name)
+    if statement is None:
+        # Comment, blank line or invalid statement
+        return attribute_parameter_dict
+
+    return evaluate_attribute_parameter_statement(
+        statement,
+        attribute_name=attribute_name,
+        attribute_parameter_dict=attribute_parameter_dict,
+        resources=resources,
+        allocations=allocations,
     )
-    # Set value in dictionary and return
-    attribute_parameter_dict[pname] = newval
-    return attribute_parameter_dict
 
 
 def make_attribute_parameter_dictionary(attribute_name, attribute_parameter_string, resources=[], allocations=[]):
@@ -377,28 +533,16 @@ def make_attribute_parameter_dictionary(attribute_name, attribute_parameter_stri
     general format:
     '<parameter_name> <op>= <argument>'
 
-    This routine processes the attribute_parameter_string line by line, in
-    order top to bottom, to generate the dictionary that is returned.
+    The attribute parameter string is compiled once (see compile_attriblist)
+    and the statements are evaluated in order top to bottom to generate the
+    dictionary that is returned.
 
     See process_attribute_parameter_string for details on the processing
     of each line.
     """
 
-    # Initialize our dictionary
-    apdict = dict()
-
-    # Covert attribute_parameter_string to a real list
-    attrib_parm_list = list(map(str.strip, attribute_parameter_string.splitlines()))
-    # Process each element in the list
-    for parmstr in attrib_parm_list:
-        apdict = process_attribute_parameter_string(
-            parameter_string=parmstr,
-            attribute_parameter_dict=apdict,
-            attribute_name=attribute_name,
-            resources=resources,
-            allocations=allocations,
-        )
-    return apdict
+    program = compile_attriblist(attribute_parameter_string)
+    return evaluate_attriblist(program, attribute_name=attribute_name, resources=resources, allocations=allocations)
 
 
 def expand_attribute(raw_value, attribute_name, attriblist_string, resources=[], allocations=[]):
@@ -2,4 +2,42 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-# Create your tests here.
+from django.test import TestCase
+
+from coldfront.core.resource.models import AttributeType, Resource, ResourceAttribute, ResourceAttributeType
+from coldfront.core.test_helpers.factories import ResourceFactory
+
+
+class ResourceGetAttributeTests(TestCase):
+    """Tests for Resource.get_attribute and Resource.get_attribute_list"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.resource = ResourceFactory(name="cluster")
+        text_type, _ = AttributeType.objects.get_or_create(name="Text")
+        cls.cluster_type = ResourceAttributeType.objects.create(name="slurm_cluster", attribute_type=text_type)
+        cls.specs_type = ResourceAttributeType.objects.create(name="slurm_specs", attribute_type=text_type)
+        ResourceAttribute.objects.create(resource=cls.resource, resource_attribute_type=cls.cluster_type, value="hpc")
+        ResourceAttribute.objects.create(
+            resource=cls.resource, resource_attribute_type=cls.specs_type, value="Fairshare=1"
+        )
+
+    def test_get_attribute_reads_prefetch_cache(self):
+        """Test that no queries are issued once resource attributes are prefetched"""
+        resource = Resource.objects.prefetch_related(
+            "resourceattribute_set__resource_attribute_type__attribute_type"
+        ).get(pk=self.resource.pk)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(resource.get_attribute("slurm_cluster"), "hpc")
+            self.assertEqual(resource.get_attribute_list("slurm_specs"), ["Fairshare=1"])
+            self.assertIsNone(resource.get_attribute("missing"))
+
+    def test_get_attribute_reads_attribute_index(self):
+        """Test that a preloaded attribute index is used instead of the database"""
+        index = self.resource.get_attribute_index()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.resource.get_attribute("slurm_cluster", attribute_index=index), "hpc")
+            self.assertEqual(self.resource.get_attribute_list("slurm_specs", attribute_index=index), ["Fairshare=1"])
+            self.assertEqual(self.resource.get_attribute_list("missing", attribute_index=index), [])
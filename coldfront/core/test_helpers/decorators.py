@@ -17,3 +17,4 @@ def _skipUnlessEnvDefined(varname, reason=None):
 
 
 makes_remote_requests = _skipUnlessEnvDefined("TESTS_ALLOW_REMOTE_REQUESTS")
+runs_benchmarks = _skipUnlessEnvDefined("TESTS_RUN_BENCHMARKS")
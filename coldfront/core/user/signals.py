@@ -7,12 +7,14 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver
 
 from coldfront.core.user.models import UserProfile
+from coldfront.core.user.utils import invalidate_user_search_cache
 
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
         UserProfile.objects.create(user=instance)
+        invalidate_user_search_cache()
 
 
 @receiver(post_save, sender=User)
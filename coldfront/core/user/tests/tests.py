@@ -2,10 +2,15 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
 from django.test import TestCase
 
 from coldfront.core.test_helpers.factories import UserFactory
 from coldfront.core.user.models import UserProfile
+from coldfront.core.user.utils import CombinedUserSearch, LocalUserSearch, UserSearch
 
 
 class TestUserProfile(TestCase):
@@ -49,3 +54,161 @@ class TestUserProfile(TestCase):
         with self.assertRaises(UserProfile.DoesNotExist):
             UserProfile.objects.get(pk=profile_obj.pk)
         self.assertEqual(0, len(UserProfile.objects.all()))
+
+
+class TestLocalUserSearch(TestCase):
+    def setUp(self):
+        for username in ["alice", "bob", "carol"]:
+            UserFactory(username=username)
+        UserFactory(username="dave", is_active=False)
+
+    def test_search_many_single_query(self):
+        with self.assertNumQueries(1):
+            matches = LocalUserSearch("", "").search_many(["alice", "carol", "dave", "erin"])
+
+        self.assertEqual([m["username"] for m in matches], ["alice", "carol"])
+        self.assertEqual(matches[0]["source"], "local")
+
+    def test_search_multiple_usernames(self):
+        context = CombinedUserSearch("carol bob erin bob", "all_fields").search()
+        self.assertEqual([m["username"] for m in context["matches"]], ["bob", "carol"])
+        self.assertEqual(context["number_of_usernames_found"], 2)
+        self.assertEqual(context["usernames_not_found"], ["erin"])
+
+
+class StaticUserSearch(UserSearch):
+    search_source = "static"
+    delay = 0
+
+    def search_a_user(self, user_search_string=None, search_by="all_fields"):
+        time.sleep(self.delay)
+        return [{"username": "alice", "source": self.search_source}, {"username": "zoe", "source": self.search_source}]
+
+
+class CountingUserSearch(StaticUserSearch):
+    search_source = "counting"
+    calls = 0
+
+    def search_a_user(self, user_search_string=None, search_by="all_fields"):
+        CountingUserSearch.calls += 1
+        return super().search_a_user(user_search_string, search_by)
+
+
+class SlowUserSearch(StaticUserSearch):
+    search_source = "slow"
+    delay = 1
+
+
+class FailingUserSearch(UserSearch):
+    search_source = "failing"
+
+    def search_a_user(self, user_search_string=None, search_by="all_fields"):
+        raise ValueError("directory unavailable")
+
+
+class UnreachableUserSearch(StaticUserSearch):
+    search_source = "unreachable"
+
+    def __init__(self, user_search_string, search_by):
+        raise ConnectionError("bind failed")
+
+
+class HangingUserSearch(StaticUserSearch):
+    search_source = "hanging"
+
+    def __init__(self, user_search_string, search_by):
+        time.sleep(1)
+        super().__init__(user_search_string, search_by)
+
+
+class ConnectingUserSearch(StaticUserSearch):
+    search_source = "connecting"
+    connections = 0
+
+    def __init__(self, user_search_string, search_by):
+        ConnectingUserSearch.connections += 1
+        super().__init__(user_search_string, search_by)
+
+
+class TestCombinedUserSearch(TestCase):
+    def setUp(self):
+        UserFactory(username="alice")
+
+    def search(self, classes):
+        with mock.patch("coldfront.core.user.utils.get_user_search_classes", return_value=classes):
+            return CombinedUserSearch("alice", "all_fields").search()
+
+    def test_results_merged_in_source_order(self):
+        context = self.search([LocalUserSearch, StaticUserSearch])
+        self.assertEqual(
+            [(m["username"], m["source"]) for m in context["matches"]], [("alice", "local"), ("zoe", "static")]
+        )
+        self.assertEqual(context["failed_sources"], [])
+
+    def test_failed_and_slow_sources_reported(self):
+        with mock.patch("coldfront.core.user.utils.USER_SEARCH_TIMEOUT", 0.2):
+            context = self.search([LocalUserSearch, FailingUserSearch, SlowUserSearch])
+
+        self.assertEqual([m["username"] for m in context["matches"]], ["alice"])
+        self.assertEqual(
+            context["failed_sources"],
+            [{"source": "failing", "error": "directory unavailable"}, {"source": "slow", "error": "timed out"}],
+        )
+
+    def test_sources_failing_to_connect_reported(self):
+        with mock.patch("coldfront.core.user.utils.USER_SEARCH_TIMEOUT", 0.2):
+            start = time.monotonic()
+            context = self.search([LocalUserSearch, UnreachableUserSearch, HangingUserSearch, StaticUserSearch])
+            elapsed = time.monotonic() - start
+
+        self.assertLess(elapsed, 0.9)
+        self.assertEqual([m["username"] for m in context["matches"]], ["alice", "zoe"])
+        self.assertEqual(
+            context["failed_sources"],
+            [{"source": "unreachable", "error": "bind failed"}, {"source": "hanging", "error": "timed out"}],
+        )
+
+    def test_local_source_failing_to_connect_reported(self):
+        context = self.search([UnreachableUserSearch, StaticUserSearch])
+
+        self.assertEqual([m["username"] for m in context["matches"]], ["alice", "zoe"])
+        self.assertEqual(context["failed_sources"], [{"source": "unreachable", "error": "bind failed"}])
+
+    def test_results_cached_until_user_created(self):
+        CountingUserSearch.calls = 0
+        self.search([LocalUserSearch, CountingUserSearch])
+        context = self.search([LocalUserSearch, CountingUserSearch])
+        self.assertEqual(CountingUserSearch.calls, 1)
+        self.assertEqual([m["username"] for m in context["matches"]], ["alice", "zoe"])
+
+        UserFactory(username="alice2")
+        context = self.search([LocalUserSearch, CountingUserSearch])
+        self.assertEqual(CountingUserSearch.calls, 2)
+        self.assertEqual([m["username"] for m in context["matches"]], ["alice", "alice2", "zoe"])
+
+    def test_local_results_not_cached(self):
+        CountingUserSearch.calls = 0
+        self.search([LocalUserSearch, CountingUserSearch])
+        User.objects.filter(username="alice").update(first_name="Alicia")
+        with self.assertNumQueries(1):
+            context = self.search([LocalUserSearch, CountingUserSearch])
+
+        self.assertEqual(CountingUserSearch.calls, 1)
+        self.assertEqual(
+            [(m["username"], m["source"]) for m in context["matches"]], [("alice", "local"), ("zoe", "counting")]
+        )
+        self.assertEqual(context["matches"][0]["first_name"], "Alicia")
+
+    def test_cached_sources_not_created(self):
+        ConnectingUserSearch.connections = 0
+        self.search([LocalUserSearch, ConnectingUserSearch])
+        context = self.search([LocalUserSearch, ConnectingUserSearch])
+        self.assertEqual(ConnectingUserSearch.connections, 1)
+        self.assertEqual([m["username"] for m in context["matches"]], ["alice", "zoe"])
+
+    def test_cache_disabled(self):
+        CountingUserSearch.calls = 0
+        with mock.patch("coldfront.core.user.utils.USER_SEARCH_CACHE_TIMEOUT", 0):
+            self.search([LocalUserSearch, CountingUserSearch])
+            self.search([LocalUserSearch, CountingUserSearch])
+        self.assertEqual(CountingUserSearch.calls, 2)
@@ -3,9 +3,15 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import abc
+import concurrent.futures
+import hashlib
 import logging
+import threading
+import time
 
 from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connections
 from django.db.models import Q
 from django.utils.module_loading import import_string
 
@@ -13,6 +19,14 @@ from coldfront.core.utils.common import import_from_settings
 
 logger = logging.getLogger(__name__)
 
+USER_SEARCH_TIMEOUT = import_from_settings("USER_SEARCH_TIMEOUT", 10)
+USER_SEARCH_MAX_WORKERS = import_from_settings("USER_SEARCH_MAX_WORKERS", 4)
+USER_SEARCH_CACHE = import_from_settings("USER_SEARCH_CACHE", "default")
+USER_SEARCH_CACHE_TIMEOUT = import_from_settings("USER_SEARCH_CACHE_TIMEOUT", 120)
+
+# Bumped to invalidate all cached user search results
+USER_SEARCH_CACHE_GENERATION_KEY = "coldfront.user_search.generation"
+
 
 class UserSearch(abc.ABC):
     def __init__(self, user_search_string, search_by):
@@ -23,16 +37,22 @@ class UserSearch(abc.ABC):
     def search_a_user(self, user_search_string=None, search_by="all_fields"):
         pass
 
+    def search_many(self, usernames):
+        """Search for each of usernames with search_by "username_only" and
+        return the matches in the order of usernames. Sources that can look up
+        many users in a single request should override this."""
+        matches = []
+        for username in usernames:
+            match = self.search_a_user(username, "username_only")
+            if match:
+                matches.extend(match)
+
+        return matches
+
     def search(self):
         if len(self.user_search_string.split()) > 1:
-            search_by = "username_only"
-            matches = []
-
             user_search_string = sorted(list(set(self.user_search_string.split())))
-            for username in user_search_string:
-                match = self.search_a_user(username, search_by)
-                if match:
-                    matches.extend(match)
+            matches = self.search_many(user_search_string)
         else:
             matches = self.search_a_user(self.user_search_string, self.search_by)
 
@@ -76,25 +96,189 @@ class LocalUserSearch(UserSearch):
         logger.info("Local user search for %s found %s results", user_search_string, len(users))
         return users
 
+    def search_many(self, usernames):
+        entries = User.objects.filter(username__in=usernames, is_active=True)
+        by_username = {user.username: user for user in entries}
+
+        users = []
+        for username in usernames:
+            user = by_username.get(username)
+            if user:
+                users.append(
+                    {
+                        "last_name": user.last_name,
+                        "first_name": user.first_name,
+                        "username": user.username,
+                        "email": user.email,
+                        "source": self.search_source,
+                    }
+                )
+
+        logger.info("Local user search for %s usernames found %s results", len(usernames), len(users))
+        return users
+
+
+_search_classes = None
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_user_search_classes():
+    """Return the LocalUserSearch class followed by the classes listed in
+    ADDITIONAL_USER_SEARCH_CLASSES, imported once per process"""
+    global _search_classes
+    if _search_classes is None:
+        paths = ["coldfront.core.user.utils.LocalUserSearch"]
+        paths += import_from_settings("ADDITIONAL_USER_SEARCH_CLASSES", [])
+        _search_classes = [import_string(path) for path in paths]
+
+    return _search_classes
+
+
+def get_user_search_executor():
+    """Return the thread pool additional user search sources run on"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=USER_SEARCH_MAX_WORKERS, thread_name_prefix="user-search"
+            )
+
+    return _executor
+
+
+def _run_search(search_class, user_search_string, search_by):
+    try:
+        return search_class(user_search_string, search_by).search()
+    finally:
+        # Worker threads must not keep database connections open
+        connections.close_all()
+
+
+def get_user_search_cache():
+    """Return the cache user search results are kept in, or None if caching
+    is disabled"""
+    if not USER_SEARCH_CACHE or not USER_SEARCH_CACHE_TIMEOUT:
+        return None
+
+    return caches[USER_SEARCH_CACHE]
+
+
+def user_search_cache_keys(cache, search_classes, user_search_string, search_by):
+    """Return the cache key of the results of each search class for a search.
+    The search string is normalized the same way UserSearch.search reads it,
+    so searches that would run the same queries share a key."""
+    usernames = user_search_string.split()
+    if len(usernames) > 1:
+        user_search_string = " ".join(sorted(set(usernames)))
+        search_by = "username_only"
+    else:
+        user_search_string = user_search_string.strip()
+
+    generation = cache.get(USER_SEARCH_CACHE_GENERATION_KEY, 0)
+    keys = []
+    for cls in search_classes:
+        source = "{}.{}".format(cls.__module__, cls.__qualname__)
+        digest = hashlib.sha256("\0".join([source, search_by or "", user_search_string]).encode()).hexdigest()
+        keys.append("coldfront.user_search.{}.{}".format(generation, digest))
+
+    return keys
+
+
+def invalidate_user_search_cache():
+    """Drop all cached user search results, e.g. when a user is created.
+    The generation counter lives in USER_SEARCH_CACHE, so other processes
+    only see the change if that cache is shared between them."""
+    cache = get_user_search_cache()
+    if cache is None:
+        return
+
+    try:
+        cache.incr(USER_SEARCH_CACHE_GENERATION_KEY)
+    except ValueError:
+        cache.set(USER_SEARCH_CACHE_GENERATION_KEY, 1, None)
+
 
 class CombinedUserSearch:
     def __init__(self, user_search_string, search_by, usernames_names_to_exclude=[]):
-        self.USER_SEARCH_CLASSES = import_from_settings("ADDITIONAL_USER_SEARCH_CLASSES", [])
-        self.USER_SEARCH_CLASSES.insert(0, "coldfront.core.user.utils.LocalUserSearch")
+        self.USER_SEARCH_CLASSES = get_user_search_classes()
         self.user_search_string = user_search_string
         self.search_by = search_by
         self.usernames_names_to_exclude = usernames_names_to_exclude
 
+    def search_sources(self):
+        """Search every source and return a list of results per source, in
+        the configured order, and a list of sources that failed or did not
+        answer within USER_SEARCH_TIMEOUT seconds.
+
+        The additional sources are created and searched concurrently on a
+        thread pool while the local database is searched on the calling
+        thread, so a source that fails or hangs while connecting is reported
+        like one that fails or hangs while searching. A source that times out
+        keeps its worker thread until it returns, so sources should set their
+        own connect and search timeouts. Results of the additional sources are
+        cached for USER_SEARCH_CACHE_TIMEOUT seconds per source, so searching
+        again for the same string (e.g. when adding the users found) does not
+        query them again. The local database is always searched, so its
+        results follow changes to users right away."""
+        cache = get_user_search_cache()
+        keys = [None] * len(self.USER_SEARCH_CLASSES)
+        cached = {}
+        if cache is not None:
+            keys[1:] = user_search_cache_keys(
+                cache, self.USER_SEARCH_CLASSES[1:], self.user_search_string, self.search_by
+            )
+            cached = cache.get_many(keys[1:])
+
+        start = time.monotonic()
+        futures = [None]
+        for search_class, key in zip(self.USER_SEARCH_CLASSES[1:], keys[1:]):
+            if key in cached:
+                futures.append(None)
+            else:
+                futures.append(
+                    get_user_search_executor().submit(
+                        _run_search, search_class, self.user_search_string, self.search_by
+                    )
+                )
+
+        results = []
+        failed_sources = []
+        for search_class, key, future in zip(self.USER_SEARCH_CLASSES, keys, futures):
+            if key in cached:
+                results.append(cached[key])
+                continue
+
+            source = getattr(search_class, "search_source", search_class.__name__)
+            try:
+                if future is None:
+                    users = search_class(self.user_search_string, self.search_by).search()
+                else:
+                    users = future.result(timeout=max(0, USER_SEARCH_TIMEOUT - (time.monotonic() - start)))
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                logger.warning("User search source %s did not answer within %ss", source, USER_SEARCH_TIMEOUT)
+                failed_sources.append({"source": source, "error": "timed out"})
+                users = []
+            except Exception as e:
+                logger.error("User search source %s failed: %s", source, e)
+                failed_sources.append({"source": source, "error": str(e)})
+                users = []
+            else:
+                if key is not None:
+                    cache.set(key, users, USER_SEARCH_CACHE_TIMEOUT)
+
+            results.append(users)
+
+        return results, failed_sources
+
     def search(self):
         matches = []
         usernames_not_found = []
         usernames_found = []
 
-        for search_class in self.USER_SEARCH_CLASSES:
-            cls = import_string(search_class)
-            search_class_obj = cls(self.user_search_string, self.search_by)
-            users = search_class_obj.search()
-
+        results, failed_sources = self.search_sources()
+        for users in results:
             for user in users:
                 username = user.get("username")
                 if username not in usernames_found and username not in self.usernames_names_to_exclude:
@@ -117,5 +301,6 @@ class CombinedUserSearch:
             "number_of_usernames_searched": number_of_usernames_searched,
             "number_of_usernames_found": number_of_usernames_found,
             "usernames_not_found": usernames_not_found,
+            "failed_sources": failed_sources,
         }
         return context
@@ -0,0 +1,85 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import logging
+import threading
+
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+
+logger = logging.getLogger(__name__)
+
+
+class ChoiceRegistry:
+    """Process wide cache of choice model instances (e.g. ProjectStatusChoice)
+    by name. Choices are looked up lazily on first use so importing a module
+    that needs them does not query the database, and each choice is only
+    queried once per process. The cached choices of a model are dropped when
+    any of its instances is saved or deleted, and all cached choices are
+    dropped when settings change (e.g. with override_settings in tests)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._connected = set()
+
+    def get(self, model, name):
+        """Return the instance of choice model with the given name. Raises
+        model.DoesNotExist if there is no such choice"""
+        key = (model._meta.label, name)
+        choice = self._cache.get(key)
+        if choice is None:
+            self._connect(model)
+            choice = model.objects.get(name=name)
+            with self._lock:
+                self._cache[key] = choice
+
+        return choice
+
+    def get_pk(self, model, name):
+        """Return the primary key of the choice model with the given name"""
+        return self.get(model, name).pk
+
+    def clear(self, model=None):
+        """Drop cached choices of model, or all cached choices"""
+        with self._lock:
+            if model is None:
+                self._cache = {}
+            else:
+                label = model._meta.label
+                self._cache = {k: v for k, v in self._cache.items() if k[0] != label}
+
+    def _connect(self, model):
+        """Drop the cached choices of model when any of its instances is
+        saved or deleted. Only choice models are connected, so saving other
+        models does not go through the registry."""
+        label = model._meta.label
+        if label in self._connected:
+            return
+
+        with self._lock:
+            post_save.connect(self._model_changed, sender=model, dispatch_uid=f"choice_registry_post_save_{label}")
+            post_delete.connect(self._model_changed, sender=model, dispatch_uid=f"choice_registry_post_delete_{label}")
+            self._connected.add(label)
+
+    def _model_changed(self, sender, **kwargs):
+        logger.debug("Choices of %s changed, clearing cache", sender._meta.label)
+        self.clear(sender)
+
+    def _settings_changed(self, **kwargs):
+        self.clear()
+
+
+choice_registry = ChoiceRegistry()
+setting_changed.connect(choice_registry._settings_changed, dispatch_uid="choice_registry_setting_changed")
+
+
+def get_choice(model, name):
+    """Return the cached instance of choice model with the given name"""
+    return choice_registry.get(model, name)
+
+
+def get_choice_pk(model, name):
+    """Return the cached primary key of the choice model with the given name"""
+    return choice_registry.get_pk(model, name)
@@ -5,6 +5,8 @@
 import datetime
 
 from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 from django_q.models import Schedule
@@ -14,6 +16,10 @@ from coldfront.config.email import EMAIL_ALLOCATION_EULA_REMINDERS
 from coldfront.core.utils.common import import_from_settings
 
 ALLOCATION_EULA_ENABLE = import_from_settings("ALLOCATION_EULA_ENABLE", False)
+IQUOTA_CACHE = import_from_settings("IQUOTA_CACHE", "default")
+IQUOTA_CACHE_PREWARM_MINUTES = import_from_settings("IQUOTA_CACHE_PREWARM_MINUTES", 0)
+SYSTEM_MONITOR_REFRESH_MINUTES = import_from_settings("SYSTEM_MONITOR_REFRESH_MINUTES", 0)
+SYSTEM_MONITOR_CACHE = import_from_settings("SYSTEM_MONITOR_CACHE", "default")
 base_dir = settings.BASE_DIR
 
 
@@ -29,3 +35,44 @@ class Command(BaseCommand):
             schedule(
                 "coldfront.core.allocation.tasks.send_eula_reminders", schedule_type=Schedule.WEEKLY, next_run=date
             )
+
+        if "coldfront.plugins.iquota" in settings.INSTALLED_APPS and IQUOTA_CACHE_PREWARM_MINUTES:
+            func = "coldfront.plugins.iquota.tasks.prewarm_quota_cache"
+            # The task runs in the django-q cluster, so a per-process cache
+            # would only ever be warmed there and never seen by the portal
+            if isinstance(caches[IQUOTA_CACHE], LocMemCache):
+                self.stderr.write(
+                    self.style.WARNING(
+                        "Not scheduling %s: IQUOTA_CACHE '%s' is a local-memory cache that is not shared "
+                        "with the portal. Configure a shared cache (e.g. Redis or memcached) to use it."
+                        % (func, IQUOTA_CACHE)
+                    )
+                )
+            # Running this command again must not add the task twice
+            elif not Schedule.objects.filter(func=func).exists():
+                schedule(
+                    func,
+                    name="Prewarm iquota cache",
+                    schedule_type=Schedule.MINUTES,
+                    minutes=IQUOTA_CACHE_PREWARM_MINUTES,
+                )
+
+        if "coldfront.plugins.system_monitor" in settings.INSTALLED_APPS and SYSTEM_MONITOR_REFRESH_MINUTES:
+            func = "coldfront.plugins.system_monitor.tasks.refresh_system_monitor"
+            # The task runs in the django-q cluster, so a per-process cache
+            # would only ever be refreshed there and never seen by the portal
+            if isinstance(caches[SYSTEM_MONITOR_CACHE], LocMemCache):
+                self.stderr.write(
+                    self.style.WARNING(
+                        "Not scheduling %s: SYSTEM_MONITOR_CACHE '%s' is a local-memory cache that is not shared "
+                        "with the portal. Configure a shared cache (e.g. Redis or memcached) to use it."
+                        % (func, SYSTEM_MONITOR_CACHE)
+                    )
+                )
+            elif not Schedule.objects.filter(func=func).exists():
+                schedule(
+                    func,
+                    name="Refresh system monitor",
+                    schedule_type=Schedule.MINUTES,
+                    minutes=SYSTEM_MONITOR_REFRESH_MINUTES,
+                )
@@ -0,0 +1,43 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+from django.test import TestCase, override_settings
+
+from coldfront.core.project.models import ProjectStatusChoice, ProjectUserStatusChoice
+from coldfront.core.utils.choices import choice_registry, get_choice, get_choice_pk
+
+
+class ChoiceRegistryTest(TestCase):
+    def setUp(self):
+        choice_registry.clear()
+        self.active = ProjectStatusChoice.objects.create(name="Active")
+
+    def tearDown(self):
+        choice_registry.clear()
+
+    def test_choice_is_queried_once(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(get_choice(ProjectStatusChoice, "Active"), self.active)
+            self.assertEqual(get_choice_pk(ProjectStatusChoice, "Active"), self.active.pk)
+
+    def test_missing_choice(self):
+        with self.assertRaises(ProjectStatusChoice.DoesNotExist):
+            get_choice(ProjectStatusChoice, "Missing")
+
+    def test_cache_cleared_on_change(self):
+        get_choice(ProjectStatusChoice, "Active")
+        self.active.delete()
+        active = ProjectStatusChoice.objects.create(name="Active")
+        self.assertEqual(get_choice_pk(ProjectStatusChoice, "Active"), active.pk)
+
+    def test_other_models_keep_cache(self):
+        get_choice(ProjectStatusChoice, "Active")
+        ProjectUserStatusChoice.objects.create(name="Active")
+        with self.assertNumQueries(0):
+            self.assertEqual(get_choice_pk(ProjectStatusChoice, "Active"), self.active.pk)
+
+    def test_cache_cleared_on_setting_change(self):
+        get_choice(ProjectStatusChoice, "Active")
+        with override_settings(PROJECT_CODE="TEST"), self.assertNumQueries(1):
+            get_choice(ProjectStatusChoice, "Active")
@@ -5,6 +5,9 @@
 import logging
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import dbus
 from django.contrib.auth.models import User
@@ -13,9 +16,11 @@ from ipalib import api
 
 from coldfront.core.allocation.models import AllocationUser, AllocationUserStatusChoice
 from coldfront.core.project.models import ProjectUser, ProjectUserStatusChoice
+from coldfront.core.utils.choices import get_choice
 from coldfront.plugins.freeipa.search import LDAPUserSearch
 from coldfront.plugins.freeipa.utils import (
     CLIENT_KTNAME,
+    FREEIPA_CHECK_WORKERS,
     FREEIPA_NOOP,
     UNIX_GROUP_ATTRIBUTE_NAME,
     AlreadyMemberError,
@@ -25,6 +30,9 @@ from coldfront.plugins.freeipa.utils import (
 
 logger = logging.getLogger(__name__)
 
+# Log progress every this many users
+PROGRESS_INTERVAL = 1000
+
 
 class Command(BaseCommand):
     help = "Sync groups in FreeIPA"
@@ -41,6 +49,13 @@ class Command(BaseCommand):
         )
         parser.add_argument("-n", "--noop", help="Print commands only. Do not run any commands.", action="store_true")
         parser.add_argument("-x", "--header", help="Include header in output", action="store_true")
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            default=FREEIPA_CHECK_WORKERS,
+            help="Number of users to look up in SSSD/FreeIPA in parallel (default %(default)s)",
+        )
 
     def writerow(self, row):
         try:
@@ -112,7 +127,7 @@ class Command(BaseCommand):
             return
 
         # Disable user from any active allocations
-        inactive_status = AllocationUserStatusChoice.objects.get(name="Removed")
+        inactive_status = get_choice(AllocationUserStatusChoice, "Removed")
         user_allocations = AllocationUser.objects.filter(user=user)
         for ua in user_allocations:
             if ua.status.name == "Active" and ua.allocation.status.name == "Active":
@@ -121,7 +136,7 @@ class Command(BaseCommand):
                 ua.save()
 
         # Disable user from any active projects
-        inactive_status = ProjectUserStatusChoice.objects.get(name="Removed")
+        inactive_status = get_choice(ProjectUserStatusChoice, "Removed")
         user_projects = ProjectUser.objects.filter(user=user)
         for pa in user_projects:
             if pa.status.name == "Active" and pa.project.status.name == "Active":
@@ -144,31 +159,94 @@ class Command(BaseCommand):
         except Exception as e:
             logger.error("Failed to update user status: %s - %s", user.username, e)
 
-    def check_user_freeipa(self, user, active_groups, removed_groups):
-        logger.info(
-            "Checking FreeIPA user=%s active_groups=%s removed_groups=%s", user.username, active_groups, removed_groups
-        )
-
-        freeipa_groups = []
-        freeipa_status = "Unknown"
+    def get_ifp(self):
+        """Return the SSSD infopipe interface and FreeIPA LDAP search of the
+        current thread, each worker gets its own D-Bus and LDAP connection"""
+        if not hasattr(self.local, "ifp"):
+            bus = dbus.SystemBus(private=True)
+            infopipe_obj = bus.get_object("org.freedesktop.sssd.infopipe", "/org/freedesktop/sssd/infopipe")
+            self.local.ifp = dbus.Interface(infopipe_obj, dbus_interface="org.freedesktop.sssd.infopipe")
+            self.local.ipa_ldap = LDAPUserSearch("", "")
+
+        return self.local.ifp, self.local.ipa_ldap
+
+    def lookup_user_freeipa(self, username):
+        """Return the FreeIPA groups and status of a user, or None if the
+        lookup failed. Safe to call from worker threads."""
+        ifp, ipa_ldap = self.get_ifp()
         try:
-            result = self.ifp.GetUserGroups(user.username)
+            result = ifp.GetUserGroups(username)
             logger.debug(result)
             freeipa_groups = [str(x) for x in result]
 
-            users = self.ipa_ldap.search_a_user(user.username, "username_only")
+            users = ipa_ldap.search_a_user(username, "username_only")
             if len(users) == 1:
                 freeipa_status = "Enabled"
             else:
                 freeipa_status = "Disabled"
         except dbus.exceptions.DBusException as e:
             if "No such user" in str(e) or "NotFound" in str(e):
-                logger.info("Skipping user %s not found in FreeIPA", user.username)
-                freeipa_status = "NotFound"
+                logger.info("Skipping user %s not found in FreeIPA", username)
             else:
-                logger.error("dbus error failed to find user %s in FreeIPA: %s", user.username, e)
+                logger.error("dbus error failed to find user %s in FreeIPA: %s", username, e)
+            return None
+
+        return freeipa_groups, freeipa_status
+
+    def lookup_user_disabled(self, username):
+        """Return "Disabled" or "NotFound" if the user is disabled or missing
+        in FreeIPA, otherwise None. Safe to call from worker threads."""
+        ifp, _ = self.get_ifp()
+        try:
+            result = ifp.GetUserAttr(username, ["nsaccountlock"])
+            if "nsAccountLock" in result and str(result["nsAccountLock"][0]) == "TRUE":
+                return "Disabled"
+        except dbus.exceptions.DBusException as e:
+            if "No such user" in str(e) or "NotFound" in str(e):
+                return "NotFound"
+            logger.error("dbus error failed while checking user %s in FreeIPA: %s", username, e)
+
+        return None
+
+    def map_users(self, func, users, what):
+        """Yield (user, func(user.username)) for each user in order, running
+        up to self.workers lookups in parallel and logging progress"""
+        total = len(users)
+        start = time.perf_counter()
+        usernames = [user.username for user in users]
+        if self.workers > 1 and total > 1:
+            executor = ThreadPoolExecutor(max_workers=self.workers)
+            results = executor.map(func, usernames)
+        else:
+            executor = None
+            results = map(func, usernames)
+
+        try:
+            for count, (user, result) in enumerate(zip(users, results), 1):
+                yield user, result
+                if count % PROGRESS_INTERVAL == 0:
+                    logger.info(
+                        "%s %s/%s users (%.1f users/s)", what, count, total, count / (time.perf_counter() - start)
+                    )
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        elapsed = time.perf_counter() - start
+        self.metrics.append((what, total, elapsed))
+
+    def check_user_freeipa(self, user, active_groups, removed_groups, lookup=None):
+        logger.info(
+            "Checking FreeIPA user=%s active_groups=%s removed_groups=%s", user.username, active_groups, removed_groups
+        )
+
+        if lookup is None:
+            lookup = self.lookup_user_freeipa(user.username)
+        if lookup is None:
             return
 
+        freeipa_groups, freeipa_status = lookup
+
         if freeipa_status == "Disabled" and user.is_active:
             logger.warning("User is active in coldfront but disabled in FreeIPA: %s", user.username)
             self.sync_user_status(user, active=False)
@@ -186,60 +264,80 @@ class Command(BaseCommand):
                 logger.info("User %s should be removed from freeipa group: %s", user.username, g)
                 self.remove_group(user, g, freeipa_status)
 
-    def process_user(self, user):
-        if self.filter_user and self.filter_user != user.username:
-            return
-
-        user_allocations = AllocationUser.objects.filter(
-            user=user, allocation__allocationattribute__allocation_attribute_type__name=UNIX_GROUP_ATTRIBUTE_NAME
+    def get_expected_groups(self, users):
+        """Build the FreeIPA groups each user should be added to and removed
+        from, using a single query over the allocations of all users. The
+        groups and resource availability of each allocation are only worked out
+        once. Returns a dict mapping user pk to (active_groups, removed_groups)
+        for users with any groups to check."""
+        user_allocations = (
+            AllocationUser.objects.filter(
+                user__in=users,
+                allocation__allocationattribute__allocation_attribute_type__name=UNIX_GROUP_ATTRIBUTE_NAME,
+            )
+            .select_related("status", "user", "allocation__status")
+            .prefetch_related(
+                "allocation__resources__resourceattribute_set__resource_attribute_type__attribute_type",
+                "allocation__allocationattribute_set__allocation_attribute_type__attribute_type",
+            )
+            .distinct()
+            .order_by("user", "pk")
         )
 
-        active_groups = []
+        allocation_groups = {}
+        allocation_available = {}
+        by_user = {}
         for ua in user_allocations:
-            if not ua.is_active():
-                continue
+            if ua.allocation_id not in allocation_groups:
+                allocation_groups[ua.allocation_id] = ua.allocation.get_attribute_list(UNIX_GROUP_ATTRIBUTE_NAME)
+                allocation_available[ua.allocation_id] = any(r.is_available for r in ua.allocation.resources.all())
+            by_user.setdefault(ua.user_id, []).append(ua)
+
+        expected = {}
+        for user_id, uas in by_user.items():
+            active_groups = []
+            for ua in uas:
+                if not ua.is_active():
+                    continue
 
-            all_resources_inactive = True
-            for r in ua.allocation.resources.all():
-                if r.is_available:
-                    all_resources_inactive = False
+                if not allocation_available[ua.allocation_id]:
+                    logger.debug(
+                        "Skipping allocation to %s for user %s due to all resources being inactive",
+                        ua.allocation.get_resources_as_string,
+                        ua.user.username,
+                    )
+                    continue
 
-            if all_resources_inactive:
-                logger.debug(
-                    "Skipping allocation to %s for user %s due to all resources being inactive",
-                    ua.allocation.get_resources_as_string,
-                    user.username,
-                )
-                continue
+                for g in allocation_groups[ua.allocation_id]:
+                    if g not in active_groups:
+                        active_groups.append(g)
 
-            for g in ua.allocation.get_attribute_list(UNIX_GROUP_ATTRIBUTE_NAME):
-                if g not in active_groups:
-                    active_groups.append(g)
+            removed_groups = []
+            for ua in uas:
+                if ua.is_active():
+                    continue
 
-        removed_groups = []
-        for ua in user_allocations:
-            if ua.is_active():
-                continue
+                for g in allocation_groups[ua.allocation_id]:
+                    if g not in removed_groups and g not in active_groups:
+                        removed_groups.append(g)
 
-            for g in ua.allocation.get_attribute_list(UNIX_GROUP_ATTRIBUTE_NAME):
-                if g not in removed_groups and g not in active_groups:
-                    removed_groups.append(g)
+            if self.filter_group:
+                if self.filter_group in active_groups:
+                    active_groups = [self.filter_group]
+                else:
+                    active_groups = []
 
-        if self.filter_group:
-            if self.filter_group in active_groups:
-                active_groups = [self.filter_group]
-            else:
-                active_groups = []
+                if self.filter_group in removed_groups:
+                    removed_groups = [self.filter_group]
+                else:
+                    removed_groups = []
 
-            if self.filter_group in removed_groups:
-                removed_groups = [self.filter_group]
-            else:
-                removed_groups = []
+            if len(active_groups) == 0 and len(removed_groups) == 0:
+                continue
 
-        if len(active_groups) == 0 and len(removed_groups) == 0:
-            return
+            expected[user_id] = (active_groups, removed_groups)
 
-        self.check_user_freeipa(user, active_groups, removed_groups)
+        return expected
 
     def handle(self, *args, **options):
         os.environ["KRB5_CLIENT_KTNAME"] = CLIENT_KTNAME
@@ -280,10 +378,9 @@ class Command(BaseCommand):
         if options["header"]:
             self.writerow(header)
 
-        self.ipa_ldap = LDAPUserSearch("", "")
-        bus = dbus.SystemBus()
-        infopipe_obj = bus.get_object("org.freedesktop.sssd.infopipe", "/org/freedesktop/sssd/infopipe")
-        self.ifp = dbus.Interface(infopipe_obj, dbus_interface="org.freedesktop.sssd.infopipe")
+        self.workers = max(1, options["workers"])
+        self.local = threading.local()
+        self.metrics = []
 
         users = User.objects.filter(is_active=True)
         logger.info("Processing %s active users", len(users))
@@ -293,28 +390,31 @@ class Command(BaseCommand):
         if options["username"]:
             logger.info("Filtering output by username: %s", options["username"])
             self.filter_user = options["username"]
+            users = users.filter(username=self.filter_user)
         if options["group"]:
             logger.info("Filtering output by group: %s", options["group"])
             self.filter_group = options["group"]
 
-        for user in users:
-            self.process_user(user)
+        expected = self.get_expected_groups(users)
+        to_check = [user for user in users if user.pk in expected]
+        for user, lookup in self.map_users(self.lookup_user_freeipa, to_check, "Checked"):
+            self.check_user_freeipa(user, *expected[user.pk], lookup=lookup)
 
         if self.disable:
-            for user in users:
-                if self.filter_user and self.filter_user != user.username:
-                    continue
-
-                try:
-                    result = self.ifp.GetUserAttr(user.username, ["nsaccountlock"])
-                    if "nsAccountLock" in result and str(result["nsAccountLock"][0]) == "TRUE":
-                        # User is disabled in FreeIPA so disable in coldfront
-                        logger.info("User is disabled in FreeIPA so disable in ColdFront: %s", user.username)
-                        self.disable_user_in_coldfront(user, "Disabled")
-                except dbus.exceptions.DBusException as e:
-                    if "No such user" in str(e) or "NotFound" in str(e):
-                        # User is not found in FreeIPA so disable in coldfront
-                        logger.info("User is not found in FreeIPA so disable in ColdFront: %s", user.username)
-                        self.disable_user_in_coldfront(user, "NotFound")
-                    else:
-                        logger.error("dbus error failed while checking user %s in FreeIPA: %s", user.username, e)
+            for user, freeipa_status in self.map_users(self.lookup_user_disabled, list(users), "Checked status of"):
+                if freeipa_status == "Disabled":
+                    # User is disabled in FreeIPA so disable in coldfront
+                    logger.info("User is disabled in FreeIPA so disable in ColdFront: %s", user.username)
+                    self.disable_user_in_coldfront(user, "Disabled")
+                elif freeipa_status == "NotFound":
+                    # User is not found in FreeIPA so disable in coldfront
+                    logger.info("User is not found in FreeIPA so disable in ColdFront: %s", user.username)
+                    self.disable_user_in_coldfront(user, "NotFound")
+
+        if verbosity > 0:
+            for what, total, elapsed in self.metrics:
+                self.stderr.write(
+                    "{} {} users in {:.1f}s ({:.1f} users/s, {} workers)".format(
+                        what, total, elapsed, total / elapsed if elapsed else 0, self.workers
+                    )
+                )
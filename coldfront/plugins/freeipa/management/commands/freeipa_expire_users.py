@@ -8,13 +8,16 @@ import os
 import sys
 
 import dbus
+from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand
+from django.db.models import Case, F, Max, Q, When
+from django.db.models.functions import TruncDate
 from django.urls import reverse
-from ipalib import api
 
 from coldfront.core.allocation.models import AllocationUser
+from coldfront.core.user.utils import invalidate_user_search_cache
 from coldfront.core.utils.mail import build_link
-from coldfront.plugins.freeipa.utils import CLIENT_KTNAME, FREEIPA_NOOP
+from coldfront.plugins.freeipa.utils import CLIENT_KTNAME, FREEIPA_NOOP, ipa_batch
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +38,55 @@ class Command(BaseCommand):
             os.dup2(devnull, sys.stdout.fileno())
             sys.exit(1)
 
+    def get_expired_users(self, expired_before):
+        """Return a dict mapping username to the latest expire date of users
+        that are not active on any allocation and whose latest expire date is
+        on or before expired_before, along with the allocation it came from.
+
+        The expire date of an allocation user is the end date of the
+        allocation, or the date the user was removed from a non expired
+        allocation. The latest expire date per user is computed with a single
+        aggregate query rather than walking every allocation user."""
+        expire_date = Case(
+            When(
+                Q(status__name="Removed") & ~Q(allocation__status__name="Expired"),
+                then=TruncDate("modified", tzinfo=datetime.timezone.utc),
+            ),
+            default=F("allocation__end_date"),
+        )
+
+        # Users active on any active allocation are never expired
+        active_users = (
+            AllocationUser.objects.filter(status__name="Active")
+            .exclude(allocation__status__name__in=["Expired"])
+            .values("user")
+        )
+
+        latest = dict(
+            AllocationUser.objects.exclude(user__in=active_users)
+            .values("user__username")
+            .annotate(latest_expire_date=Max(expire_date))
+            .filter(latest_expire_date__lte=expired_before)
+            .values_list("user__username", "latest_expire_date")
+        )
+
+        # Pick the allocation the latest expire date came from, the first
+        # one by id as when walking the allocation users in order
+        expired_users = {}
+        for username, allocation_id, date in (
+            AllocationUser.objects.filter(user__username__in=latest)
+            .annotate(expire_date=expire_date)
+            .order_by("pk")
+            .values_list("user__username", "allocation_id", "expire_date")
+        ):
+            if username not in expired_users and date == latest[username]:
+                expired_users[username] = {
+                    "expire_date": date,
+                    "allocation_id": allocation_id,
+                }
+
+        return dict(sorted(expired_users.items()))
+
     def handle(self, *args, **options):
         os.environ["KRB5_CLIENT_KTNAME"] = CLIENT_KTNAME
 
@@ -75,90 +127,59 @@ class Command(BaseCommand):
         expired_365_days_ago = datetime.datetime.today() - datetime.timedelta(days=365)
         expired_365_days_ago = expired_365_days_ago.date()
 
-        # Find all active users on active allocations
-        active_users = sorted(
-            list(
-                set(
-                    AllocationUser.objects.filter(status__name="Active")
-                    .exclude(allocation__status__name__in=["Expired"])
-                    .values_list("user__username", flat=True)
-                )
-            )
-        )
-
-        # Filter out users to expire, either not active or have been removed
-        expired_allocation_users = {}
-        for allocationuser in AllocationUser.objects.all():
-            if allocationuser.user.username in active_users:
-                continue
-
-            allocation = allocationuser.allocation
-            expire_date = allocation.end_date
-            if allocation.status.name != "Expired" and allocationuser.status.name == "Removed":
-                expire_date = allocationuser.modified.date()
-
-            if not expire_date:
-                logger.info(
-                    "Unable to find expire date for user=%s allocation_id=%s",
-                    allocationuser.user.username,
-                    allocation.id,
-                )
-                continue
-
-            if allocationuser.user.username not in expired_allocation_users:
-                expired_allocation_users[allocationuser.user.username] = {
-                    "user": allocationuser.user,
-                    "expire_date": expire_date,
-                    "allocation_id": allocation.id,
-                }
-            else:
-                if expire_date > expired_allocation_users[allocationuser.user.username]["expire_date"]:
-                    expired_allocation_users[allocationuser.user.username] = {
-                        "user": allocationuser.user,
-                        "expire_date": expire_date,
-                        "allocation_id": allocation.id,
-                    }
-
-        # Print users whose latest allocation expiration date GTE 365 days and active in FreeIPA
-        for key in expired_allocation_users.keys():
-            if expired_allocation_users[key]["expire_date"] > expired_365_days_ago:
-                continue
+        # Users whose latest allocation expiration date GTE 365 days
+        expired_users = self.get_expired_users(expired_365_days_ago)
+        logger.info("Found %s users with no allocations active in the last 365 days", len(expired_users))
 
+        # Print those still active in FreeIPA
+        to_disable = []
+        for key, expired in expired_users.items():
             try:
                 result = ifp.GetUserAttr(key, ["nsaccountlock"])
                 if "nsAccountLock" in result and str(result["nsAccountLock"][0]).lower() == "true":
                     # User is already disabled in FreeIPA so do nothing
                     logger.info("User already disabled in FreeIPA: %s", key)
-                    pass
-                else:
-                    # User is active in FreeIPA but not on any active allocations
-                    self.writerow(
-                        [
-                            key,
-                            expired_allocation_users[key]["expire_date"].strftime("%Y-%m-%d"),
-                            build_link(
-                                reverse(
-                                    "allocation-detail", kwargs={"pk": expired_allocation_users[key]["allocation_id"]}
-                                )
-                            ),
-                        ]
-                    )
-
-                    if self.sync and not self.noop:
-                        # Disable in ColdFront
-                        expired_allocation_users[key]["user"].is_active = False
-                        expired_allocation_users[key]["user"].save()
-
-                        # Disable in FreeIPA
-                        res = api.Command.user_disable(key)
-                        if not res:
-                            raise ValueError("Missing FreeIPA response")
-                        if "result" not in res or not res["result"]:
-                            raise ValueError(f"Failed to disable user: {res}")
+                    continue
             except dbus.exceptions.DBusException as e:
                 if "No such user" in str(e) or "NotFound" in str(e):
                     logger.info("User %s not found in FreeIPA", key)
                 else:
                     logger.error("dbus error failed to find user %s in FreeIPA: %s", key, e)
-            except Exception as e:
-                logger.error("Failed to disable user %s: %s", key, e)
+                continue
+
+            # User is active in FreeIPA but not on any active allocations
+            self.writerow(
+                [
+                    key,
+                    expired["expire_date"].strftime("%Y-%m-%d"),
+                    build_link(reverse("allocation-detail", kwargs={"pk": expired["allocation_id"]})),
+                ]
+            )
+            to_disable.append(key)
+
+        if not self.sync or self.noop or not to_disable:
+            return
+
+        # Disable in FreeIPA, in batches
+        disabled = []
+        try:
+            for (key,), error in ipa_batch("user_disable", [(key,) for key in to_disable]):
+                if error:
+                    logger.error("Failed to disable user %s: %s", key, error)
+                else:
+                    logger.info("Disabled user %s in FreeIPA", key)
+                    disabled.append(key)
+        except Exception as e:
+            logger.error("Failed to disable users: %s", e)
+
+        if not disabled:
+            return
+
+        # Disable in ColdFront only the users disabled in FreeIPA. Users are
+        # saved one at a time so the post_save signal handlers still run.
+        for user in User.objects.filter(username__in=disabled, is_active=True):
+            user.is_active = False
+            user.save(update_fields=["is_active"])
+
+        # Disabled users no longer show up in local user searches
+        invalidate_user_search_cache()
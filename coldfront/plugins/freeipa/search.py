@@ -15,6 +15,9 @@ from coldfront.core.utils.common import import_from_settings
 
 logger = logging.getLogger(__name__)
 
+# Max number of usernames looked up in a single LDAP filter by search_many
+SEARCH_MANY_CHUNK_SIZE = 100
+
 
 class LDAPUserSearch(UserSearch):
     search_source = "LDAP"
@@ -84,3 +87,27 @@ class LDAPUserSearch(UserSearch):
 
         logger.info("LDAP user search for %s found %s results", user_search_string, len(users))
         return users
+
+    def search_many(self, usernames):
+        """Look up usernames with one (|(uid=a)(uid=b)...) filter per chunk of
+        SEARCH_MANY_CHUNK_SIZE usernames rather than one search per username"""
+        os.environ["KRB5_CLIENT_KTNAME"] = self.FREEIPA_KTNAME
+
+        found = {}
+        for i in range(0, len(usernames), SEARCH_MANY_CHUNK_SIZE):
+            chunk = usernames[i : i + SEARCH_MANY_CHUNK_SIZE]
+            uids = "".join(ldap.filter.filter_format("(uid=%s)", [name]) for name in chunk)
+            searchParameters = {
+                "search_base": self.FREEIPA_USER_SEARCH_BASE,
+                "search_filter": f"(&(|{uids})(|(nsaccountlock=FALSE)(!(nsaccountlock=*))))",
+                "attributes": ["uid", "sn", "givenName", "mail"],
+                "size_limit": len(chunk),
+            }
+            self.conn.search(**searchParameters)
+            for entry in self.conn.entries:
+                user_dict = self.parse_ldap_entry(entry)
+                found.setdefault(user_dict["username"].lower(), user_dict)
+
+        users = [found[username.lower()] for username in usernames if username.lower() in found]
+        logger.info("LDAP user search for %s usernames found %s results", len(usernames), len(users))
+        return users
@@ -2,6 +2,9 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import threading
+
+from django.core.signals import request_finished, request_started
 from django.dispatch import receiver
 from django_q.tasks import async_task
 
@@ -9,12 +12,41 @@ from coldfront.core.allocation.signals import allocation_activate_user, allocati
 from coldfront.core.allocation.views import AllocationAddUsersView, AllocationRemoveUsersView, AllocationRenewView
 from coldfront.core.project.views import ProjectAddUsersView, ProjectRemoveUsersView
 
+# Allocation users activated or removed while handling a request are queued
+# and submitted as a single batched task per kind when the request finishes,
+# so adding many users at once makes one FreeIPA call per group.
+_pending = threading.local()
+
+
+def _queue_task(func, allocation_user_pk):
+    batches = getattr(_pending, "batches", None)
+    if batches is None:
+        async_task(func, [allocation_user_pk])
+        return
+
+    pks = batches.setdefault(func, [])
+    if allocation_user_pk not in pks:
+        pks.append(allocation_user_pk)
+
+
+@receiver(request_started)
+def start_batches(sender, **kwargs):
+    _pending.batches = {}
+
+
+@receiver(request_finished)
+def submit_batches(sender, **kwargs):
+    batches = getattr(_pending, "batches", None)
+    _pending.batches = None
+    for func, allocation_user_pks in (batches or {}).items():
+        async_task(func, allocation_user_pks)
+
 
 @receiver(allocation_activate_user, sender=ProjectAddUsersView)
 @receiver(allocation_activate_user, sender=AllocationAddUsersView)
 def activate_user(sender, **kwargs):
     allocation_user_pk = kwargs.get("allocation_user_pk")
-    async_task("coldfront.plugins.freeipa.tasks.add_user_group", allocation_user_pk)
+    _queue_task("coldfront.plugins.freeipa.tasks.add_user_groups", allocation_user_pk)
 
 
 @receiver(allocation_remove_user, sender=ProjectRemoveUsersView)
@@ -22,4 +54,4 @@ def activate_user(sender, **kwargs):
 @receiver(allocation_remove_user, sender=AllocationRenewView)
 def remove_user(sender, **kwargs):
     allocation_user_pk = kwargs.get("allocation_user_pk")
-    async_task("coldfront.plugins.freeipa.tasks.remove_user_group", allocation_user_pk)
+    _queue_task("coldfront.plugins.freeipa.tasks.remove_user_groups", allocation_user_pk)
@@ -10,117 +10,163 @@ from ipalib import api
 from coldfront.core.allocation.models import Allocation, AllocationUser
 from coldfront.core.allocation.utils import set_allocation_user_status_to_error
 from coldfront.plugins.freeipa.utils import (
+    ALREADY_MEMBER_MSG,
     CLIENT_KTNAME,
     FREEIPA_NOOP,
+    NOT_MEMBER_MSG,
     UNIX_GROUP_ATTRIBUTE_NAME,
-    AlreadyMemberError,
-    NotMemberError,
-    check_ipa_group_error,
+    get_ipa_group_failures,
 )
 
 logger = logging.getLogger(__name__)
 
 
 def add_user_group(allocation_user_pk):
-    allocation_user = AllocationUser.objects.get(pk=allocation_user_pk)
-    if allocation_user.allocation.status.name != "Active":
-        logger.warning("Allocation is not active. Will not add groups")
-        return
+    add_user_groups([allocation_user_pk])
 
-    if allocation_user.status.name != "Active":
-        logger.warning("Allocation user status is not 'Active'. Will not add groups.")
-        return
 
-    groups = allocation_user.allocation.get_attribute_list(UNIX_GROUP_ATTRIBUTE_NAME)
-    if len(groups) == 0:
-        logger.info("Allocation does not have any groups. Nothing to add")
-        return
+def remove_user_group(allocation_user_pk):
+    remove_user_groups([allocation_user_pk])
+
+
+def _get_allocation_users(allocation_user_pks):
+    return (
+        AllocationUser.objects.filter(pk__in=allocation_user_pks)
+        .select_related("allocation__status", "status", "user")
+        .prefetch_related("allocation__allocationattribute_set__allocation_attribute_type__attribute_type")
+        .order_by("pk")
+    )
+
 
+def _update_groups(command, verb, done, preposition, ignore_msg, members):
+    """Run a FreeIPA group membership command once per group for all users
+    in members, a dict mapping group to a dict of username to the allocation
+    user pks being changed. The per member failures in the response are
+    checked and the allocation users of failed members are set to Error,
+    except for ignore_msg (already a member/not a member) which is only
+    logged."""
     os.environ["KRB5_CLIENT_KTNAME"] = CLIENT_KTNAME
-    for g in groups:
+    failed_pks = set()
+    for g, users in members.items():
+        usernames = ", ".join(users)
         if FREEIPA_NOOP:
-            logger.warning(
-                "NOOP - FreeIPA adding user %s to group %s for allocation %s",
-                allocation_user.user.username,
-                g,
-                allocation_user.allocation,
-            )
+            logger.warning("NOOP - FreeIPA %s users %s %s group %s", verb, usernames, preposition, g)
             continue
 
         try:
-            res = api.Command.group_add_member(g, user=[allocation_user.user.username])
-            check_ipa_group_error(res)
-        except AlreadyMemberError:
-            logger.warning("User %s is already a member of group %s", allocation_user.user.username, g)
+            res = command(g, user=list(users))
+            failures = get_ipa_group_failures(res)
         except Exception as e:
-            logger.error("Failed adding user %s to group %s: %s", allocation_user.user.username, g, e)
-            set_allocation_user_status_to_error(allocation_user_pk)
-        else:
-            logger.info("Added user %s to group %s successfully", allocation_user.user.username, g)
+            logger.error("Failed %s users %s %s group %s: %s", verb, usernames, preposition, g, e)
+            failures = {username: str(e) for username in users}
+
+        for username, pks in users.items():
+            err_msg = failures.get(username)
+            if err_msg is None:
+                logger.info("%s user %s %s group %s successfully", done, username, preposition, g)
+            elif err_msg == ignore_msg:
+                logger.warning("User %s, group %s: %s", username, g, err_msg)
+            else:
+                logger.error("Failed %s user %s %s group %s: %s", verb, username, preposition, g, err_msg)
+                failed_pks.update(pks)
+
+    for pk in sorted(failed_pks):
+        set_allocation_user_status_to_error(pk)
+
+
+def add_user_groups(allocation_user_pks):
+    """Add the users of the given allocation users to the FreeIPA groups of
+    their allocations, with a single group_add_member call per group"""
+    members = {}
+    for allocation_user in _get_allocation_users(allocation_user_pks):
+        if allocation_user.allocation.status.name != "Active":
+            logger.warning("Allocation %s is not active. Will not add groups", allocation_user.allocation)
+            continue
 
+        if allocation_user.status.name != "Active":
+            logger.warning(
+                "Allocation user %s status is not 'Active'. Will not add groups.", allocation_user.user.username
+            )
+            continue
 
-def remove_user_group(allocation_user_pk):
-    allocation_user = AllocationUser.objects.get(pk=allocation_user_pk)
-    if allocation_user.allocation.status.name not in [
-        "Active",
-        "Pending",
-    ]:
-        logger.warning("Allocation is not active or pending. Will not remove groups.")
-        return
-
-    if allocation_user.status.name != "Removed":
-        logger.warning("Allocation user status is not 'Removed'. Will not remove groups.")
-        return
-
-    groups = allocation_user.allocation.get_attribute_list(UNIX_GROUP_ATTRIBUTE_NAME)
-    if len(groups) == 0:
-        logger.info("Allocation does not have any groups. Nothing to remove")
-        return
-
-    # Check other active allocations the user is active on for FreeIPA groups
-    # and ensure we don't remove them.
+        groups = allocation_user.allocation.get_attribute_list(UNIX_GROUP_ATTRIBUTE_NAME)
+        if len(groups) == 0:
+            logger.info("Allocation %s does not have any groups. Nothing to add", allocation_user.allocation)
+            continue
+
+        for g in groups:
+            members.setdefault(g, {}).setdefault(allocation_user.user.username, []).append(allocation_user.pk)
+
+    _update_groups(api.Command.group_add_member, "adding", "Added", "to", ALREADY_MEMBER_MSG, members)
+
+
+def remove_user_groups(allocation_user_pks):
+    """Remove the users of the given allocation users from the FreeIPA groups
+    of their allocations, with a single group_remove_member call per group.
+    Groups the user still has through another active allocation are kept."""
+    allocation_users = []
+    for allocation_user in _get_allocation_users(allocation_user_pks):
+        if allocation_user.allocation.status.name not in [
+            "Active",
+            "Pending",
+        ]:
+            logger.warning(
+                "Allocation %s is not active or pending. Will not remove groups.", allocation_user.allocation
+            )
+            continue
+
+        if allocation_user.status.name != "Removed":
+            logger.warning(
+                "Allocation user %s status is not 'Removed'. Will not remove groups.", allocation_user.user.username
+            )
+            continue
+
+        allocation_users.append(allocation_user)
+
+    # Check other active allocations the users are active on for FreeIPA
+    # groups and ensure we don't remove them.
     user_allocations = (
-        Allocation.objects.filter(
-            allocationuser__user=allocation_user.user,
-            allocationuser__status__name="Active",
+        AllocationUser.objects.filter(
+            user__in=[au.user_id for au in allocation_users],
             status__name="Active",
-            allocationattribute__allocation_attribute_type__name=UNIX_GROUP_ATTRIBUTE_NAME,
+            allocation__status__name="Active",
+            allocation__allocationattribute__allocation_attribute_type__name=UNIX_GROUP_ATTRIBUTE_NAME,
         )
-        .exclude(pk=allocation_user.allocation.pk)
+        .values_list("user", "allocation")
         .distinct()
     )
+    allocation_groups = {
+        a.pk: a.get_attribute_list(UNIX_GROUP_ATTRIBUTE_NAME)
+        for a in Allocation.objects.filter(pk__in={pk for _, pk in user_allocations}).prefetch_related(
+            "allocationattribute_set__allocation_attribute_type__attribute_type"
+        )
+    }
+    active_groups = {}
+    for user_id, allocation_id in user_allocations:
+        active_groups.setdefault(user_id, []).append(allocation_id)
+
+    members = {}
+    for allocation_user in allocation_users:
+        groups = allocation_user.allocation.get_attribute_list(UNIX_GROUP_ATTRIBUTE_NAME)
+        if len(groups) == 0:
+            logger.info("Allocation %s does not have any groups. Nothing to remove", allocation_user.allocation)
+            continue
 
-    exclude = []
-    for a in user_allocations:
-        for g in a.get_attribute_list(UNIX_GROUP_ATTRIBUTE_NAME):
-            if g in groups:
-                exclude.append(g)
-
-    for g in exclude:
-        groups.remove(g)
-
-    if len(groups) == 0:
-        logger.info("No groups to remove. User may belong to these groups in other active allocations: %s", exclude)
-        return
+        exclude = set()
+        for allocation_id in active_groups.get(allocation_user.user_id, []):
+            if allocation_id != allocation_user.allocation_id:
+                exclude.update(g for g in allocation_groups[allocation_id] if g in groups)
 
-    os.environ["KRB5_CLIENT_KTNAME"] = CLIENT_KTNAME
-    for g in groups:
-        if FREEIPA_NOOP:
-            logger.warning(
-                "NOOP - FreeIPA removing user %s from group %s for allocation %s",
+        groups = [g for g in groups if g not in exclude]
+        if len(groups) == 0:
+            logger.info(
+                "No groups to remove. User %s may belong to these groups in other active allocations: %s",
                 allocation_user.user.username,
-                g,
-                allocation_user.allocation,
+                sorted(exclude),
             )
             continue
 
-        try:
-            res = api.Command.group_remove_member(g, user=[allocation_user.user.username])
-            check_ipa_group_error(res)
-        except NotMemberError:
-            logger.warning("User %s is not a member of group %s", allocation_user.user.username, g)
-        except Exception as e:
-            logger.error("Failed removing user %s from group %s: %s", allocation_user.user.username, g, e)
-            set_allocation_user_status_to_error(allocation_user_pk)
-        else:
-            logger.info("Removed user %s from group %s successfully", allocation_user.user.username, g)
+        for g in groups:
+            members.setdefault(g, {}).setdefault(allocation_user.user.username, []).append(allocation_user.pk)
+
+    _update_groups(api.Command.group_remove_member, "removing", "Removed", "from", NOT_MEMBER_MSG, members)
@@ -0,0 +1,177 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Unit tests for the freeipa_expire_users command"""
+
+import datetime
+import unittest
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+
+from coldfront.config.env import ENV
+
+if not ENV.bool("PLUGIN_FREEIPA", default=False):
+    raise unittest.SkipTest("Only run FreeIPA tests if enabled")
+
+from coldfront.core.allocation.models import AllocationUser
+from coldfront.core.test_helpers.factories import (
+    AllocationFactory,
+    AllocationStatusChoiceFactory,
+    AllocationUserFactory,
+    AllocationUserStatusChoiceFactory,
+    UserFactory,
+)
+from coldfront.plugins.freeipa.management.commands import freeipa_expire_users
+from coldfront.plugins.freeipa.management.commands.freeipa_expire_users import Command
+
+TODAY = datetime.date.today()
+
+
+def years_ago(years, days=0):
+    return TODAY - datetime.timedelta(days=365 * years + days)
+
+
+class GetExpiredUsersTests(TestCase):
+    """tests for Command.get_expired_users"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.active = AllocationStatusChoiceFactory(name="Active")
+        cls.expired = AllocationStatusChoiceFactory(name="Expired")
+        cls.user_active = AllocationUserStatusChoiceFactory(name="Active")
+        cls.user_removed = AllocationUserStatusChoiceFactory(name="Removed")
+
+    def allocation_user(self, username, status, end_date, user_status=None, removed_on=None):
+        allocation = AllocationFactory(status=status, end_date=end_date)
+        user = User.objects.filter(username=username).first() or UserFactory(username=username)
+        allocation_user = AllocationUserFactory(
+            allocation=allocation, user=user, status=user_status or self.user_active
+        )
+        if removed_on:
+            AllocationUser.objects.filter(pk=allocation_user.pk).update(
+                modified=datetime.datetime.combine(removed_on, datetime.time(12), tzinfo=datetime.timezone.utc)
+            )
+        return allocation_user
+
+    def get_expired_users(self):
+        return Command().get_expired_users(years_ago(1))
+
+    def test_latest_expire_date_is_used(self):
+        self.allocation_user("alice", self.expired, years_ago(3))
+        latest = self.allocation_user("alice", self.expired, years_ago(2))
+        self.allocation_user("alice", self.expired, years_ago(4))
+
+        self.assertEqual(
+            self.get_expired_users(),
+            {"alice": {"expire_date": years_ago(2), "allocation_id": latest.allocation_id}},
+        )
+
+    def test_latest_expire_date_after_cutoff_is_not_expired(self):
+        self.allocation_user("alice", self.expired, years_ago(3))
+        self.allocation_user("alice", self.expired, years_ago(0, days=30))
+
+        self.assertEqual(self.get_expired_users(), {})
+
+    def test_users_active_on_an_allocation_are_not_expired(self):
+        self.allocation_user("alice", self.expired, years_ago(3))
+        self.allocation_user("alice", self.active, years_ago(2))
+
+        self.assertEqual(self.get_expired_users(), {})
+
+    def test_removed_from_allocation_uses_removal_date(self):
+        removed = self.allocation_user(
+            "alice", self.active, TODAY, user_status=self.user_removed, removed_on=years_ago(2)
+        )
+
+        self.assertEqual(
+            self.get_expired_users(),
+            {"alice": {"expire_date": years_ago(2), "allocation_id": removed.allocation_id}},
+        )
+
+    def test_removed_recently_is_not_expired(self):
+        self.allocation_user("alice", self.expired, years_ago(3))
+        self.allocation_user(
+            "alice", self.active, years_ago(3), user_status=self.user_removed, removed_on=years_ago(0, days=30)
+        )
+
+        self.assertEqual(self.get_expired_users(), {})
+
+    def test_removed_from_expired_allocation_uses_end_date(self):
+        removed = self.allocation_user(
+            "alice", self.expired, years_ago(3), user_status=self.user_removed, removed_on=years_ago(0, days=30)
+        )
+
+        self.assertEqual(
+            self.get_expired_users(),
+            {"alice": {"expire_date": years_ago(3), "allocation_id": removed.allocation_id}},
+        )
+
+    def test_tie_break_is_first_allocation_user(self):
+        first = self.allocation_user("alice", self.expired, years_ago(2))
+        self.allocation_user("alice", self.expired, years_ago(2))
+
+        self.assertEqual(self.get_expired_users()["alice"]["allocation_id"], first.allocation_id)
+
+    def test_users_are_sorted(self):
+        self.allocation_user("carol", self.expired, years_ago(2))
+        self.allocation_user("alice", self.expired, years_ago(2))
+
+        self.assertEqual(list(self.get_expired_users()), ["alice", "carol"])
+
+
+class ExpireUsersSyncTests(TestCase):
+    """tests for freeipa_expire_users --sync"""
+
+    @classmethod
+    def setUpTestData(cls):
+        expired = AllocationStatusChoiceFactory(name="Expired")
+        user_status = AllocationUserStatusChoiceFactory(name="Active")
+        for username in ["alice", "bob"]:
+            AllocationUserFactory(
+                allocation=AllocationFactory(status=expired, end_date=years_ago(2)),
+                user=UserFactory(username=username),
+                status=user_status,
+            )
+
+    def call_command(self, *args):
+        ifp = mock.Mock()
+        ifp.GetUserAttr.return_value = {"nsAccountLock": ["FALSE"]}
+        out = StringIO()
+        with (
+            mock.patch.object(freeipa_expire_users.dbus, "SystemBus"),
+            mock.patch.object(freeipa_expire_users.dbus, "Interface", return_value=ifp),
+            mock.patch.object(freeipa_expire_users, "build_link", side_effect=lambda url: url),
+            mock.patch.object(
+                freeipa_expire_users,
+                "ipa_batch",
+                side_effect=lambda method, args_list: [
+                    (args, "boom" if args[0] == "bob" else None) for args in args_list
+                ],
+            ) as ipa_batch,
+            mock.patch.object(freeipa_expire_users, "invalidate_user_search_cache") as invalidate,
+        ):
+            call_command("freeipa_expire_users", *args, stdout=out)
+        return out.getvalue(), ipa_batch, invalidate
+
+    def test_report_only_without_sync(self):
+        out, ipa_batch, _ = self.call_command()
+
+        self.assertIn("alice", out)
+        self.assertIn("bob", out)
+        ipa_batch.assert_not_called()
+        self.assertEqual(User.objects.filter(username__in=["alice", "bob"], is_active=True).count(), 2)
+
+    def test_sync_deactivates_only_users_disabled_in_freeipa(self):
+        with mock.patch.object(freeipa_expire_users.logger, "error") as error:
+            _, ipa_batch, invalidate = self.call_command("--sync")
+
+        error.assert_called()
+        ipa_batch.assert_called_once_with("user_disable", [("alice",), ("bob",)])
+        self.assertFalse(User.objects.get(username="alice").is_active)
+        self.assertTrue(User.objects.get(username="bob").is_active)
+        invalidate.assert_called_once_with()
@@ -0,0 +1,79 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Unit tests for the freeipa user search"""
+
+import json
+import unittest
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from coldfront.config.env import ENV
+
+if not ENV.bool("PLUGIN_FREEIPA", default=False):
+    raise unittest.SkipTest("Only run FreeIPA tests if enabled")
+
+from coldfront.plugins.freeipa import search
+from coldfront.plugins.freeipa.search import LDAPUserSearch
+
+
+def ldap_entry(username):
+    """Return a mocked ldap3 Entry for a user"""
+    attributes = {"uid": [username], "sn": ["User"], "givenName": [username.title()], "mail": []}
+    entry = mock.Mock()
+    entry.entry_to_json.return_value = json.dumps({"dn": f"uid={username}", "attributes": attributes})
+    return entry
+
+
+class SearchManyTests(SimpleTestCase):
+    """tests for LDAPUserSearch.search_many"""
+
+    directory = ["alice", "bob", "carol"] + [f"user{i:03}" for i in range(250)]
+
+    def setUp(self):
+        self.conn = mock.Mock()
+        self.conn.bind.return_value = True
+        self.conn.search.side_effect = self.search
+        patcher = mock.patch.object(search, "Connection", return_value=self.conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def search(self, search_base, search_filter, attributes, size_limit):
+        self.conn.entries = [
+            ldap_entry(username) for username in self.directory if f"(uid={username.lower()})" in search_filter.lower()
+        ]
+
+    def search_many(self, usernames):
+        return LDAPUserSearch("", "username_only").search_many(usernames)
+
+    def filters(self):
+        return [call.kwargs["search_filter"] for call in self.conn.search.call_args_list]
+
+    def test_usernames_are_searched_in_chunks(self):
+        usernames = [f"user{i:03}" for i in range(250)]
+
+        users = self.search_many(usernames)
+
+        self.assertEqual([user["username"] for user in users], usernames)
+        self.assertEqual([call.kwargs["size_limit"] for call in self.conn.search.call_args_list], [100, 100, 50])
+        self.assertTrue(self.filters()[0].startswith("(&(|(uid=user000)(uid=user001)"))
+        self.assertTrue(self.filters()[0].endswith("(uid=user099))(|(nsaccountlock=FALSE)(!(nsaccountlock=*))))"))
+
+    def test_results_follow_requested_order(self):
+        users = self.search_many(["carol", "missing", "ALICE", "bob"])
+
+        self.assertEqual([user["username"] for user in users], ["carol", "alice", "bob"])
+        self.assertEqual(
+            users[0],
+            {"last_name": "User", "first_name": "Carol", "username": "carol", "email": "", "source": "LDAP"},
+        )
+
+    def test_filter_values_are_escaped(self):
+        self.assertEqual(self.search_many(["*", "a)(uid=*"]), [])
+
+        self.assertEqual(
+            self.filters(),
+            [r"(&(|(uid=\2a)(uid=a\29\28uid=\2a))(|(nsaccountlock=FALSE)(!(nsaccountlock=*))))"],
+        )
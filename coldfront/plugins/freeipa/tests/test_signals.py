@@ -0,0 +1,68 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Unit tests for the freeipa signal handlers"""
+
+import unittest
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from coldfront.config.env import ENV
+
+if not ENV.bool("PLUGIN_FREEIPA", default=False):
+    raise unittest.SkipTest("Only run FreeIPA tests if enabled")
+
+from coldfront.core.allocation.signals import allocation_activate_user, allocation_remove_user
+from coldfront.core.allocation.views import AllocationAddUsersView, AllocationRemoveUsersView
+from coldfront.core.project.views import ProjectAddUsersView
+from coldfront.plugins.freeipa import signals
+
+ADD_TASK = "coldfront.plugins.freeipa.tasks.add_user_groups"
+REMOVE_TASK = "coldfront.plugins.freeipa.tasks.remove_user_groups"
+
+
+class FreeIPASignalBatchingTests(SimpleTestCase):
+    """tests for batching the freeipa tasks per request"""
+
+    def setUp(self):
+        patcher = mock.patch.object(signals, "async_task")
+        self.async_task = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, signals._pending, "batches", None)
+
+    def test_tasks_are_batched_per_request(self):
+        signals.start_batches(sender=None)
+        allocation_activate_user.send(sender=ProjectAddUsersView, allocation_user_pk=1)
+        allocation_activate_user.send(sender=AllocationAddUsersView, allocation_user_pk=2)
+        allocation_activate_user.send(sender=AllocationAddUsersView, allocation_user_pk=1)
+        allocation_remove_user.send(sender=AllocationRemoveUsersView, allocation_user_pk=3)
+
+        self.async_task.assert_not_called()
+
+        signals.submit_batches(sender=None)
+
+        self.assertEqual(
+            self.async_task.call_args_list,
+            [mock.call(ADD_TASK, [1, 2]), mock.call(REMOVE_TASK, [3])],
+        )
+
+    def test_batches_are_reset_after_request(self):
+        signals.start_batches(sender=None)
+        allocation_activate_user.send(sender=ProjectAddUsersView, allocation_user_pk=1)
+        signals.submit_batches(sender=None)
+        self.async_task.reset_mock()
+
+        signals.submit_batches(sender=None)
+
+        self.async_task.assert_not_called()
+
+    def test_tasks_outside_request_are_submitted_immediately(self):
+        allocation_activate_user.send(sender=ProjectAddUsersView, allocation_user_pk=1)
+        allocation_remove_user.send(sender=AllocationRemoveUsersView, allocation_user_pk=2)
+
+        self.assertEqual(
+            self.async_task.call_args_list,
+            [mock.call(ADD_TASK, [1]), mock.call(REMOVE_TASK, [2])],
+        )
@@ -0,0 +1,174 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Unit tests for the freeipa tasks"""
+
+import unittest
+from unittest import mock
+
+from django.test import TestCase
+
+from coldfront.config.env import ENV
+
+if not ENV.bool("PLUGIN_FREEIPA", default=False):
+    raise unittest.SkipTest("Only run FreeIPA tests if enabled")
+
+from coldfront.core.test_helpers.factories import (
+    AAttributeTypeFactory,
+    AllocationAttributeFactory,
+    AllocationAttributeTypeFactory,
+    AllocationFactory,
+    AllocationStatusChoiceFactory,
+    AllocationUserFactory,
+    AllocationUserStatusChoiceFactory,
+    UserFactory,
+)
+from coldfront.plugins.freeipa import tasks
+from coldfront.plugins.freeipa.utils import ALREADY_MEMBER_MSG, NOT_MEMBER_MSG, UNIX_GROUP_ATTRIBUTE_NAME
+
+
+def ipa_response(group, users, failed=()):
+    """Return a group_add_member/group_remove_member response with the given
+    (username, error message) failures"""
+    return {
+        "completed": len(users) - len(failed),
+        "failed": {"member": {"user": list(failed)}},
+        "result": {"cn": [group]},
+    }
+
+
+class FreeIPAGroupTasksTests(TestCase):
+    """tests for add_user_groups and remove_user_groups"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.active = AllocationUserStatusChoiceFactory(name="Active")
+        cls.removed = AllocationUserStatusChoiceFactory(name="Removed")
+        AllocationUserStatusChoiceFactory(name="Error")
+        cls.group_type = AllocationAttributeTypeFactory(
+            name=UNIX_GROUP_ATTRIBUTE_NAME, attribute_type=AAttributeTypeFactory(name="Text")
+        )
+        cls.allocation = AllocationFactory(status=AllocationStatusChoiceFactory(name="Active"))
+        for group in ["grp_a", "grp_b"]:
+            AllocationAttributeFactory(allocation=cls.allocation, allocation_attribute_type=cls.group_type, value=group)
+        cls.users = [UserFactory(username=username) for username in ["alice", "bob"]]
+
+    def setUp(self):
+        patcher = mock.patch.object(tasks.api, "Command")
+        self.command = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.command.group_add_member.side_effect = lambda g, user: ipa_response(g, user)
+        self.command.group_remove_member.side_effect = lambda g, user: ipa_response(g, user)
+
+    def allocation_users(self, status, allocation=None):
+        return [
+            AllocationUserFactory(allocation=allocation or self.allocation, user=user, status=status)
+            for user in self.users
+        ]
+
+    def status(self, allocation_user):
+        allocation_user.refresh_from_db()
+        return allocation_user.status.name
+
+    def test_add_user_groups_one_call_per_group(self):
+        allocation_users = self.allocation_users(self.active)
+
+        tasks.add_user_groups([au.pk for au in allocation_users])
+
+        self.assertEqual(
+            self.command.group_add_member.call_args_list,
+            [mock.call("grp_a", user=["alice", "bob"]), mock.call("grp_b", user=["alice", "bob"])],
+        )
+        self.assertEqual([self.status(au) for au in allocation_users], ["Active", "Active"])
+
+    def test_add_user_groups_skips_inactive_allocation_users(self):
+        allocation_users = self.allocation_users(self.removed)
+
+        with mock.patch.object(tasks.logger, "warning") as warning:
+            tasks.add_user_groups([au.pk for au in allocation_users])
+
+        warning.assert_called()
+        self.command.group_add_member.assert_not_called()
+
+    def test_add_user_groups_already_member_is_not_an_error(self):
+        allocation_users = self.allocation_users(self.active)
+        self.command.group_add_member.side_effect = lambda g, user: ipa_response(
+            g, user, failed=[("alice", ALREADY_MEMBER_MSG)]
+        )
+
+        with (
+            mock.patch.object(tasks.logger, "warning") as warning,
+            mock.patch.object(tasks.logger, "error") as error,
+        ):
+            tasks.add_user_groups([au.pk for au in allocation_users])
+
+        self.assertEqual([self.status(au) for au in allocation_users], ["Active", "Active"])
+        warning.assert_called()
+        error.assert_not_called()
+
+    def test_add_user_groups_failure_sets_error(self):
+        alice, bob = self.allocation_users(self.active)
+        self.command.group_add_member.side_effect = lambda g, user: ipa_response(
+            g, user, failed=[("bob", "no such entry")] if g == "grp_b" else []
+        )
+
+        with mock.patch.object(tasks.logger, "error") as error:
+            tasks.add_user_groups([alice.pk, bob.pk])
+
+        error.assert_called()
+        self.assertEqual(self.status(alice), "Active")
+        self.assertEqual(self.status(bob), "Error")
+
+    def test_add_user_groups_command_exception_sets_error_for_group(self):
+        allocation_users = self.allocation_users(self.active)
+        self.command.group_add_member.side_effect = Exception("connection refused")
+
+        with mock.patch.object(tasks.logger, "error") as error:
+            tasks.add_user_groups([au.pk for au in allocation_users])
+
+        error.assert_called()
+        self.assertEqual(self.command.group_add_member.call_count, 2)
+        self.assertEqual([self.status(au) for au in allocation_users], ["Error", "Error"])
+
+    def test_remove_user_groups_one_call_per_group(self):
+        allocation_users = self.allocation_users(self.removed)
+        self.command.group_remove_member.side_effect = lambda g, user: ipa_response(
+            g, user, failed=[("bob", NOT_MEMBER_MSG)]
+        )
+
+        with mock.patch.object(tasks.logger, "warning") as warning:
+            tasks.remove_user_groups([au.pk for au in allocation_users])
+
+        warning.assert_called()
+        self.assertEqual(
+            self.command.group_remove_member.call_args_list,
+            [mock.call("grp_a", user=["alice", "bob"]), mock.call("grp_b", user=["alice", "bob"])],
+        )
+        self.assertEqual([self.status(au) for au in allocation_users], ["Removed", "Removed"])
+
+    def test_remove_user_groups_keeps_groups_of_other_active_allocations(self):
+        allocation_users = self.allocation_users(self.removed)
+        other = AllocationFactory(status=self.allocation.status)
+        AllocationAttributeFactory(allocation=other, allocation_attribute_type=self.group_type, value="grp_b")
+        AllocationUserFactory(allocation=other, user=self.users[0], status=self.active)
+
+        tasks.remove_user_groups([au.pk for au in allocation_users])
+
+        self.assertEqual(
+            self.command.group_remove_member.call_args_list,
+            [mock.call("grp_a", user=["alice", "bob"]), mock.call("grp_b", user=["bob"])],
+        )
+
+    def test_remove_user_groups_ignores_inactive_other_allocations(self):
+        allocation_users = self.allocation_users(self.removed)
+        other = AllocationFactory(status=AllocationStatusChoiceFactory(name="Expired"))
+        AllocationAttributeFactory(allocation=other, allocation_attribute_type=self.group_type, value="grp_b")
+        AllocationUserFactory(allocation=other, user=self.users[0], status=self.active)
+
+        tasks.remove_user_groups([au.pk for au in allocation_users])
+
+        self.assertEqual(
+            self.command.group_remove_member.call_args_list,
+            [mock.call("grp_a", user=["alice", "bob"]), mock.call("grp_b", user=["alice", "bob"])],
+        )
@@ -0,0 +1,39 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Unit tests for the freeipa utils"""
+
+import unittest
+
+from django.test import SimpleTestCase
+
+from coldfront.config.env import ENV
+
+if not ENV.bool("PLUGIN_FREEIPA", default=False):
+    raise unittest.SkipTest("Only run FreeIPA tests if enabled")
+
+from coldfront.plugins.freeipa.utils import ALREADY_MEMBER_MSG, get_ipa_group_failures
+
+
+class GetIpaGroupFailuresTests(SimpleTestCase):
+    """tests for get_ipa_group_failures"""
+
+    def test_returns_failed_users(self):
+        res = {
+            "completed": 1,
+            "failed": {"member": {"user": [("alice", ALREADY_MEMBER_MSG), ("bob", "no such entry")]}},
+            "result": {"cn": ["grp_a"]},
+        }
+
+        self.assertEqual(get_ipa_group_failures(res), {"alice": ALREADY_MEMBER_MSG, "bob": "no such entry"})
+
+    def test_no_failures(self):
+        res = {"completed": 2, "failed": {"member": {"user": []}}, "result": {"cn": ["grp_a"]}}
+
+        self.assertEqual(get_ipa_group_failures(res), {})
+        self.assertEqual(get_ipa_group_failures({"completed": 2}), {})
+
+    def test_missing_response(self):
+        with self.assertRaises(ValueError):
+            get_ipa_group_failures(None)
@@ -13,6 +13,11 @@ from coldfront.core.utils.common import import_from_settings
 CLIENT_KTNAME = import_from_settings("FREEIPA_KTNAME")
 UNIX_GROUP_ATTRIBUTE_NAME = import_from_settings("FREEIPA_GROUP_ATTRIBUTE_NAME", "freeipa_group")
 FREEIPA_NOOP = import_from_settings("FREEIPA_NOOP", False)
+FREEIPA_CHECK_WORKERS = import_from_settings("FREEIPA_CHECK_WORKERS", 1)
+FREEIPA_BATCH_SIZE = import_from_settings("FREEIPA_BATCH_SIZE", 100)
+
+ALREADY_MEMBER_MSG = "This entry is already a member"
+NOT_MEMBER_MSG = "This entry is not a member"
 
 logger = logging.getLogger(__name__)
 
@@ -51,11 +56,34 @@ def check_ipa_group_error(res):
     err_msg = res["failed"]["member"]["user"][0][1]
 
     # Check if user is already a member
-    if err_msg == "This entry is already a member":
+    if err_msg == ALREADY_MEMBER_MSG:
         raise AlreadyMemberError(err_msg)
 
     # Check if user is not a member
-    if err_msg == "This entry is not a member":
+    if err_msg == NOT_MEMBER_MSG:
         raise NotMemberError(err_msg)
 
     raise ApiError(err_msg)
+
+
+def get_ipa_group_failures(res):
+    """Return a dict mapping username to error message for each user member
+    that failed in a group_add_member/group_remove_member response"""
+    if not res:
+        raise ValueError("Missing FreeIPA response")
+
+    return {username: err_msg for username, err_msg in res.get("failed", {}).get("member", {}).get("user", [])}
+
+
+def ipa_batch(method, args_list, batch_size=FREEIPA_BATCH_SIZE):
+    """Run the FreeIPA command method once for each tuple of arguments in
+    args_list, sending at most batch_size commands per batch call. Yields
+    (args, error) in order, error being None if the command succeeded"""
+    for i in range(0, len(args_list), batch_size):
+        chunk = args_list[i : i + batch_size]
+        res = api.Command.batch([{"method": method, "params": [list(args), {}]} for args in chunk])
+        if not res or "results" not in res:
+            raise ValueError("Missing FreeIPA response")
+
+        for args, result in zip(chunk, res["results"]):
+            yield args, result.get("error")
@@ -0,0 +1,34 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import logging
+
+from django.contrib.auth.models import User
+
+from coldfront.plugins.iquota.utils import refresh_quota_snapshots
+
+logger = logging.getLogger(__name__)
+
+
+def prewarm_quota_cache():
+    """Fetch the quotas of all active allocation users and their groups into
+    the quota snapshot cache"""
+    users = (
+        User.objects.filter(
+            is_active=True,
+            allocationuser__status__name="Active",
+            allocationuser__allocation__status__name="Active",
+        )
+        .distinct()
+        .prefetch_related("groups")
+    )
+
+    usernames = []
+    groups = set()
+    for user in users:
+        usernames.append(user.username)
+        groups.update(group.name for group in user.groups.all())
+
+    count = refresh_quota_snapshots(usernames, groups)
+    logger.info("Cached %s quota snapshots for %s users and %s groups", count, len(usernames), len(groups))
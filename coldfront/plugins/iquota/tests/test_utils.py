@@ -0,0 +1,194 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Unit tests for the iquota quota snapshots"""
+
+import io
+import unittest
+from datetime import timedelta
+from unittest import mock
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from django_q.models import Schedule
+
+from coldfront.config.env import ENV
+
+if not ENV.bool("PLUGIN_IQUOTA", default=False):
+    raise unittest.SkipTest("Only run iquota tests if enabled")
+
+from coldfront.plugins.iquota import utils
+from coldfront.plugins.iquota.utils import get_quota_snapshot, quota_cache_key, refresh_quota_snapshots
+
+
+class FakeIquota:
+    """Stand-in for Iquota recording the quotas requested from the API.
+    Quotas of names in failing cannot be fetched."""
+
+    IQUOTA_MAX_WORKERS = 2
+    failing = set()
+    requests = []
+
+    def __init__(self, username, groups):
+        self.username = username
+        self.groups = groups
+
+    def get_user_quota(self):
+        FakeIquota.requests.append(("user", self.username))
+        if self.username in self.failing:
+            return None
+        return {"path": f"/user/{self.username}", "username": self.username}
+
+    def get_group_quotas_by_group(self):
+        quotas = {}
+        for group in self.groups:
+            FakeIquota.requests.append(("group", group))
+            quotas[group] = None if group in self.failing else [{"path": f"/projects/{group}"}]
+        return quotas
+
+
+class QuotaSnapshotTestCase(SimpleTestCase):
+    def setUp(self):
+        self.cache = LocMemCache("iquota-tests", {})
+        self.cache.clear()
+        patchers = [
+            mock.patch.object(utils, "get_quota_cache", return_value=self.cache),
+            mock.patch.object(utils, "Iquota", FakeIquota),
+            mock.patch.object(FakeIquota, "failing", set()),
+            mock.patch.object(FakeIquota, "requests", []),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def requests(self):
+        requests, FakeIquota.requests[:] = list(FakeIquota.requests), []
+        return requests
+
+
+class GetQuotaSnapshotTests(QuotaSnapshotTestCase):
+    """tests for get_quota_snapshot"""
+
+    def test_snapshot_is_cached(self):
+        first = get_quota_snapshot("alice", ["grp_a", "grp_b"])
+        self.assertEqual(self.requests(), [("user", "alice"), ("group", "grp_a"), ("group", "grp_b")])
+
+        second = get_quota_snapshot("alice", ["grp_a", "grp_b"])
+
+        self.assertEqual(self.requests(), [])
+        self.assertEqual(second, first)
+        self.assertEqual(second["user_quota"], {"path": "/user/alice", "username": "alice"})
+        self.assertEqual(list(second["group_quotas"]), ["/projects/grp_a", "/projects/grp_b"])
+
+    def test_only_missing_quotas_are_fetched(self):
+        get_quota_snapshot("alice", ["grp_a"])
+        self.requests()
+
+        snapshot = get_quota_snapshot("bob", ["grp_a", "grp_b"])
+
+        self.assertEqual(self.requests(), [("user", "bob"), ("group", "grp_b")])
+        self.assertEqual(list(snapshot["group_quotas"]), ["/projects/grp_a", "/projects/grp_b"])
+
+    def test_refresh_fetches_everything(self):
+        first = get_quota_snapshot("alice", ["grp_a"])
+        self.requests()
+
+        with mock.patch.object(utils.timezone, "now", return_value=first["updated"] + timedelta(minutes=5)):
+            snapshot = get_quota_snapshot("alice", ["grp_a"], refresh=True)
+
+        self.assertEqual(self.requests(), [("user", "alice"), ("group", "grp_a")])
+        self.assertGreater(snapshot["updated"], first["updated"])
+
+    def test_failed_requests_are_not_cached(self):
+        FakeIquota.failing = {"alice", "grp_b"}
+
+        snapshot = get_quota_snapshot("alice", ["grp_a", "grp_b"])
+
+        self.assertIsNone(snapshot["user_quota"])
+        self.assertEqual(list(snapshot["group_quotas"]), ["/projects/grp_a"])
+
+        FakeIquota.failing = set()
+        self.requests()
+        snapshot = get_quota_snapshot("alice", ["grp_a", "grp_b"])
+
+        self.assertEqual(self.requests(), [("user", "alice"), ("group", "grp_b")])
+        self.assertEqual(list(snapshot["group_quotas"]), ["/projects/grp_a", "/projects/grp_b"])
+
+    def test_names_with_spaces(self):
+        get_quota_snapshot("alice", ["grp a", "grp_a"])
+        get_quota_snapshot("alice", ["grp a", "grp_a"])
+
+        self.assertEqual(self.requests(), [("user", "alice"), ("group", "grp a"), ("group", "grp_a")])
+        self.assertNotIn(" ", quota_cache_key("group", "grp a"))
+        self.assertNotEqual(quota_cache_key("group", "grp a"), quota_cache_key("group", "grp_a"))
+
+    def test_no_groups(self):
+        snapshot = get_quota_snapshot("alice", [])
+
+        self.assertIsNone(snapshot["group_quotas"])
+        self.assertEqual(self.requests(), [("user", "alice")])
+
+
+class RefreshQuotaSnapshotsTests(QuotaSnapshotTestCase):
+    """tests for refresh_quota_snapshots"""
+
+    def test_refreshed_snapshots_are_served_from_cache(self):
+        self.assertEqual(refresh_quota_snapshots(["alice", "bob"], {"grp_b", "grp_a"}), 4)
+        self.assertEqual(
+            sorted(self.requests()), [("group", "grp_a"), ("group", "grp_b"), ("user", "alice"), ("user", "bob")]
+        )
+
+        get_quota_snapshot("alice", ["grp_a"])
+        get_quota_snapshot("bob", ["grp_a", "grp_b"])
+
+        self.assertEqual(self.requests(), [])
+
+    def test_failed_requests_are_not_cached(self):
+        FakeIquota.failing = {"bob", "grp_b"}
+
+        self.assertEqual(refresh_quota_snapshots(["alice", "bob"], {"grp_a", "grp_b"}), 2)
+
+        self.requests()
+        FakeIquota.failing = set()
+        get_quota_snapshot("bob", ["grp_a", "grp_b"])
+        self.assertEqual(self.requests(), [("user", "bob"), ("group", "grp_b")])
+
+    def test_cache_disabled(self):
+        with mock.patch.object(utils, "get_quota_cache", return_value=None):
+            self.assertEqual(refresh_quota_snapshots(["alice"], {"grp_a"}), 0)
+
+        self.assertEqual(self.requests(), [])
+
+
+class ScheduledTasksTests(TestCase):
+    """tests for scheduling the quota cache prewarm task"""
+
+    FUNC = "coldfront.plugins.iquota.tasks.prewarm_quota_cache"
+
+    def setUp(self):
+        self.stderr = io.StringIO()
+
+    def add_scheduled_tasks(self, cache):
+        with (
+            mock.patch("coldfront.core.utils.management.commands.add_scheduled_tasks.IQUOTA_CACHE_PREWARM_MINUTES", 10),
+            mock.patch("coldfront.core.utils.management.commands.add_scheduled_tasks.caches", {"default": cache}),
+        ):
+            call_command("add_scheduled_tasks", stderr=self.stderr)
+
+    def test_prewarm_task_is_scheduled_once(self):
+        cache = mock.Mock()
+        self.add_scheduled_tasks(cache)
+        self.add_scheduled_tasks(cache)
+
+        schedules = Schedule.objects.filter(func=self.FUNC)
+        self.assertEqual(schedules.count(), 1)
+        self.assertEqual(schedules.get().minutes, 10)
+        self.assertEqual(self.stderr.getvalue(), "")
+
+    def test_not_scheduled_with_local_memory_cache(self):
+        self.add_scheduled_tasks(LocMemCache("iquota-tests", {}))
+
+        self.assertFalse(Schedule.objects.filter(func=self.FUNC).exists())
+        self.assertIn("IQUOTA_CACHE", self.stderr.getvalue())
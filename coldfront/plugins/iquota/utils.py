@@ -2,14 +2,42 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import hashlib
+import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import humanize
 import kerberos
 import requests
+from django.core.cache import caches
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
 
 from coldfront.core.utils.common import import_from_settings
-from coldfront.plugins.iquota.exceptions import KerberosError, MissingQuotaError
+from coldfront.plugins.iquota.exceptions import IquotaError, KerberosError, MissingQuotaError
+
+IQUOTA_CACHE = import_from_settings("IQUOTA_CACHE", "default")
+IQUOTA_CACHE_TIMEOUT = import_from_settings("IQUOTA_CACHE_TIMEOUT", 900)
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(pool_size):
+    """Return the requests.Session shared by all requests to the iquota API so
+    connections are reused between requests"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+            _session.mount("https://", adapter)
+
+    return _session
 
 
 class Iquota:
@@ -19,6 +47,8 @@ class Iquota:
         self.IQUOTA_API_PORT = import_from_settings("IQUOTA_API_PORT")
         self.IQUOTA_CA_CERT = import_from_settings("IQUOTA_CA_CERT")
         self.IQUOTA_KEYTAB = import_from_settings("IQUOTA_KEYTAB")
+        self.IQUOTA_TIMEOUT = import_from_settings("IQUOTA_TIMEOUT", 10)
+        self.IQUOTA_MAX_WORKERS = import_from_settings("IQUOTA_MAX_WORKERS", 8)
         self.username = username
         self.groups = groups
 
@@ -34,6 +64,14 @@ class Iquota:
         except kerberos.GSSError:
             raise KerberosError("error initializing GSS client")
 
+    def _get(self, url):
+        """GET url from the iquota API over the shared session. Each request
+        gets a new GSS token, as the API's replay cache rejects a token that
+        is used twice."""
+        headers = {"Authorization": "Negotiate " + self.gssclient_token()}
+        session = get_session(self.IQUOTA_MAX_WORKERS)
+        return session.get(url, headers=headers, verify=self.IQUOTA_CA_CERT, timeout=self.IQUOTA_TIMEOUT)
+
     def _humanize_user_quota(self, path, user_used, user_limit):
         user_quota = {
             "path": path,
@@ -46,15 +84,15 @@ class Iquota:
         return user_quota
 
     def get_user_quota(self):
-        token = self.gssclient_token()
-
-        headers = {"Authorization": "Negotiate " + token}
+        """Return the quota of the user, or None if it could not be fetched"""
         url = "https://{}:{}/quota?user={}".format(self.IQUOTA_API_HOST, self.IQUOTA_API_PORT, self.username)
 
-        r = requests.get(url, headers=headers, verify=self.IQUOTA_CA_CERT)
-
         try:
+            r = self._get(url)
             usage = r.json()[0]
+        except requests.exceptions.RequestException as e:
+            logger.warning("Failed to fetch quota for user %s: %s", self.username, e)
+            return None
         except KeyError:
             raise MissingQuotaError("Missing user quota for username: %s" % (self.username))
         else:
@@ -73,13 +111,13 @@ class Iquota:
         return group_quota
 
     def _get_group_quota(self, group):
-        token = self.gssclient_token()
-
-        headers = {"Authorization": "Negotiate " + token}
-
         url = "https://{}:{}/quota?group={}".format(self.IQUOTA_API_HOST, self.IQUOTA_API_PORT, group)
 
-        r = requests.get(url, headers=headers, verify=self.IQUOTA_CA_CERT)
+        try:
+            r = self._get(url)
+        except requests.exceptions.RequestException as e:
+            logger.warning("Failed to fetch quota for group %s: %s", group, e)
+            return None
 
         try:
             usage = r.json()
@@ -99,14 +137,123 @@ class Iquota:
 
         return quotas
 
+    def get_group_quotas_by_group(self):
+        """Return a dict mapping each group to its list of quotas, or to None
+        if its quota could not be fetched"""
+        if not self.groups:
+            return {}
+
+        workers = min(len(self.groups), self.IQUOTA_MAX_WORKERS)
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(self._get_group_quota, self.groups))
+        else:
+            results = [self._get_group_quota(group) for group in self.groups]
+
+        return dict(zip(self.groups, results))
+
     def get_group_quotas(self):
         if not self.groups:
             return None
 
         group_quotas = {}
-        for group in self.groups:
-            group_quota = self._get_group_quota(group)
-            for g in group_quota:
+        for group_quota in self.get_group_quotas_by_group().values():
+            for g in group_quota or []:
                 group_quotas[g["path"]] = g
 
         return group_quotas
+
+
+def get_quota_cache():
+    """Return the cache quota snapshots are kept in, or None if caching is
+    disabled"""
+    if not IQUOTA_CACHE or not IQUOTA_CACHE_TIMEOUT:
+        return None
+
+    return caches[IQUOTA_CACHE]
+
+
+def quota_cache_key(kind, name):
+    """Return the cache key of the quota of a user or group. The name is
+    hashed, as memcached does not allow spaces or control characters in keys."""
+    return "coldfront.iquota.{}.{}".format(kind, hashlib.sha256(name.encode()).hexdigest())
+
+
+def get_quota_snapshot(username, groups, refresh=False):
+    """Return the quotas of a user and their groups as a dict with the
+    user_quota, the group_quotas keyed by path and when they were last
+    updated. Quotas are served from the cache, where each user and group is
+    kept for IQUOTA_CACHE_TIMEOUT seconds, and only the ones not cached (or
+    all of them if refresh is True) are fetched from the iquota API."""
+    cache = get_quota_cache()
+    iquota = Iquota(username, groups)
+    now = timezone.now()
+    if cache is None:
+        return {"user_quota": iquota.get_user_quota(), "group_quotas": iquota.get_group_quotas(), "updated": now}
+
+    user_key = quota_cache_key("user", username)
+    group_keys = {quota_cache_key("group", group): group for group in groups}
+    cached = {} if refresh else cache.get_many([user_key, *group_keys])
+
+    if user_key not in cached:
+        cached[user_key] = (iquota.get_user_quota(), now)
+        # A failed request is not cached so it is retried next time
+        if cached[user_key][0] is not None:
+            cache.set(user_key, cached[user_key], IQUOTA_CACHE_TIMEOUT)
+
+    missing = [group for key, group in group_keys.items() if key not in cached]
+    if missing:
+        fetched = {}
+        for group, quotas in Iquota(username, missing).get_group_quotas_by_group().items():
+            snapshot = (quotas or [], now)
+            cached[quota_cache_key("group", group)] = snapshot
+            # Failed requests are not cached so they are retried next time
+            if quotas is not None:
+                fetched[quota_cache_key("group", group)] = snapshot
+
+        cache.set_many(fetched, IQUOTA_CACHE_TIMEOUT)
+
+    group_quotas = None
+    if groups:
+        group_quotas = {}
+        for key in group_keys:
+            for g in cached[key][0]:
+                group_quotas[g["path"]] = g
+
+    return {
+        "user_quota": cached[user_key][0],
+        "group_quotas": group_quotas,
+        "updated": min(snapshot[1] for snapshot in cached.values()),
+    }
+
+
+def refresh_quota_snapshots(usernames, groups):
+    """Fetch the quotas of usernames and groups from the iquota API and
+    store them in the cache. Returns the number of snapshots stored."""
+    cache = get_quota_cache()
+    if cache is None:
+        return 0
+
+    now = timezone.now()
+    snapshots = {}
+
+    def fetch_user_quota(username):
+        try:
+            return Iquota(username, []).get_user_quota()
+        except IquotaError as e:
+            logger.warning("Failed to fetch quota for user %s: %s", username, getattr(e, "message", e))
+            return None
+
+    usernames = list(usernames)
+    iquota = Iquota(None, sorted(groups))
+    with ThreadPoolExecutor(max_workers=max(1, iquota.IQUOTA_MAX_WORKERS)) as executor:
+        for username, quota in zip(usernames, executor.map(fetch_user_quota, usernames)):
+            if quota is not None:
+                snapshots[quota_cache_key("user", username)] = (quota, now)
+
+    for group, quotas in iquota.get_group_quotas_by_group().items():
+        if quotas is not None:
+            snapshots[quota_cache_key("group", group)] = (quotas, now)
+
+    cache.set_many(snapshots, IQUOTA_CACHE_TIMEOUT)
+    return len(snapshots)
@@ -5,7 +5,7 @@
 from django.http import HttpResponse
 from django.shortcuts import render
 
-from coldfront.plugins.iquota.utils import Iquota
+from coldfront.plugins.iquota.utils import get_quota_snapshot
 
 
 def get_isilon_quota(request):
@@ -15,11 +15,6 @@ def get_isilon_quota(request):
     username = request.user.username
     groups = [group.name for group in request.user.groups.all()]
 
-    iquota = Iquota(username, groups)
-
-    context = {
-        "user_quota": iquota.get_user_quota(),
-        "group_quotas": iquota.get_group_quotas(),
-    }
+    context = get_quota_snapshot(username, groups, refresh=bool(request.POST.get("refresh")))
 
     return render(request, "iquota/iquota.html", context)
@@ -2,4 +2,212 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-# Create your tests here.
+import json
+import unittest
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from coldfront.config.env import ENV
+
+if not ENV.bool("PLUGIN_LDAP_USER_SEARCH", default=False):
+    raise unittest.SkipTest("Only run LDAP user search tests if enabled")
+
+from ldap3.core.exceptions import LDAPSocketReceiveError
+
+from coldfront.plugins.ldap_user_search import utils
+from coldfront.plugins.ldap_user_search.utils import LDAPUserSearch
+
+
+def ldap_entry(username, last_name="", first_name="", email=""):
+    """Return a mocked ldap3 Entry for a user"""
+    attributes = {"uid": [username], "sn": [last_name], "givenName": [first_name], "mail": [email]}
+    entry = mock.Mock()
+    entry.entry_to_json.return_value = json.dumps({"dn": f"uid={username}", "attributes": attributes})
+    return entry
+
+
+class MockConnection:
+    """Stand-in for a bound ldap3.Connection returning the entries of the
+    users in directory whose uid appears in the search filter"""
+
+    def __init__(self, directory, *args, **kwargs):
+        self.directory = directory
+        self.closed = False
+        self.bound = True
+        self.entries = []
+        self.searches = []
+        self.search_error = None
+        self.unbind = mock.Mock()
+
+    def search(self, search_base, search_filter, attributes=None, size_limit=0):
+        self.searches.append({"search_filter": search_filter, "size_limit": size_limit})
+        if self.search_error:
+            raise self.search_error
+        self.entries = [
+            ldap_entry(username, *values)
+            for username, values in self.directory.items()
+            if f"={username.lower()})" in search_filter.lower()
+        ]
+
+
+class LDAPUserSearchTestCase(SimpleTestCase):
+    directory = {}
+
+    def setUp(self):
+        self.connections = []
+
+        def connection(*args, **kwargs):
+            conn = MockConnection(self.directory, *args, **kwargs)
+            self.connections.append(conn)
+            return conn
+
+        patcher = mock.patch.object(utils, "Connection", side_effect=connection)
+        self.connection = patcher.start()
+        self.addCleanup(patcher.stop)
+        # each test gets its own connection pools
+        self.addCleanup(utils._pools.clear)
+        utils._pools.clear()
+
+    def searches(self):
+        return [search for conn in self.connections for search in conn.searches]
+
+
+class LDAPConnectionPoolTests(LDAPUserSearchTestCase):
+    directory = {"alice": ("Smith", "Alice", "alice@example.com")}
+
+    def test_searches_reuse_pooled_connection(self):
+        for _ in range(3):
+            users = LDAPUserSearch("alice", "username_only").search_a_user("alice", "username_only")
+            self.assertEqual([user["username"] for user in users], ["alice"])
+
+        self.assertEqual(self.connection.call_count, 1)
+        self.assertEqual(len(self.searches()), 3)
+
+    def test_searches_share_pool_per_settings(self):
+        first = LDAPUserSearch("alice", "username_only")
+        second = LDAPUserSearch("bob", "username_only")
+
+        self.assertIs(first.pool, second.pool)
+
+    def test_unbound_connection_is_replaced(self):
+        search = LDAPUserSearch("alice", "username_only")
+        search.search_a_user("alice", "username_only")
+        self.connections[0].bound = False
+
+        search.search_a_user("alice", "username_only")
+
+        self.assertEqual(self.connection.call_count, 2)
+        self.connections[0].unbind.assert_called_once_with()
+
+    def test_idle_connection_is_replaced(self):
+        search = LDAPUserSearch("alice", "username_only")
+        with mock.patch.object(utils.time, "monotonic", return_value=1000):
+            search.search_a_user("alice", "username_only")
+        with mock.patch.object(utils.time, "monotonic", return_value=1000 + search.pool.idle_timeout):
+            search.search_a_user("alice", "username_only")
+
+        self.assertEqual(self.connection.call_count, 2)
+        self.connections[0].unbind.assert_called_once_with()
+
+    def test_connections_are_not_reused_after_fork(self):
+        search = LDAPUserSearch("alice", "username_only")
+        search.search_a_user("alice", "username_only")
+
+        with mock.patch.object(utils.os, "getpid", return_value=search.pool._pid + 1):
+            search.search_a_user("alice", "username_only")
+
+        self.assertEqual(self.connection.call_count, 2)
+        # the parent's socket is left alone rather than unbound in the child
+        self.connections[0].unbind.assert_not_called()
+
+    def test_search_is_retried_once_on_lost_connection(self):
+        search = LDAPUserSearch("alice", "username_only")
+        search.search_a_user("alice", "username_only")
+        self.connections[0].search_error = LDAPSocketReceiveError("connection reset")
+
+        with self.assertLogs(utils.logger, "INFO"):
+            users = search.search_a_user("alice", "username_only")
+
+        self.assertEqual([user["username"] for user in users], ["alice"])
+        self.assertEqual(self.connection.call_count, 2)
+        self.connections[0].unbind.assert_called_once_with()
+
+    def test_search_fails_after_second_lost_connection(self):
+        search = LDAPUserSearch("alice", "username_only")
+        self.connection.side_effect = None
+        conn = MockConnection(self.directory)
+        conn.search_error = LDAPSocketReceiveError("connection reset")
+        self.connection.return_value = conn
+
+        with self.assertLogs(utils.logger, "INFO"), self.assertRaises(LDAPSocketReceiveError):
+            search.search_a_user("alice", "username_only")
+
+        self.assertEqual(len(conn.searches), 2)
+        self.assertEqual(search.pool._idle, [])
+
+    def test_other_errors_are_not_retried(self):
+        search = LDAPUserSearch("alice", "username_only")
+        search.search_a_user("alice", "username_only")
+        self.connections[0].search_error = ValueError("bad filter")
+
+        with self.assertRaises(ValueError):
+            search.search_a_user("alice", "username_only")
+
+        self.assertEqual(self.connection.call_count, 1)
+
+
+class SearchManyTests(LDAPUserSearchTestCase):
+    directory = {
+        "alice": ("Smith", "Alice", "alice@example.com"),
+        "bob": ("Jones", "Bob", "bob@example.com"),
+        "carol": ("White", "Carol", "carol@example.com"),
+        **{f"user{i:03}": ("User", str(i), "") for i in range(250)},
+    }
+
+    def search_many(self, usernames):
+        return LDAPUserSearch("", "username_only").search_many(usernames)
+
+    def test_usernames_are_searched_in_chunks(self):
+        usernames = [f"user{i:03}" for i in range(250)]
+
+        users = self.search_many(usernames)
+
+        self.assertEqual([user["username"] for user in users], usernames)
+        searches = self.searches()
+        self.assertEqual([search["size_limit"] for search in searches], [100, 100, 50])
+        self.assertTrue(searches[0]["search_filter"].startswith("(|(uid=user000)(uid=user001)"))
+        self.assertTrue(searches[2]["search_filter"].endswith("(uid=user249))"))
+        self.assertEqual(self.connection.call_count, 1)
+
+    def test_results_follow_requested_order(self):
+        users = self.search_many(["carol", "missing", "alice", "bob"])
+
+        self.assertEqual([user["username"] for user in users], ["carol", "alice", "bob"])
+        self.assertEqual(
+            users[0],
+            {
+                "username": "carol",
+                "last_name": "White",
+                "first_name": "Carol",
+                "email": "carol@example.com",
+                "source": "LDAP",
+            },
+        )
+
+    def test_usernames_match_case_insensitively(self):
+        users = self.search_many(["ALICE", "bob"])
+
+        self.assertEqual([user["username"] for user in users], ["alice", "bob"])
+
+    def test_filter_values_are_escaped(self):
+        self.assertEqual(self.search_many(["*", "a)(uid=*"]), [])
+
+        self.assertEqual(
+            self.searches()[0]["search_filter"],
+            r"(|(uid=\2a)(uid=a\29\28uid=\2a))",
+        )
+
+    def test_no_usernames(self):
+        self.assertEqual(self.search_many([]), [])
+        self.assertEqual(self.searches(), [])
@@ -4,10 +4,14 @@
 
 import json
 import logging
+import os
 import ssl
+import threading
+import time
 
 import ldap.filter
 from ldap3 import AUTO_BIND_TLS_BEFORE_BIND, SASL, Connection, Server, Tls, get_config_parameter, set_config_parameter
+from ldap3.core.exceptions import LDAPCommunicationError, LDAPSessionTerminatedByServerError, LDAPSocketReceiveError
 
 from coldfront.core.user.utils import UserSearch
 from coldfront.core.utils.common import import_from_settings
@@ -15,6 +19,107 @@ from coldfront.core.utils.common import import_from_settings
 logger = logging.getLogger(__name__)
 
 
+LDAP_USER_SEARCH_POOL_SIZE = import_from_settings("LDAP_USER_SEARCH_POOL_SIZE", 4)
+LDAP_USER_SEARCH_POOL_IDLE_TIMEOUT = import_from_settings("LDAP_USER_SEARCH_POOL_IDLE_TIMEOUT", 300)
+
+# Max number of usernames looked up in a single LDAP filter by search_many
+SEARCH_MANY_CHUNK_SIZE = 100
+
+# Errors after which a pooled connection is dropped and the search retried
+# once on a new connection
+RECONNECT_ERRORS = (LDAPCommunicationError, LDAPSessionTerminatedByServerError, LDAPSocketReceiveError)
+
+
+class LDAPConnectionPool:
+    """Thread-safe pool of bound connections to an LDAP server, opened with
+    connect(server), so each search does not pay for a new connection, TLS
+    handshake and bind.
+
+    Connections are handed out to one thread at a time. Connections that have
+    been idle for longer than idle_timeout seconds, or are no longer bound,
+    are closed and replaced by a new connection. At most size idle connections
+    are kept."""
+
+    def __init__(self, server, connect, size=4, idle_timeout=300):
+        self.server = server
+        self.connect = connect
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+
+    def discard(self, conn):
+        """Close a connection that should not be returned to the pool"""
+        try:
+            conn.unbind()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """Return a bound connection from the pool, or a new one"""
+        while True:
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Sockets inherited from the parent process must not be used
+                    self._idle = []
+                    self._pid = os.getpid()
+                if not self._idle:
+                    break
+                conn, last_used = self._idle.pop()
+
+            if not conn.closed and conn.bound and time.monotonic() - last_used < self.idle_timeout:
+                return conn
+
+            self.discard(conn)
+
+        return self.connect(self.server)
+
+    def release(self, conn):
+        """Return a connection to the pool"""
+        if conn.closed or not conn.bound:
+            self.discard(conn)
+            return
+
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic()))
+                return
+
+        self.discard(conn)
+
+    def close(self):
+        """Unbind all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for conn, _ in idle:
+            self.discard(conn)
+
+
+# Connection pools shared by all LDAPUserSearch instances in the process,
+# keyed by the connection settings
+_pools = {}
+_pools_lock = threading.Lock()
+
+# LDAP attributes already added to ATTRIBUTES_EXCLUDED_FROM_CHECK
+_excluded_attributes = set()
+
+
+def exclude_attributes_from_check(ldap_attrs):
+    """Add LDAP attributes to the global ldap3 ATTRIBUTES_EXCLUDED_FROM_CHECK
+    setting, once per process"""
+    with _pools_lock:
+        new_attrs = [attr for attr in ldap_attrs if attr not in _excluded_attributes]
+        if not new_attrs:
+            return
+
+        attrs = get_config_parameter("ATTRIBUTES_EXCLUDED_FROM_CHECK")
+        attrs.extend(new_attrs)
+        set_config_parameter("ATTRIBUTES_EXCLUDED_FROM_CHECK", attrs)
+        _excluded_attributes.update(new_attrs)
+
+
 class LDAPUserSearch(UserSearch):
     search_source = "LDAP"
 
@@ -45,6 +150,40 @@ class LDAPUserSearch(UserSearch):
         )
         self.MAPPING_CALLBACK = import_from_settings("LDAP_USER_SEARCH_MAPPING_CALLBACK", self.parse_ldap_entry)
 
+        self.pool = self.get_pool()
+        self.server = self.pool.server
+        exclude_attributes_from_check(self.ATTRIBUTE_MAP.values())
+
+    def get_pool(self):
+        """Return the process wide connection pool for the connection
+        settings of this search, creating it on first use"""
+        key = (
+            self.LDAP_SERVER_URI,
+            self.LDAP_BIND_DN,
+            self.LDAP_BIND_PASSWORD,
+            self.LDAP_CONNECT_TIMEOUT,
+            self.LDAP_USE_SSL,
+            self.LDAP_USE_TLS,
+            self.LDAP_SASL_MECHANISM,
+            self.LDAP_SASL_CREDENTIALS,
+            self.LDAP_PRIV_KEY_FILE,
+            self.LDAP_CERT_FILE,
+            self.LDAP_CACERT_FILE,
+            self.LDAP_CERT_VALIDATE_MODE,
+        )
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = LDAPConnectionPool(
+                    self.get_server(),
+                    self.get_connection,
+                    size=LDAP_USER_SEARCH_POOL_SIZE,
+                    idle_timeout=LDAP_USER_SEARCH_POOL_IDLE_TIMEOUT,
+                )
+
+        return pool
+
+    def get_server(self):
         tls = None
         if self.LDAP_USE_TLS:
             ldap_cert_validate_mode = ssl.CERT_NONE
@@ -60,9 +199,11 @@ class LDAPUserSearch(UserSearch):
                 validate=ldap_cert_validate_mode,
             )
 
-        self.server = Server(
+        return Server(
             self.LDAP_SERVER_URI, use_ssl=self.LDAP_USE_SSL, connect_timeout=self.LDAP_CONNECT_TIMEOUT, tls=tls
         )
+
+    def get_connection(self, server):
         auto_bind = True
         if self.LDAP_USE_TLS:
             auto_bind = AUTO_BIND_TLS_BEFORE_BIND
@@ -71,7 +212,28 @@ class LDAPUserSearch(UserSearch):
             conn_params["sasl_mechanism"] = self.LDAP_SASL_MECHANISM
             conn_params["sasl_credentials"] = self.LDAP_SASL_CREDENTIALS
             conn_params["authentication"] = SASL
-        self.conn = Connection(self.server, self.LDAP_BIND_DN, self.LDAP_BIND_PASSWORD, **conn_params)
+        return Connection(server, self.LDAP_BIND_DN, self.LDAP_BIND_PASSWORD, **conn_params)
+
+    def ldap_search(self, **search_parameters):
+        """Run a search on a pooled connection and return the entries. If the
+        connection turns out to be broken it is replaced and the search is
+        retried once."""
+        for attempt in range(2):
+            conn = self.pool.acquire()
+            try:
+                conn.search(**search_parameters)
+                entries = conn.entries
+            except RECONNECT_ERRORS as e:
+                self.pool.discard(conn)
+                if attempt:
+                    raise
+                logger.info("LDAP connection lost, reconnecting: %s", e)
+            except Exception:
+                self.pool.discard(conn)
+                raise
+            else:
+                self.pool.release(conn)
+                return entries
 
     @staticmethod
     def parse_ldap_entry(attribute_map, entry_dict):
@@ -83,9 +245,6 @@ class LDAPUserSearch(UserSearch):
     def search_a_user(self, user_search_string=None, search_by="all_fields"):
         size_limit = 50
         ldap_attrs = list(self.ATTRIBUTE_MAP.values())
-        attrs = get_config_parameter("ATTRIBUTES_EXCLUDED_FROM_CHECK")
-        attrs.extend(ldap_attrs)
-        set_config_parameter("ATTRIBUTES_EXCLUDED_FROM_CHECK", attrs)
         if user_search_string and search_by == "all_fields":
             filter = ldap.filter.filter_format(
                 f"(|({ldap_attrs[0]}=*%s*)({ldap_attrs[1]}=*%s*)({ldap_attrs[2]}=*%s*)({ldap_attrs[3]}=*%s*))",
@@ -108,9 +267,9 @@ class LDAPUserSearch(UserSearch):
             "size_limit": size_limit,
         }
         logger.debug(f"search params: {searchParameters}")
-        self.conn.search(**searchParameters)
+        entries = self.ldap_search(**searchParameters)
         users = []
-        for idx, entry in enumerate(self.conn.entries, 1):
+        for idx, entry in enumerate(entries, 1):
             entry_dict = json.loads(entry.entry_to_json()).get("attributes")
             logger.debug(f"Entry dict: {entry_dict}")
             user_dict = self.MAPPING_CALLBACK(self.ATTRIBUTE_MAP, entry_dict)
@@ -118,3 +277,41 @@ class LDAPUserSearch(UserSearch):
             users.append(user_dict)
         logger.info("LDAP user search for %s found %s results", user_search_string, len(users))
         return users
+
+    def search_many(self, usernames):
+        """Look up usernames with one (|(uid=a)(uid=b)...) filter per chunk of
+        SEARCH_MANY_CHUNK_SIZE usernames rather than one search per username"""
+        ldap_attrs = list(self.ATTRIBUTE_MAP.values())
+        attr = self.ATTRIBUTE_MAP[self.USERNAME_ONLY_ATTR]
+
+        found = {}
+        for i in range(0, len(usernames), SEARCH_MANY_CHUNK_SIZE):
+            chunk = usernames[i : i + SEARCH_MANY_CHUNK_SIZE]
+            filter = "(|{})".format("".join(ldap.filter.filter_format(f"({attr}=%s)", [name]) for name in chunk))
+            searchParameters = {
+                "search_base": self.LDAP_USER_SEARCH_BASE,
+                "search_filter": filter,
+                "attributes": ldap_attrs,
+                "size_limit": len(chunk),
+            }
+            logger.debug(f"search params: {searchParameters}")
+            for entry in self.ldap_search(**searchParameters):
+                entry_dict = json.loads(entry.entry_to_json()).get("attributes")
+                logger.debug(f"Entry dict: {entry_dict}")
+                values = entry_dict.get(attr)
+                if not values:
+                    continue
+                # LDAP matches are case insensitive, keep one entry per username
+                found.setdefault(str(values[0]).lower(), entry_dict)
+
+        users = []
+        for username in usernames:
+            entry_dict = found.get(username.lower())
+            if entry_dict is None:
+                continue
+            user_dict = self.MAPPING_CALLBACK(self.ATTRIBUTE_MAP, entry_dict)
+            user_dict["source"] = self.search_source
+            users.append(user_dict)
+
+        logger.info("LDAP user search for %s usernames found %s results", len(usernames), len(users))
+        return users
@@ -130,6 +130,8 @@ class Command(BaseCommand):
             "PROJECT_OPENLDAP_PRIV_KEY_FILE": None,
             "PROJECT_OPENLDAP_CERT_FILE": None,
             "PROJECT_OPENLDAP_CACERT_FILE": None,
+            "PROJECT_OPENLDAP_POOL_SIZE": 4,
+            "PROJECT_OPENLDAP_POOL_CHECK_INTERVAL": 60,
         }
 
         # Check required vars
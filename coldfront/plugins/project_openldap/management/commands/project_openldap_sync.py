@@ -16,6 +16,7 @@ from coldfront.core.project.models import (
 )
 
 # OpenLDAP (ldap3) connections formed in utils.py
+from coldfront.core.utils.choices import get_choice_pk
 from coldfront.core.utils.common import import_from_settings
 
 # NEW or ACTIVE status projects not known to OpenLDAP at all can simply be added as normal, using tasks.py function
@@ -38,7 +39,9 @@ from coldfront.plugins.project_openldap.utils import (
     ldapsearch_check_project_dn,
     ldapsearch_get_description,
     ldapsearch_get_posixgroup_memberuids,
+    ldapsearch_get_posixgroups,
     move_dn_in_openldap,
+    normalize_dn,
     remove_members_from_openldap_posixgroup,
     update_posixgroup_description_in_openldap,
 )
@@ -56,13 +59,6 @@ PROJECT_OPENLDAP_EXCLUDE_USERS = import_from_settings("PROJECT_OPENLDAP_EXCLUDE_
 
 logger = logging.getLogger(__name__)
 
-# affirm project status choices
-PROJECT_STATUS_CHOICE_NEW = ProjectStatusChoice.objects.get(name="New").pk
-PROJECT_STATUS_CHOICE_ACTIVE = ProjectStatusChoice.objects.get(name="Active").pk
-PROJECT_STATUS_CHOICE_ARCHIVED = ProjectStatusChoice.objects.get(name="Archived").pk
-# affirm project user status choices
-PROJECTUSER_STATUS_CHOICE_ACTIVE = ProjectUserStatusChoice.objects.get(name="Active").pk
-
 # where project_dn var is used -> posixgroup DN
 # where archive_dn var is used -> posixgroup DN in archive
 # where DN var is used, can be any DN
@@ -73,6 +69,10 @@ PROJECTUSER_STATUS_CHOICE_ACTIVE = ProjectUserStatusChoice.objects.get(name="Act
 class Command(BaseCommand):
     help = "Sync projects and memberUids in OpenLDAP (from Coldfront)"
 
+    # set by --bulk, snapshot of OpenLDAP posixGroups by DN and Coldfront members by project pk
+    openldap_posixgroups = None
+    cf_members_by_project = None
+
     def add_arguments(self, parser):
         parser.add_argument(
             "-a",
@@ -110,6 +110,19 @@ class Command(BaseCommand):
             help="Skip projects with New or Active status in Coldfront",
             action="store_true",
         )
+        parser.add_argument(
+            "-b",
+            "--bulk",
+            help="With --all, load all OpenLDAP posixGroups and Coldfront project members up front instead of searching per project",
+            action="store_true",
+        )
+
+    # affirm project and project user status choices, looked up once per process
+    def local_load_status_choices(self):
+        self.project_status_new = get_choice_pk(ProjectStatusChoice, "New")
+        self.project_status_active = get_choice_pk(ProjectStatusChoice, "Active")
+        self.project_status_archived = get_choice_pk(ProjectStatusChoice, "Archived")
+        self.projectuser_status_active = get_choice_pk(ProjectUserStatusChoice, "Active")
 
     def local_get_project_by_code(self, project_group):
         try:
@@ -123,6 +136,11 @@ class Command(BaseCommand):
         if sync:
             # simply add the project using tasks.py function
             add_project(project)
+            self.local_update_bulk(
+                construct_dn_str(project),
+                add_members=(project.pi.username,),
+                description=construct_project_posixgroup_description(project),
+            )
         # else notify, need to write with sync
         else:
             self.stdout.write(
@@ -177,6 +195,7 @@ class Command(BaseCommand):
                     archive_gid,
                     write=True,
                 )
+                self.local_update_bulk(archive_posixgroup_dn, description=archive_openldap_posixgroup_description)
             except Exception as e:
                 self.stdout.write(f"Exception adding {archive_posixgroup_dn} to OpenLDAP: {e}")
 
@@ -202,6 +221,7 @@ class Command(BaseCommand):
             try:
                 relative_dn = construct_per_project_ou_relative_dn_str(project)
                 move_dn_in_openldap(project_ou_dn, relative_dn, PROJECT_OPENLDAP_ARCHIVE_OU, write=True)
+                self.local_move_bulk(construct_dn_str(project), archive_dn)
                 self.stdout.write(
                     f"Moving project to archive OU, DN: {archive_dn} in OpenLDAP - SYNC is {sync} - WRITING TO Openldap"
                 )
@@ -212,8 +232,8 @@ class Command(BaseCommand):
 
     def handle_project_removal_if_needed(self, project, project_ou_dn, sync=False):
         if project.status_id not in [
-            PROJECT_STATUS_CHOICE_NEW,
-            PROJECT_STATUS_CHOICE_ACTIVE,
+            self.project_status_new,
+            self.project_status_active,
         ]:
             # archive OU not defined, so remove this project
             if PROJECT_OPENLDAP_REMOVE_PROJECT and not PROJECT_OPENLDAP_ARCHIVE_OU:
@@ -225,6 +245,7 @@ class Command(BaseCommand):
                 if sync:
                     try:
                         remove_project(project)
+                        self.local_move_bulk(construct_dn_str(project), None)
                         self.stdout.write(
                             f"Removed inactive project {project.project_code} from OpenLDAP - SYNC is {sync}"
                         )
@@ -244,16 +265,17 @@ class Command(BaseCommand):
         new_description = construct_project_posixgroup_description(project)  # supply project_obj
 
         if project.status_id in [
-            PROJECT_STATUS_CHOICE_NEW,
-            PROJECT_STATUS_CHOICE_ACTIVE,
+            self.project_status_new,
+            self.project_status_active,
         ]:
             # fetch current description from project_dn
-            fetched_description = ldapsearch_get_description(project_dn)
+            fetched_description = self.local_get_openldap_description(project_dn)
             if new_description == fetched_description:
                 self.stdout.write("Description is up-to-date.")
             if new_description != fetched_description:
                 if sync:
                     update_posixgroup_description_in_openldap(project_dn, new_description, write=True)
+                    self.local_update_bulk(project_dn, description=new_description)
                     self.stdout.write(f"{new_description}")
                 else:
                     # line up description output
@@ -261,9 +283,9 @@ class Command(BaseCommand):
                     self.stdout.write(f"NEW openldap_description will be {new_description}")
                     self.stdout.write("SYNC required to update OpenLDAP description")
 
-        if project.status_id in [PROJECT_STATUS_CHOICE_ARCHIVED]:
+        if project.status_id in [self.project_status_archived]:
             # fetch current description from archive DN
-            fetched_description = ldapsearch_get_description(archive_dn)
+            fetched_description = self.local_get_openldap_description(archive_dn)
             if new_description == fetched_description:
                 self.stdout.write("Description is up-to-date.")
             if new_description != fetched_description:
@@ -279,17 +301,80 @@ class Command(BaseCommand):
                     )
                 if sync and write_to_archive:
                     update_posixgroup_description_in_openldap(archive_dn, new_description, write=True)
+                    self.local_update_bulk(archive_dn, description=new_description)
                     self.stdout.write(f"{new_description}")
 
+    # load the OpenLDAP posixGroups in the project and archive OUs and the active members of projects in one go
+    def local_load_bulk(self, projects):
+        self.openldap_posixgroups = {}
+        for ou in [PROJECT_OPENLDAP_OU, PROJECT_OPENLDAP_ARCHIVE_OU]:
+            if not ou:
+                continue
+            posixgroups = ldapsearch_get_posixgroups(ou)
+            if posixgroups is None:
+                self.stdout.write(f"ERROR: Could not load posixGroups from OpenLDAP OU {ou} - HALTING")
+                raise CommandError
+            self.openldap_posixgroups.update(posixgroups)
+
+        self.cf_members_by_project = {}
+        queryset = ProjectUser.objects.filter(
+            project__in=projects, status_id=self.projectuser_status_active
+        ).values_list("project_id", "user__username")
+        for project_pk, username in queryset:
+            if username not in PROJECT_OPENLDAP_EXCLUDE_USERS:
+                self.cf_members_by_project.setdefault(project_pk, []).append(username)
+
+        self.stdout.write(
+            f"Loaded {len(self.openldap_posixgroups)} OpenLDAP posixGroups and members of {len(self.cf_members_by_project)} Coldfront projects"
+        )
+
+    # keep the --bulk snapshot in line with a posixGroup moved in this run, e.g. to the archive OU, or removed if new_dn is None
+    def local_move_bulk(self, dn, new_dn):
+        if self.openldap_posixgroups is None:
+            return
+        posixgroup = self.openldap_posixgroups.pop(normalize_dn(dn), None)
+        if posixgroup is not None and new_dn is not None:
+            self.openldap_posixgroups[normalize_dn(new_dn)] = posixgroup
+
+    # keep the --bulk snapshot in line with the members or description of a posixGroup written in this run
+    def local_update_bulk(self, dn, add_members=(), remove_members=(), description=None):
+        if self.openldap_posixgroups is None:
+            return
+        members, old_description = self.openldap_posixgroups.get(normalize_dn(dn), ((), None))
+        members = [m for m in members if m not in remove_members]
+        members += [m for m in add_members if m not in members]
+        self.openldap_posixgroups[normalize_dn(dn)] = (
+            tuple(members),
+            description if description is not None else old_description,
+        )
+
+    def local_check_project_dn(self, dn):
+        if self.openldap_posixgroups is not None:
+            return normalize_dn(dn) in self.openldap_posixgroups
+        return ldapsearch_check_project_dn(dn)
+
+    def local_get_openldap_description(self, dn):
+        if self.openldap_posixgroups is not None:
+            posixgroup = self.openldap_posixgroups.get(normalize_dn(dn))
+            return posixgroup[1] if posixgroup else None
+        return ldapsearch_get_description(dn)
+
     # get active users from the coldfront django project
     def local_get_cf_django_members(self, project_pk):
-        queryset = ProjectUser.objects.filter(project_id=project_pk, status_id=PROJECTUSER_STATUS_CHOICE_ACTIVE)
+        if self.cf_members_by_project is not None:
+            return tuple(self.cf_members_by_project.get(project_pk, ()))
+
+        queryset = ProjectUser.objects.filter(project_id=project_pk, status_id=self.projectuser_status_active)
         usernames = [
             user.user.username for user in queryset if user.user.username not in PROJECT_OPENLDAP_EXCLUDE_USERS
         ]
         return tuple(usernames)
 
     def local_get_openldap_members(self, dn):
+        if self.openldap_posixgroups is not None:
+            posixgroup = self.openldap_posixgroups.get(normalize_dn(dn))
+            return posixgroup[0] if posixgroup else ()
+
         entries = ldapsearch_get_posixgroup_memberuids(dn)
 
         if entries is None:
@@ -350,6 +435,7 @@ class Command(BaseCommand):
                 if ldapsearch_project_result:
                     try:
                         remove_members_from_openldap_posixgroup(member_change_dn, missing_in_cf, write=True)
+                        self.local_update_bulk(member_change_dn, remove_members=missing_in_cf)
                         self.stdout.write(f"SYNC {sync} - Removed members {missing_in_cf}")
                     except Exception as e:
                         self.stdout.write(
@@ -363,6 +449,7 @@ class Command(BaseCommand):
                     elif write_to_archive:
                         try:
                             remove_members_from_openldap_posixgroup(member_change_dn, missing_in_cf, write=True)
+                            self.local_update_bulk(member_change_dn, remove_members=missing_in_cf)
                             self.stdout.write(f"SYNC {sync} - Removed members {missing_in_cf}")
                         except Exception as e:
                             self.stdout.write(
@@ -379,6 +466,7 @@ class Command(BaseCommand):
                 if ldapsearch_project_result:
                     try:
                         add_members_to_openldap_posixgroup(member_change_dn, missing_in_openldap, write=True)
+                        self.local_update_bulk(member_change_dn, add_members=missing_in_openldap)
                         self.stdout.write(f"SYNC {sync} - Added members {missing_in_openldap}")
                     except Exception as e:
                         self.stdout.write(
@@ -392,6 +480,7 @@ class Command(BaseCommand):
                     elif write_to_archive:
                         try:
                             add_members_to_openldap_posixgroup(member_change_dn, missing_in_openldap, write=True)
+                            self.local_update_bulk(member_change_dn, add_members=missing_in_openldap)
                             self.stdout.write(f"SYNC {sync} - Added members {missing_in_openldap}")
                         except Exception as e:
                             self.stdout.write(
@@ -407,14 +496,16 @@ class Command(BaseCommand):
         update_description=False,
         skip_archived=False,
         skip_newactive=False,
+        project=None,
     ):
         # 1) do some setup and checks
-        project = self.local_get_project_by_code(project_group)
+        if project is None:
+            project = self.local_get_project_by_code(project_group)
         if not project:
             return
 
         # skip archived projects if option supplied
-        if skip_archived and project.status_id in [PROJECT_STATUS_CHOICE_ARCHIVED]:
+        if skip_archived and project.status_id in [self.project_status_archived]:
             self.stdout.write("--------------------")
             self.stdout.write(
                 f"Requested skip_archived, not processing archived project status for Project {project.project_code}"
@@ -424,8 +515,8 @@ class Command(BaseCommand):
 
         # skip archived projects if option supplied
         if skip_newactive and project.status_id in [
-            PROJECT_STATUS_CHOICE_NEW,
-            PROJECT_STATUS_CHOICE_ACTIVE,
+            self.project_status_new,
+            self.project_status_active,
         ]:
             self.stdout.write("--------------------")
             self.stdout.write(
@@ -449,22 +540,22 @@ class Command(BaseCommand):
         self.stdout.write("")
 
         # does project exist in project OU
-        ldapsearch_project_result = ldapsearch_check_project_dn(project_dn)
+        ldapsearch_project_result = self.local_check_project_dn(project_dn)
         self.stdout.write(f"search project OU result: {ldapsearch_project_result}")
         # does project exist in archive OU
         if PROJECT_OPENLDAP_ARCHIVE_OU:
-            ldapsearch_project_result_archive = ldapsearch_check_project_dn(project_archive_dn)
+            ldapsearch_project_result_archive = self.local_check_project_dn(project_archive_dn)
             self.stdout.write(f"search project archive OU result: {ldapsearch_project_result_archive}")
         else:
             self.stdout.write("search project archive OU result: N/A - PROJECT_OPENLDAP_ARCHIVE_OU is not set")
-            if project.status_id in [PROJECT_STATUS_CHOICE_ARCHIVED]:
+            if project.status_id in [self.project_status_archived]:
                 self.stdout.write("NOTE: This project has Coldfront status_id of Archived")
         # 1) --- END ---
 
         # 2) determine if the project needs added, moved or removed - ARCHIVAL
         # Use coldfront project object status id to determine what to do next... ARCHIVAL case
         # Project archived in Coldfront django
-        if project.status_id in [PROJECT_STATUS_CHOICE_ARCHIVED]:
+        if project.status_id in [self.project_status_archived]:
             # archive OU is setup to archive projects
             if PROJECT_OPENLDAP_ARCHIVE_OU and PROJECT_OPENLDAP_REMOVE_PROJECT:
                 # project is in project OU not archive OU - DNs supplied - apart from relative, generated in function
@@ -499,8 +590,8 @@ class Command(BaseCommand):
         # Use coldfront project object status id to determine what to do next... NEW or ACTIVE case
         # Project is new or active status in Coldfront django
         elif project.status_id in [
-            PROJECT_STATUS_CHOICE_NEW,
-            PROJECT_STATUS_CHOICE_ACTIVE,
+            self.project_status_new,
+            self.project_status_active,
         ]:
             if not ldapsearch_project_result:
                 self.handle_missing_project_in_openldap_new_active(project, sync)
@@ -584,19 +675,27 @@ class Command(BaseCommand):
         update_description=False,
         skip_archived=False,
         skip_newactive=False,
+        bulk=False,
     ):
-        projects = Project.objects.filter(
-            status_id__in=[
-                PROJECT_STATUS_CHOICE_NEW,
-                PROJECT_STATUS_CHOICE_ACTIVE,
-                PROJECT_STATUS_CHOICE_ARCHIVED,
-            ]
-        ).order_by("id")
+        projects = (
+            Project.objects.filter(
+                status_id__in=[
+                    self.project_status_new,
+                    self.project_status_active,
+                    self.project_status_archived,
+                ]
+            )
+            .select_related("pi")
+            .order_by("id")
+        )
 
         if len(projects) == 0:
             self.stdout.write("No projects found by loop_all_projects - EXITING")
             return
 
+        if bulk:
+            self.local_load_bulk(projects)
+
         for project in projects:
             if hasattr(project, "project_code") and project.project_code:
                 project_code = project.project_code
@@ -607,6 +706,7 @@ class Command(BaseCommand):
                     update_description,
                     skip_archived,
                     skip_newactive,
+                    project=project,
                 )
             else:
                 # won't continue to process so self.stdout.write seperator here
@@ -630,6 +730,8 @@ class Command(BaseCommand):
         else:
             root_logger.setLevel(logging.WARNING)
 
+        self.local_load_status_choices()
+
         self.sync = False
         if options["sync"]:
             self.sync = True
@@ -671,6 +773,14 @@ class Command(BaseCommand):
                 self.skip_newactive,
             )
 
+        self.bulk = False
+        if options["bulk"]:
+            if self.all:
+                self.bulk = True
+                logger.info("Loading all OpenLDAP posixGroups and Coldfront project members up front")
+            else:
+                logger.warning("--bulk is only used with --all")
+
         if self.all:
             self.loop_all_projects(
                 self.sync,
@@ -678,6 +788,7 @@ class Command(BaseCommand):
                 self.update_description,
                 self.skip_archived,
                 self.skip_newactive,
+                self.bulk,
             )
 
         if not self.filter_group and not self.all:
@@ -0,0 +1,128 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import unittest
+from io import StringIO
+from unittest import mock
+
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from coldfront.config.env import ENV
+
+if not ENV.bool("PLUGIN_PROJECT_OPENLDAP", default=False):
+    raise unittest.SkipTest("Only run project OpenLDAP tests if enabled")
+
+from coldfront.core.project.models import Project
+from coldfront.core.test_helpers.factories import (
+    ProjectFactory,
+    ProjectStatusChoiceFactory,
+    ProjectUserFactory,
+    ProjectUserStatusChoiceFactory,
+    UserFactory,
+)
+from coldfront.core.utils.choices import choice_registry
+from coldfront.plugins.project_openldap import utils
+from coldfront.plugins.project_openldap.management.commands import project_openldap_sync
+from coldfront.plugins.project_openldap.management.commands.project_openldap_sync import Command
+
+PROJECT_OU = "ou=projects,dc=example"
+ARCHIVE_OU = "ou=archive,dc=example"
+
+
+class ProjectOpenLDAPSyncBulkTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        ProjectStatusChoiceFactory(name="New")
+        cls.active = ProjectStatusChoiceFactory(name="Active")
+        cls.archived = ProjectStatusChoiceFactory(name="Archived")
+        user_active = ProjectUserStatusChoiceFactory(name="Active")
+        user_removed = ProjectUserStatusChoiceFactory(name="Removed")
+
+        cls.project = ProjectFactory(project_code="PROJ1", status=cls.active, pi=UserFactory(username="pi1"))
+        for username in ["jane", "john", "coldfront"]:
+            ProjectUserFactory(project=cls.project, user=UserFactory(username=username), status=user_active)
+        ProjectUserFactory(project=cls.project, user=UserFactory(username="gone"), status=user_removed)
+
+    def setUp(self):
+        patchers = [
+            mock.patch.object(project_openldap_sync, "PROJECT_OPENLDAP_OU", PROJECT_OU),
+            mock.patch.object(project_openldap_sync, "PROJECT_OPENLDAP_ARCHIVE_OU", ARCHIVE_OU),
+            mock.patch.object(project_openldap_sync, "PROJECT_OPENLDAP_REMOVE_PROJECT", True),
+            mock.patch.object(utils, "PROJECT_OPENLDAP_OU", PROJECT_OU),
+            mock.patch.object(utils, "PROJECT_OPENLDAP_ARCHIVE_OU", ARCHIVE_OU),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # choices cached by earlier tests may have been rolled back
+        choice_registry.clear()
+        self.command = Command(stdout=StringIO())
+        self.command.local_load_status_choices()
+        self.project_dn = f"cn=PROJ1,ou=PROJ1,{PROJECT_OU}"
+        self.archive_dn = f"cn=PROJ1,ou=PROJ1,{ARCHIVE_OU}"
+
+    def load_bulk(self, posixgroups):
+        def get_posixgroups(ou):
+            return {dn: group for dn, group in posixgroups.items() if dn.endswith(ou)}
+
+        with mock.patch.object(project_openldap_sync, "ldapsearch_get_posixgroups", side_effect=get_posixgroups):
+            self.command.local_load_bulk(Project.objects.all())
+
+    def test_load_bulk(self):
+        self.load_bulk(
+            {
+                utils.normalize_dn(self.project_dn): (("jane",), "PI: pi1"),
+                f"cn=proj2,ou=proj2,{ARCHIVE_OU}": ((), None),
+            }
+        )
+
+        self.assertTrue(self.command.local_check_project_dn(self.project_dn))
+        self.assertTrue(self.command.local_check_project_dn(f"cn=PROJ2,ou=PROJ2,{ARCHIVE_OU}"))
+        self.assertFalse(self.command.local_check_project_dn(self.archive_dn))
+        self.assertEqual(self.command.local_get_openldap_members(self.project_dn), ("jane",))
+        self.assertEqual(self.command.local_get_openldap_description(self.project_dn), "PI: pi1")
+        # removed and excluded users are left out
+        self.assertEqual(sorted(self.command.local_get_cf_django_members(self.project.pk)), ["jane", "john"])
+
+    def test_load_bulk_failure(self):
+        with (
+            mock.patch.object(project_openldap_sync, "ldapsearch_get_posixgroups", return_value=None),
+            self.assertRaises(CommandError),
+        ):
+            self.command.local_load_bulk(Project.objects.all())
+
+    @mock.patch.object(project_openldap_sync, "remove_members_from_openldap_posixgroup")
+    @mock.patch.object(project_openldap_sync, "add_members_to_openldap_posixgroup")
+    def test_member_changes_update_snapshot(self, add_members, remove_members):
+        self.load_bulk({utils.normalize_dn(self.project_dn): (("jane", "old"), "PI: pi1")})
+
+        self.command.sync_check_project("PROJ1", sync=True, project=self.project)
+
+        add_members.assert_called_once_with(self.project_dn, ("john",), write=True)
+        remove_members.assert_called_once_with(self.project_dn, ("old",), write=True)
+        self.assertEqual(self.command.local_get_openldap_members(self.project_dn), ("jane", "john"))
+
+    @mock.patch.object(project_openldap_sync, "remove_members_from_openldap_posixgroup")
+    @mock.patch.object(project_openldap_sync, "add_members_to_openldap_posixgroup")
+    @mock.patch.object(project_openldap_sync, "move_dn_in_openldap")
+    def test_move_to_archive_updates_snapshot(self, move_dn, add_members, remove_members):
+        self.project.status = self.archived
+        self.project.save()
+        self.load_bulk({utils.normalize_dn(self.project_dn): (("jane", "john"), "PI: pi1")})
+
+        self.command.sync_check_project("PROJ1", sync=True, write_to_archive=True, project=self.project)
+
+        move_dn.assert_called_once_with(f"ou=PROJ1,{PROJECT_OU}", "ou=PROJ1", ARCHIVE_OU, write=True)
+        self.assertFalse(self.command.local_check_project_dn(self.project_dn))
+        self.assertTrue(self.command.local_check_project_dn(self.archive_dn))
+
+        # checking the project again finds its members in the archive OU
+        self.command.sync_check_project("PROJ1", sync=True, write_to_archive=True, project=self.project)
+
+        move_dn.assert_called_once()
+        add_members.assert_not_called()
+        remove_members.assert_not_called()
+        self.assertEqual(self.command.local_get_openldap_members(self.archive_dn), ("jane", "john"))
@@ -0,0 +1,254 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import unittest
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from coldfront.config.env import ENV
+
+if not ENV.bool("PLUGIN_PROJECT_OPENLDAP", default=False):
+    raise unittest.SkipTest("Only run project OpenLDAP tests if enabled")
+
+from ldap3.core.exceptions import LDAPSocketReceiveError
+
+from coldfront.plugins.project_openldap import utils
+from coldfront.plugins.project_openldap.utils import OpenLDAPConnectionPool
+
+
+def mock_connection():
+    """Return a mocked bound ldap3.Connection"""
+    conn = mock.Mock(closed=False, bound=True)
+    return conn
+
+
+class OpenLDAPConnectionPoolTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(utils, "Connection", side_effect=lambda *args, **kwargs: mock_connection())
+        self.connection = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = OpenLDAPConnectionPool("server", "user", "password", size=2, check_interval=60)
+
+    def test_acquire_release_reuses_connection(self):
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+
+        self.assertIs(self.pool.acquire(), conn)
+        self.assertEqual(self.connection.call_count, 1)
+        self.connection.assert_called_once_with("server", "user", "password", auto_bind=True)
+
+    def test_acquire_opens_new_connection_when_all_in_use(self):
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+
+        self.assertIsNot(first, second)
+        self.assertEqual(self.connection.call_count, 2)
+
+    def test_acquire_returns_none_when_bind_fails(self):
+        self.connection.side_effect = Exception("bind failed")
+
+        with mock.patch.object(utils.logger, "error") as error:
+            self.assertIsNone(self.pool.acquire())
+        error.assert_called_once()
+
+    def test_release_keeps_at_most_size_connections(self):
+        conns = [self.pool.acquire() for _ in range(3)]
+        for conn in conns:
+            self.pool.release(conn)
+
+        self.assertEqual(len(self.pool._idle), 2)
+        conns[2].unbind.assert_called_once_with()
+
+    def test_release_discards_unbound_connection(self):
+        conn = self.pool.acquire()
+        conn.bound = False
+        self.pool.release(conn)
+
+        self.assertEqual(self.pool._idle, [])
+        conn.unbind.assert_called_once_with()
+
+    def test_recently_used_connection_is_not_checked(self):
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+
+        self.assertIs(self.pool.acquire(), conn)
+        conn.extend.standard.who_am_i.assert_not_called()
+
+    def test_idle_connection_is_checked_with_who_am_i(self):
+        conn = self.pool.acquire()
+        with mock.patch.object(utils.time, "monotonic", return_value=1000):
+            self.pool.release(conn)
+        with mock.patch.object(utils.time, "monotonic", return_value=1061):
+            self.assertIs(self.pool.acquire(), conn)
+
+        conn.extend.standard.who_am_i.assert_called_once_with()
+        self.assertEqual(self.connection.call_count, 1)
+
+    def test_idle_connection_failing_who_am_i_is_replaced(self):
+        conn = self.pool.acquire()
+        conn.extend.standard.who_am_i.side_effect = LDAPSocketReceiveError("connection reset")
+        with mock.patch.object(utils.time, "monotonic", return_value=1000):
+            self.pool.release(conn)
+        with mock.patch.object(utils.time, "monotonic", return_value=1061):
+            new_conn = self.pool.acquire()
+
+        self.assertIsNot(new_conn, conn)
+        conn.unbind.assert_called_once_with()
+        self.assertEqual(self.connection.call_count, 2)
+
+    def test_connections_are_discarded_after_fork(self):
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+
+        with mock.patch.object(utils.os, "getpid", return_value=self.pool._pid + 1):
+            new_conn = self.pool.acquire()
+            self.assertIsNot(new_conn, conn)
+            self.pool.release(new_conn)
+            self.assertEqual(self.pool._idle[0][0], new_conn)
+
+        # the parent's socket is left alone rather than unbound in the child
+        conn.unbind.assert_not_called()
+        self.assertEqual(len(self.pool._idle), 1)
+
+    def test_run_releases_connection(self):
+        result = self.pool.run(lambda conn: conn.search("dn", "(objectclass=posixGroup)"))
+
+        conn = self.pool._idle[0][0]
+        self.assertEqual(result, conn.search.return_value)
+
+    def test_run_retries_once_on_dead_connection(self):
+        dead = self.pool.acquire()
+        self.pool.release(dead)
+        dead.delete.side_effect = LDAPSocketReceiveError("connection reset")
+
+        with mock.patch.object(utils.logger, "info") as info:
+            result = self.pool.run(lambda conn: conn.delete("dn"))
+        info.assert_called_once()
+
+        dead.unbind.assert_called_once_with()
+        self.assertEqual(self.connection.call_count, 2)
+        new_conn = self.pool._idle[0][0]
+        self.assertIsNot(new_conn, dead)
+        self.assertEqual(result, new_conn.delete.return_value)
+
+    def test_run_raises_after_second_dead_connection(self):
+        self.connection.side_effect = None
+        conn = mock_connection()
+        conn.delete.side_effect = LDAPSocketReceiveError("connection reset")
+        self.connection.return_value = conn
+
+        with self.assertRaises(LDAPSocketReceiveError):
+            self.pool.run(lambda conn: conn.delete("dn"))
+
+        self.assertEqual(conn.delete.call_count, 2)
+        self.assertEqual(self.pool._idle, [])
+
+    def test_run_does_not_retry_other_errors(self):
+        operation = mock.Mock(side_effect=IndexError)
+
+        with self.assertRaises(IndexError):
+            self.pool.run(operation)
+
+        operation.assert_called_once()
+        self.assertEqual(len(self.pool._idle), 1)
+
+    def test_run_returns_none_without_connection(self):
+        self.connection.side_effect = Exception("bind failed")
+        operation = mock.Mock()
+
+        with mock.patch.object(utils.logger, "error") as error:
+            self.assertIsNone(self.pool.run(operation))
+        error.assert_called_once()
+        operation.assert_not_called()
+
+
+class OpenLDAPOperationsTests(SimpleTestCase):
+    def setUp(self):
+        self.conn = mock_connection()
+        patcher = mock.patch.object(utils.openldap_pool, "run", side_effect=lambda operation: operation(self.conn))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_normalize_dn(self):
+        self.assertEqual(
+            utils.normalize_dn("CN=Proj1, ou = Proj1,OU=Projects,dc=Example"),
+            "cn=proj1,ou=proj1,ou=projects,dc=example",
+        )
+
+    def test_get_posixgroups(self):
+        self.conn.extend.standard.paged_search.return_value = iter(
+            [
+                {
+                    "type": "searchResEntry",
+                    "dn": "cn=PROJ1,ou=PROJ1,ou=projects,dc=example",
+                    "attributes": {"memberUid": ["jane", "john"], "description": ["PI: jane"]},
+                },
+                {"type": "searchResEntry", "dn": "cn=proj2,ou=proj2,ou=projects,dc=example", "attributes": {}},
+                {"type": "searchResRef", "uri": ["ldap://other"]},
+            ]
+        )
+
+        posixgroups = utils.ldapsearch_get_posixgroups("ou=projects,dc=example")
+
+        self.assertEqual(
+            posixgroups,
+            {
+                "cn=proj1,ou=proj1,ou=projects,dc=example": (("jane", "john"), "PI: jane"),
+                "cn=proj2,ou=proj2,ou=projects,dc=example": ((), None),
+            },
+        )
+        self.assertEqual(self.conn.extend.standard.paged_search.call_args.args[0], "ou=projects,dc=example")
+
+    def test_get_posixgroups_failure(self):
+        self.conn.extend.standard.paged_search.side_effect = Exception("search failed")
+
+        with mock.patch.object(utils.logger, "info"):
+            self.assertIsNone(utils.ldapsearch_get_posixgroups("ou=projects,dc=example"))
+
+    def test_add_members_in_single_modify(self):
+        self.conn.modify.return_value = True
+
+        utils.add_members_to_openldap_posixgroup("cn=proj1", ["jane", "john"])
+
+        self.conn.modify.assert_called_once_with("cn=proj1", {"memberUid": [(utils.MODIFY_ADD, ["jane", "john"])]})
+
+    def test_add_members_falls_back_to_one_at_a_time(self):
+        self.conn.modify.side_effect = [False, True, False]
+
+        utils.add_members_to_openldap_posixgroup("cn=proj1", ["jane", "john"])
+
+        self.assertEqual(
+            self.conn.modify.call_args_list[1:],
+            [
+                mock.call("cn=proj1", {"memberUid": [(utils.MODIFY_ADD, ["jane"])]}),
+                mock.call("cn=proj1", {"memberUid": [(utils.MODIFY_ADD, ["john"])]}),
+            ],
+        )
+
+    def test_remove_members_in_single_modify(self):
+        self.conn.modify.return_value = True
+
+        utils.remove_members_from_openldap_posixgroup("cn=proj1", ["jane", "john"])
+
+        self.conn.modify.assert_called_once_with("cn=proj1", {"memberUid": [(utils.MODIFY_DELETE, ["jane", "john"])]})
+
+    def test_remove_members_falls_back_to_one_at_a_time(self):
+        self.conn.modify.side_effect = [False, True, True]
+
+        utils.remove_members_from_openldap_posixgroup("cn=proj1", ["jane", "john"])
+
+        self.assertEqual(
+            self.conn.modify.call_args_list[1:],
+            [
+                mock.call("cn=proj1", {"memberUid": [(utils.MODIFY_DELETE, ["jane"])]}),
+                mock.call("cn=proj1", {"memberUid": [(utils.MODIFY_DELETE, ["john"])]}),
+            ],
+        )
+
+    def test_no_members_no_modify(self):
+        utils.add_members_to_openldap_posixgroup("cn=proj1", [])
+        utils.remove_members_from_openldap_posixgroup("cn=proj1", ["jane"], write=False)
+
+        self.conn.modify.assert_not_called()
@@ -5,9 +5,13 @@
 """Coldfront project_openldap plugin utils.py"""
 
 import logging
+import os
 import textwrap
+import threading
+import time
 
-from ldap3 import MODIFY_ADD, MODIFY_DELETE, MODIFY_REPLACE, Connection, Server, Tls
+from ldap3 import MODIFY_ADD, MODIFY_DELETE, MODIFY_REPLACE, SUBTREE, Connection, Server, Tls
+from ldap3.core.exceptions import LDAPCommunicationError, LDAPSessionTerminatedByServerError, LDAPSocketReceiveError
 
 from coldfront.core.utils.common import import_from_settings
 
@@ -27,6 +31,10 @@ PROJECT_OPENLDAP_ARCHIVE_OU = import_from_settings("PROJECT_OPENLDAP_ARCHIVE_OU"
 
 PROJECT_OPENLDAP_DESCRIPTION_TITLE_LENGTH = import_from_settings("PROJECT_OPENLDAP_DESCRIPTION_TITLE_LENGTH")
 
+PROJECT_OPENLDAP_POOL_SIZE = import_from_settings("PROJECT_OPENLDAP_POOL_SIZE", 4)
+PROJECT_OPENLDAP_POOL_CHECK_INTERVAL = import_from_settings("PROJECT_OPENLDAP_POOL_CHECK_INTERVAL", 60)
+PROJECT_OPENLDAP_PAGE_SIZE = import_from_settings("PROJECT_OPENLDAP_PAGE_SIZE", 500)
+
 # provide a sensible default locally to stop the openldap description being too long
 MAX_OPENLDAP_DESCRIPTION_LENGTH = 250
 
@@ -49,6 +57,9 @@ server = Server(
 )
 logger = logging.getLogger(__name__)
 
+# errors raised by an operation on a connection that has gone away
+RECONNECT_ERRORS = (LDAPCommunicationError, LDAPSessionTerminatedByServerError, LDAPSocketReceiveError)
+
 
 def openldap_connection(server_opt, bind_user, bind_password):
     """Open connection to OpenLDAP"""
@@ -60,55 +71,166 @@ def openldap_connection(server_opt, bind_user, bind_password):
         return None
 
 
+class OpenLDAPConnectionPool:
+    """Thread-safe pool of bound connections to OpenLDAP, so each operation
+    does not pay for a new connection and bind.
+
+    Connections are handed out to one thread at a time. Connections that have
+    been idle for longer than check_interval seconds are checked with a WhoAmI
+    request before use, and connections that are closed or fail the check are
+    replaced by a new connection. At most size idle connections are kept."""
+
+    def __init__(self, server_opt, bind_user, bind_password, size=4, check_interval=60):
+        self.server = server_opt
+        self.bind_user = bind_user
+        self.bind_password = bind_password
+        self.size = size
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+
+    def _healthy(self, conn, last_used):
+        if conn.closed or not conn.bound:
+            return False
+
+        if time.monotonic() - last_used < self.check_interval:
+            return True
+
+        try:
+            conn.extend.standard.who_am_i()
+        except Exception as e:
+            logger.info("Pooled OpenLDAP connection failed health check: %s", e)
+            return False
+
+        return not conn.closed
+
+    def _discard(self, conn):
+        try:
+            conn.unbind()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """Return a healthy bound connection from the pool, or a new one.
+        Returns None if a new connection could not be opened."""
+        while True:
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Sockets inherited from the parent process must not be used
+                    self._idle = []
+                    self._pid = os.getpid()
+                if not self._idle:
+                    break
+                conn, last_used = self._idle.pop()
+
+            if self._healthy(conn, last_used):
+                return conn
+
+            self._discard(conn)
+
+        return openldap_connection(self.server, self.bind_user, self.bind_password)
+
+    def release(self, conn):
+        """Return a connection to the pool"""
+        if conn.closed or not conn.bound:
+            self._discard(conn)
+            return
+
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic()))
+                return
+
+        self._discard(conn)
+
+    def run(self, operation):
+        """Call operation with a pooled connection and return its result, or
+        None if no connection could be opened. If the connection turns out to
+        be dead the operation is retried once on a new connection."""
+        for attempt in range(2):
+            conn = self.acquire()
+            if conn is None:
+                return None
+
+            try:
+                result = operation(conn)
+            except RECONNECT_ERRORS as e:
+                self._discard(conn)
+                if attempt:
+                    raise
+                logger.info("OpenLDAP connection lost, reconnecting: %s", e)
+            except Exception:
+                self.release(conn)
+                raise
+            else:
+                self.release(conn)
+                return result
+
+    def close(self):
+        """Unbind all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+openldap_pool = OpenLDAPConnectionPool(
+    server,
+    PROJECT_OPENLDAP_BIND_USER,
+    PROJECT_OPENLDAP_BIND_PASSWORD,
+    size=PROJECT_OPENLDAP_POOL_SIZE,
+    check_interval=PROJECT_OPENLDAP_POOL_CHECK_INTERVAL,
+)
+
+
 def add_members_to_openldap_posixgroup(dn, list_memberuids, write=True):
     """Add members to a posixgroup in OpenLDAP"""
     member_uid = tuple(list_memberuids)
-    conn = openldap_connection(server, PROJECT_OPENLDAP_BIND_USER, PROJECT_OPENLDAP_BIND_PASSWORD)
-
-    if not conn:
-        return
-
-    if not write:
+    if not write or not member_uid:
         return None
 
-    try:
+    def add_members(conn):
+        # add all members in one modify, falling back to one at a time
+        # so members that can be added still are if one of them fails
+        if conn.modify(dn, {"memberUid": [(MODIFY_ADD, list(member_uid))]}):
+            return
+
         for user in member_uid:
             add_username = user
             conn.modify(dn, {"memberUid": [(MODIFY_ADD, [add_username])]})
+
+    try:
+        openldap_pool.run(add_members)
     except Exception as exc_log:
         logger.info(exc_log)
-    finally:
-        conn.unbind()
 
 
 def remove_members_from_openldap_posixgroup(dn, list_memberuids, write=True):
     """Remove members from a posixgroup in OpenLDAP"""
     member_uids_tuple = tuple(list_memberuids)
-    conn = openldap_connection(server, PROJECT_OPENLDAP_BIND_USER, PROJECT_OPENLDAP_BIND_PASSWORD)
-
-    if not conn:
-        return
-
-    if not write:
+    if not write or not member_uids_tuple:
         return None
 
-    try:
+    def remove_members(conn):
+        # remove all members in one modify, falling back to one at a time
+        # so members that can be removed still are if one of them fails
+        if conn.modify(dn, {"memberUid": [(MODIFY_DELETE, list(member_uids_tuple))]}):
+            return
+
         for user in member_uids_tuple:
             remove_username = user
             conn.modify(dn, {"memberUid": [(MODIFY_DELETE, [remove_username])]})
+
+    try:
+        openldap_pool.run(remove_members)
     except Exception as exc_log:
         logger.info(exc_log)
-    finally:
-        conn.unbind()
 
 
 def add_per_project_ou_to_openldap(project_obj, dn, openldap_ou_description, write=True):
     """Add a per project OU to OpenLDAP - write an OU for a project"""
-    conn = openldap_connection(server, PROJECT_OPENLDAP_BIND_USER, PROJECT_OPENLDAP_BIND_PASSWORD)
-
-    if not conn:
-        return
-
     if not write:
         return None
 
@@ -116,10 +238,12 @@ def add_per_project_ou_to_openldap(project_obj, dn, openldap_ou_description, wri
     try:
         project_code_str = project_obj.project_code
         ou = f"{project_code_str}"
-        conn.add(
-            dn,
-            ["top", "organizationalUnit"],
-            {"ou": ou, "description": openldap_ou_description},
+        openldap_pool.run(
+            lambda conn: conn.add(
+                dn,
+                ["top", "organizationalUnit"],
+                {"ou": ou, "description": openldap_ou_description},
+            )
         )
     except Exception as exc_log:
         logger.error("Project OU: DN to write...")
@@ -127,25 +251,20 @@ def add_per_project_ou_to_openldap(project_obj, dn, openldap_ou_description, wri
         logger.error("Attributes to write...")
         logger.error(f"OU description - {openldap_ou_description}")
         logger.error(exc_log)
-    finally:
-        conn.unbind()
 
 
 def add_posixgroup_to_openldap(dn, openldap_description, gid_int, write=True):
     """Add a posixGroup to OpenLDAP"""
-    conn = openldap_connection(server, PROJECT_OPENLDAP_BIND_USER, PROJECT_OPENLDAP_BIND_PASSWORD)
-
-    if not conn:
-        return
-
     if not write:
         return None
 
     try:
-        conn.add(
-            dn,
-            "posixGroup",
-            {"description": openldap_description, "gidNumber": gid_int},
+        openldap_pool.run(
+            lambda conn: conn.add(
+                dn,
+                "posixGroup",
+                {"description": openldap_description, "gidNumber": gid_int},
+            )
         )
     except Exception as exc_log:
         logger.error("Project posixgroup: DN to write...")
@@ -153,138 +272,138 @@ def add_posixgroup_to_openldap(dn, openldap_description, gid_int, write=True):
         logger.error("Attributes to write...")
         logger.error(f"posixGroup description - {openldap_description} gidNumber - {gid_int}")
         logger.error(exc_log)
-    finally:
-        conn.unbind()
 
 
 # Remove a DN - e.g. DELETE a project OU or posixgroup in OpenLDAP
 def remove_dn_from_openldap(dn, write=True):
     """Remove a DN from OpenLDAP"""
-    conn = openldap_connection(server, PROJECT_OPENLDAP_BIND_USER, PROJECT_OPENLDAP_BIND_PASSWORD)
-
-    if not conn:
-        return
-
     if not write:
         return None
 
     try:
-        conn.delete(dn)
+        openldap_pool.run(lambda conn: conn.delete(dn))
     except Exception as exc_log:
         logger.info(exc_log)
-    finally:
-        conn.unbind()
 
 
 # Update the project title in OpenLDAP
 def update_posixgroup_description_in_openldap(dn, openldap_description, write=True):
     """Update the description of a posixGroup in OpenLDAP"""
-    conn = openldap_connection(server, PROJECT_OPENLDAP_BIND_USER, PROJECT_OPENLDAP_BIND_PASSWORD)
-
-    if not conn:
-        return
-
     if not write:
         return None
 
     try:
-        conn.modify(dn, {"description": [(MODIFY_REPLACE, [openldap_description])]})
+        openldap_pool.run(lambda conn: conn.modify(dn, {"description": [(MODIFY_REPLACE, [openldap_description])]}))
     except Exception as exc_log:
         logger.info(exc_log)
-    finally:
-        conn.unbind()
 
 
 # MOVE the project to an archive OU - defined as env var
 def move_dn_in_openldap(current_dn, relative_dn, destination_ou, write=True):
     """Move a DN to another OU in OpenLDAP"""
-    conn = openldap_connection(server, PROJECT_OPENLDAP_BIND_USER, PROJECT_OPENLDAP_BIND_PASSWORD)
-
-    if not conn:
-        return
-
     if not write:
         return None
 
     try:
-        conn.modify_dn(current_dn, relative_dn, new_superior=destination_ou)
+        openldap_pool.run(lambda conn: conn.modify_dn(current_dn, relative_dn, new_superior=destination_ou))
     except Exception as exc_log:
         logger.info(exc_log)
-    finally:
-        conn.unbind()
 
 
 def ldapsearch_check_project_dn(dn):
     """Check a distinguished name exists and represents a project (posixGroup)"""
-    conn = openldap_connection(server, PROJECT_OPENLDAP_BIND_USER, PROJECT_OPENLDAP_BIND_PASSWORD)
-
-    if not conn:
-        return
-
     try:
-        ldapsearch_check_project_dn_result = conn.search(dn, "(objectclass=posixGroup)")
+        ldapsearch_check_project_dn_result = openldap_pool.run(lambda conn: conn.search(dn, "(objectclass=posixGroup)"))
         return ldapsearch_check_project_dn_result
     except Exception as exc_log:
         logger.info(exc_log)
         return None
-    finally:
-        conn.unbind()
 
 
 # check bind user can see the Project OU or Archive OU - is also used in system setup check script
 def ldapsearch_check_ou(OU):
     """Test that ldapsearch can see an OU"""
-    conn = openldap_connection(server, PROJECT_OPENLDAP_BIND_USER, PROJECT_OPENLDAP_BIND_PASSWORD)
-
-    if not conn:
-        return
-
     try:
-        ldapsearch_check_project_ou_result = conn.search(OU, "(objectclass=organizationalUnit)")
+        ldapsearch_check_project_ou_result = openldap_pool.run(
+            lambda conn: conn.search(OU, "(objectclass=organizationalUnit)")
+        )
         return ldapsearch_check_project_ou_result
     except Exception as exc_log:
         logger.info(exc_log)
         return None
-    finally:
-        conn.unbind()
 
 
 def ldapsearch_get_posixgroup_memberuids(dn):
     """Get memberUids from a posixGroup"""
-    conn = openldap_connection(server, PROJECT_OPENLDAP_BIND_USER, PROJECT_OPENLDAP_BIND_PASSWORD)
 
-    if not conn:
-        return
+    def get_memberuids(conn):
+        conn.search(dn, "(objectclass=posixGroup)", attributes=["memberUid"])
+        return conn.entries
 
     try:
-        conn.search(dn, "(objectclass=posixGroup)", attributes=["memberUid"])
-        ldapsearch_project_memberuids_entries = conn.entries
+        ldapsearch_project_memberuids_entries = openldap_pool.run(get_memberuids)
         return ldapsearch_project_memberuids_entries
     except Exception as exc_log:
         logger.info(exc_log)
         return None
-    finally:
-        conn.unbind()
 
 
 def ldapsearch_get_description(dn):
     """Get description from an openldap entry"""
-    conn = openldap_connection(server, PROJECT_OPENLDAP_BIND_USER, PROJECT_OPENLDAP_BIND_PASSWORD)
-
-    if not conn:
-        return
 
-    try:
+    def get_description(conn):
         conn.search(dn, "(objectclass=posixGroup)", attributes=["description"])
         ldapsearch_project_description_entries = conn.entries
         # list with single entry, get description
-        ldapsearch_project_description = ldapsearch_project_description_entries[0].description
+        return ldapsearch_project_description_entries[0].description
+
+    try:
+        ldapsearch_project_description = openldap_pool.run(get_description)
         return ldapsearch_project_description
     except Exception as exc_log:
         logger.info(exc_log)
         return None
-    finally:
-        conn.unbind()
+
+
+def normalize_dn(dn):
+    """Normalize the case and spacing of a DN so DNs constructed here and DNs
+    returned by OpenLDAP can be compared"""
+    return ",".join("=".join(part.strip() for part in rdn.split("=", 1)) for rdn in dn.split(",")).lower()
+
+
+def ldapsearch_get_posixgroups(base_dn):
+    """Get the memberUids and description of every posixGroup under base_dn
+    with a single paged subtree search. Returns a dict mapping the normalized
+    DN of each posixGroup to a (memberUids, description) tuple, or None if the
+    search failed"""
+
+    def get_posixgroups(conn):
+        posixgroups = {}
+        for entry in conn.extend.standard.paged_search(
+            base_dn,
+            "(objectclass=posixGroup)",
+            search_scope=SUBTREE,
+            attributes=["memberUid", "description"],
+            paged_size=PROJECT_OPENLDAP_PAGE_SIZE,
+            generator=True,
+        ):
+            if entry.get("type") != "searchResEntry":
+                continue
+
+            attributes = entry["attributes"]
+            # match the value of a single valued ldap3 Attribute
+            description = attributes.get("description") or None
+            if isinstance(description, list) and len(description) == 1:
+                description = description[0]
+            posixgroups[normalize_dn(entry["dn"])] = (tuple(attributes.get("memberUid", [])), description)
+
+        return posixgroups
+
+    try:
+        return openldap_pool.run(get_posixgroups)
+    except Exception as exc_log:
+        logger.info(exc_log)
+        return None
 
 
 """
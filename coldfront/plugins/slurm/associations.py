@@ -5,10 +5,12 @@
 import datetime
 import logging
 import os
-import re
 import sys
 
-from coldfront.core.resource.models import Resource
+from django.db.models import Prefetch, Q
+
+from coldfront.core.allocation.models import Allocation, AllocationAttribute, AllocationUser
+from coldfront.core.resource.models import Resource, ResourceAttribute
 from coldfront.plugins.slurm.utils import (
     SLURM_ACCOUNT_ATTRIBUTE_NAME,
     SLURM_CLUSTER_ATTRIBUTE_NAME,
@@ -19,12 +21,44 @@ from coldfront.plugins.slurm.utils import (
 
 logger = logging.getLogger(__name__)
 
+# Prefetch allocation attributes (and the resources their expansion may
+# reference) so get_attribute() reads from the prefetch cache
+ALLOCATION_ATTRIBUTE_PREFETCH = [
+    Prefetch(
+        "allocationattribute_set",
+        queryset=AllocationAttribute.objects.select_related("allocation_attribute_type__attribute_type"),
+    ),
+    Prefetch(
+        "resources__resourceattribute_set",
+        queryset=ResourceAttribute.objects.select_related("resource_attribute_type__attribute_type"),
+    ),
+]
+
 
 class SlurmParserError(SlurmError):
     pass
 
 
+def _parse_sacctmgr_line(line, prefix):
+    """Parse a line from sacctmgr dump of the form: Prefix - 'name':spec1:spec2
+    into the (interned) name and list of specs. Returns None for the name if
+    the line does not start with the prefix followed by a quoted name."""
+    if not line.startswith(prefix):
+        return None, None
+
+    parts = line.split(":")
+    name = parts[0][len(prefix) :]
+    if len(name) < 3 or name[0] != "'" or name[-1] != "'":
+        return None, None
+
+    return sys.intern(name[1:-1]), parts[1:]
+
+
 class SlurmBase:
+    # Cached result of spec_list(), see below
+    _spec_key = None
+    _spec_set = frozenset()
+
     def __init__(self, name, specs=None):
         if specs is None:
             specs = []
@@ -32,22 +66,26 @@ class SlurmBase:
         self.name = name
         self.specs = specs
 
+    def spec_set(self):
+        """Return frozenset of unique Slurm Specs"""
+        # Specs are only ever appended to, so the parsed set is cached
+        # until the list of specs changes
+        key = tuple(self.specs)
+        if self._spec_key != key:
+            items = set()
+            for s in key:
+                items.update(s.split(":"))
+            self._spec_key = key
+            self._spec_set = frozenset(items)
+
+        return self._spec_set
+
     def spec_list(self):
         """Return unique list of Slurm Specs"""
-        items = []
-        for s in self.specs:
-            for i in s.split(":"):
-                items.append(i)
-
-        return list(set(items))
+        return list(self.spec_set())
 
     def format_specs(self):
         """Format unique list of Slurm Specs"""
-        items = []
-        for s in self.specs:
-            for i in s.split(":"):
-                items.append(i)
-
         return ":".join([x for x in self.spec_list()])
 
     def _write(self, out, data):
@@ -66,63 +104,144 @@ class SlurmCluster(SlurmBase):
 
     @staticmethod
     def new_from_stream(stream):
-        """Create a new SlurmCluster by parsing the output from sacctmgr dump."""
+        """Create a new SlurmCluster by parsing the output from sacctmgr dump.
+        The stream is consumed one line at a time."""
         cluster = None
         parent = None
+        users = None
         for line in stream:
             line = line.strip()
-            if re.match("^#", line):
+            if not line or line[0] == "#":
                 continue
-            elif re.match("^Cluster - '[^']+'", line):
-                parts = line.split(":")
-                name = re.sub(r"^Cluster - ", "", parts[0]).strip("\n'")
-                if len(name) == 0:
-                    raise (SlurmParserError("Cluster name not found for line: {}".format(line)))
-                cluster = SlurmCluster(name)
-                cluster.specs += parts[1:]
-            elif re.match("^Account - '[^']+'", line):
-                account = SlurmAccount.new_from_sacctmgr(line)
-                cluster.accounts[account.name] = account
-            elif re.match("^Parent - '[^']+'", line):
-                parent = re.sub(r"^Parent - ", "", line).strip("\n'")
-                if parent == "root":
-                    cluster.accounts["root"] = SlurmAccount("root")
-                if not parent:
-                    raise (SlurmParserError("Parent name not found for line: {}".format(line)))
-            elif re.match("^User - '[^']+'", line):
-                user = SlurmUser.new_from_sacctmgr(line)
+            elif line.startswith("User - "):
+                # User lines make up nearly all of a dump so they are parsed
+                # inline, adding the user directly to the current Parent
+                name, specs = _parse_sacctmgr_line(line, "User - ")
+                if not name:
+                    raise (SlurmParserError('Invalid format. Must start with "User" for line: {}'.format(line)))
                 if not parent:
                     raise (SlurmParserError("Found user record without Parent for line: {}".format(line)))
-                account = cluster.accounts[parent]
-                account.add_user(user)
-                cluster.accounts[parent] = account
+                if users is None:
+                    users = cluster.accounts[parent].users
+                rec = users.get(name)
+                if rec is None:
+                    users[name] = SlurmUser(name, specs=specs)
+                else:
+                    rec.specs += specs
+            elif line.startswith("Parent - "):
+                parent, _ = _parse_sacctmgr_line(line, "Parent - ")
+                if not parent:
+                    raise (SlurmParserError("Parent name not found for line: {}".format(line)))
+                if parent == "root":
+                    cluster.accounts["root"] = SlurmAccount("root")
+                users = None
+            elif line.startswith("Account - "):
+                account = SlurmAccount.new_from_sacctmgr(line)
+                cluster.accounts[account.name] = account
+            elif line.startswith("Cluster - "):
+                name, specs = _parse_sacctmgr_line(line, "Cluster - ")
+                if not name:
+                    raise (SlurmParserError("Cluster name not found for line: {}".format(line)))
+                cluster = SlurmCluster(name)
+                cluster.specs += specs
 
         if not cluster or not cluster.name:
             raise (SlurmParserError("Failed to parse Slurm cluster name. Is this in sacctmgr dump file format?"))
 
         return cluster
 
+    @staticmethod
+    def new_from_associations(name, lines, default_accounts=None):
+        """Create a new SlurmCluster from the output of sacctmgr list
+        associations Format=Account,User,QOS -Pn. Only the accounts listed
+        are included. As with sacctmgr dump, user QOS are the QOS a user has
+        in addition to those of the account association, and each user gets
+        their DefaultAccount from default_accounts (user name to account), if
+        given."""
+        if default_accounts is None:
+            default_accounts = {}
+
+        cluster = SlurmCluster(name)
+        account_qos = {}
+        user_rows = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+
+            parts = line.split("|")
+            if len(parts) != 3 or not parts[0]:
+                raise (SlurmParserError("Invalid association for line: {}".format(line)))
+
+            account, user, qos = parts
+            if account not in cluster.accounts:
+                cluster.accounts[account] = SlurmAccount(sys.intern(account))
+
+            qos = set(q for q in qos.split(",") if q)
+            if user:
+                user_rows.append((account, user, qos))
+            else:
+                account_qos[account] = qos
+
+        for account, user, qos in user_rows:
+            specs = []
+            extra = qos - account_qos.get(account, set())
+            if extra:
+                specs.append("QOS+=" + ",".join(sorted(extra)))
+            if user in default_accounts:
+                specs.append("DefaultAccount='{}'".format(default_accounts[user]))
+            cluster.accounts[account].add_user(SlurmUser(sys.intern(user), specs=specs))
+
+        return cluster
+
     @staticmethod
     def new_from_resource(resource):
-        """Create a new SlurmCluster from a ColdFront Resource model."""
-        name = resource.get_attribute(SLURM_CLUSTER_ATTRIBUTE_NAME)
-        specs = resource.get_attribute_list(SLURM_SPECS_ATTRIBUTE_NAME)
-        user_specs = resource.get_attribute_list(SLURM_USER_SPECS_ATTRIBUTE_NAME)
+        """Create a new SlurmCluster from a ColdFront Resource model.
+
+        All active allocations, allocation users and attributes of the
+        resource and its child "Cluster Partition" resources are loaded up
+        front, so the number of queries does not grow with the number of
+        allocations or users."""
+        attribute_index = resource.get_attribute_index()
+        name = resource.get_attribute(SLURM_CLUSTER_ATTRIBUTE_NAME, attribute_index=attribute_index)
+        specs = resource.get_attribute_list(SLURM_SPECS_ATTRIBUTE_NAME, attribute_index=attribute_index)
+        user_specs = resource.get_attribute_list(SLURM_USER_SPECS_ATTRIBUTE_NAME, attribute_index=attribute_index)
         if not name:
             raise (SlurmError("Resource {} missing slurm_cluster".format(resource)))
 
         cluster = SlurmCluster(name, specs)
 
+        active_allocations = Allocation.objects.filter(
+            status__name__in=["Active", "Renewal Requested"]
+        ).prefetch_related(
+            *ALLOCATION_ATTRIBUTE_PREFETCH,
+            Prefetch("allocationuser_set", queryset=AllocationUser.objects.select_related("user", "status")),
+        )
+        resources = Resource.objects.filter(
+            Q(pk=resource.pk) | Q(parent_resource_id=resource.pk, resource_type__name="Cluster Partition")
+        ).prefetch_related(
+            Prefetch(
+                "resourceattribute_set",
+                queryset=ResourceAttribute.objects.select_related("resource_attribute_type__attribute_type"),
+            ),
+            Prefetch("allocation_set", queryset=active_allocations),
+        )
+
         # Process allocations
-        for allocation in resource.allocation_set.filter(status__name__in=["Active", "Renewal Requested"]):
-            cluster.add_allocation(allocation, user_specs=user_specs)
+        children = []
+        for r in resources:
+            if r.pk != resource.pk:
+                children.append(r)
+                continue
+
+            for allocation in r.allocation_set.all():
+                cluster.add_allocation(allocation, user_specs=user_specs)
 
         # Process child resources
-        children = Resource.objects.filter(parent_resource_id=resource.id, resource_type__name="Cluster Partition")
         for r in children:
             partition_specs = r.get_attribute_list(SLURM_SPECS_ATTRIBUTE_NAME)
             partition_user_specs = r.get_attribute_list(SLURM_USER_SPECS_ATTRIBUTE_NAME)
-            for allocation in r.allocation_set.filter(status__name__in=["Active", "Renewal Requested"]):
+            for allocation in r.allocation_set.all():
                 cluster.add_allocation(allocation, specs=partition_specs, user_specs=partition_user_specs)
 
         return cluster
@@ -175,15 +294,11 @@ class SlurmAccount(SlurmBase):
     def new_from_sacctmgr(line):
         """Create a new SlurmAccount by parsing a line from sacctmgr dump. For
         example: Account - 'physics':Description='physics group':Organization='cas':Fairshare=100"""
-        if not re.match("^Account - '[^']+'", line):
+        name, specs = _parse_sacctmgr_line(line, "Account - ")
+        if not name:
             raise (SlurmParserError('Invalid format. Must start with "Account" for line: {}'.format(line)))
 
-        parts = line.split(":")
-        name = re.sub(r"^Account - ", "", parts[0]).strip("\n'")
-        if len(name) == 0:
-            raise (SlurmParserError("Cluster name not found for line: {}".format(line)))
-
-        return SlurmAccount(name, specs=parts[1:])
+        return SlurmAccount(name, specs=specs)
 
     def add_allocation(self, allocation, user_specs=None):
         """Add users from a ColdFront Allocation model to SlurmAccount"""
@@ -200,7 +315,12 @@ class SlurmAccount(SlurmBase):
         self.specs += allocation.get_attribute_list(SLURM_SPECS_ATTRIBUTE_NAME)
 
         allocation_user_specs = allocation.get_attribute_list(SLURM_USER_SPECS_ATTRIBUTE_NAME)
-        for u in allocation.allocationuser_set.filter(status__name="Active"):
+        if "allocationuser_set" in getattr(allocation, "_prefetched_objects_cache", {}):
+            allocation_users = [u for u in allocation.allocationuser_set.all() if u.status.name == "Active"]
+        else:
+            allocation_users = allocation.allocationuser_set.filter(status__name="Active").select_related("user")
+
+        for u in allocation_users:
             user = SlurmUser(u.user.username)
             user.specs += allocation_user_specs
             user.specs += user_specs
@@ -235,15 +355,11 @@ class SlurmUser(SlurmBase):
     def new_from_sacctmgr(line):
         """Create a new SlurmUser by parsing a line from sacctmgr dump. For
         example: User - 'jane':DefaultAccount='physics':Fairshare=Parent:QOS='general-compute'"""
-        if not re.match("^User - '[^']+'", line):
+        name, specs = _parse_sacctmgr_line(line, "User - ")
+        if not name:
             raise (SlurmParserError('Invalid format. Must start with "User" for line: {}'.format(line)))
 
-        parts = line.split(":")
-        name = re.sub(r"^User - ", "", parts[0]).strip("\n'")
-        if len(name) == 0:
-            raise (SlurmParserError("User name not found for line: {}".format(line)))
-
-        return SlurmUser(name, specs=parts[1:])
+        return SlurmUser(name, specs=specs)
 
     def write(self, out):
         self._write(
@@ -253,3 +369,21 @@ class SlurmUser(SlurmBase):
                 self.format_specs(),
             ),
         )
+
+
+def slurm_accounts_changed_since(since):
+    """Return the set of Slurm account names of allocations that changed since
+    the given datetime, based on the history of allocations, allocation users
+    and allocation attributes. Account names the allocations had before a
+    change (or before being deleted) are included."""
+    changed = set(Allocation.history.filter(history_date__gte=since).values_list("id", flat=True))
+    changed.update(AllocationUser.history.filter(history_date__gte=since).values_list("allocation_id", flat=True))
+    changed.update(AllocationAttribute.history.filter(history_date__gte=since).values_list("allocation_id", flat=True))
+    if not changed:
+        return set()
+
+    return set(
+        AllocationAttribute.history.filter(
+            allocation_id__in=changed, allocation_attribute_type__name=SLURM_ACCOUNT_ATTRIBUTE_NAME
+        ).values_list("value", flat=True)
+    )
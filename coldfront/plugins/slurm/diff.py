@@ -0,0 +1,171 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import json
+from collections import Counter
+
+SLURM_PLAN_VERSION = 1
+
+
+def normalize_specs(specs):
+    """Normalize a list of Slurm specs into the frozenset of QOS the
+    association has in addition to its parent (QOS+=a,b or QOS=+a,+b) and the
+    default account, if any."""
+    qos = set()
+    default_account = None
+    for spec in specs:
+        for s in spec.split(":"):
+            if s.startswith("QOS+="):
+                qos.update(s[5:].replace("'", "").split(","))
+            elif s.startswith("QOS="):
+                qos.update(q[1:] for q in s[4:].replace("'", "").split(",") if q.startswith("+"))
+            elif s.startswith("DefaultAccount="):
+                default_account = s[15:].strip("'")
+
+    qos.discard("")
+    return frozenset(qos), default_account
+
+
+def flatten_cluster(cluster):
+    """Flatten a SlurmCluster into a dict mapping (account, user) to the
+    normalized specs of each association. Account associations have an empty
+    user name."""
+    # Users mostly share the same specs so each distinct list of specs is only
+    # normalized once
+    normalized = {}
+    associations = {}
+    for name, account in cluster.accounts.items():
+        associations[(name, "")] = normalize_specs(account.specs)
+        for uid, user in account.users.items():
+            key = tuple(user.specs)
+            specs = normalized.get(key)
+            if specs is None:
+                specs = normalized[key] = normalize_specs(key)
+            associations[(name, uid)] = specs
+
+    return associations
+
+
+class SlurmPlan:
+    """Changes needed to bring the associations of a Slurm cluster in line
+    with ColdFront. Each change is a tuple:
+
+        add: (account, user, qos)
+        remove: (account, user)
+        modify: (account, user, qos_add, qos_remove)
+        default_account: (user, account, new_account)
+
+    Account associations have an empty user name. User removals are listed
+    before account removals."""
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.add = []
+        self.remove = []
+        self.modify = []
+        self.default_account = []
+
+    def __len__(self):
+        return len(self.add) + len(self.remove) + len(self.modify) + len(self.default_account)
+
+    def to_dict(self):
+        return {
+            "version": SLURM_PLAN_VERSION,
+            "cluster": self.cluster,
+            "add": [{"account": a, "user": u, "qos": sorted(qos)} for a, u, qos in self.add],
+            "remove": [{"account": a, "user": u} for a, u in self.remove],
+            "modify": [
+                {"account": a, "user": u, "qos_add": sorted(qos_add), "qos_remove": sorted(qos_remove)}
+                for a, u, qos_add, qos_remove in self.modify
+            ],
+            "default_account": [{"user": u, "account": a, "new_account": new} for u, a, new in self.default_account],
+        }
+
+    def to_json(self, fh, indent=2):
+        json.dump(self.to_dict(), fh, indent=indent)
+
+    @staticmethod
+    def from_dict(data):
+        if data.get("version") != SLURM_PLAN_VERSION:
+            raise ValueError("Unsupported Slurm plan version: {}".format(data.get("version")))
+
+        plan = SlurmPlan(data["cluster"])
+        plan.add = [(r["account"], r["user"], frozenset(r["qos"])) for r in data.get("add", [])]
+        plan.remove = [(r["account"], r["user"]) for r in data.get("remove", [])]
+        plan.modify = [
+            (r["account"], r["user"], frozenset(r["qos_add"]), frozenset(r["qos_remove"]))
+            for r in data.get("modify", [])
+        ]
+        plan.default_account = [(r["user"], r["account"], r["new_account"]) for r in data.get("default_account", [])]
+        return plan
+
+    @staticmethod
+    def from_json(fh):
+        return SlurmPlan.from_dict(json.load(fh))
+
+
+def diff_clusters(slurm_cluster, coldfront_cluster, accounts=None):
+    """Compute the SlurmPlan to bring the associations in slurm_cluster in
+    line with coldfront_cluster. If accounts is given only those accounts are
+    compared.
+
+    Both clusters are flattened and compared in a single pass over each side.
+    Slurm user associations not in ColdFront are removed, as are accounts not
+    in ColdFront or left without users. The root account and root user
+    associations of accounts in ColdFront are left alone. Users whose default
+    account is removed are moved to one of their remaining accounts."""
+    current = flatten_cluster(slurm_cluster)
+    desired = flatten_cluster(coldfront_cluster)
+    plan = SlurmPlan(slurm_cluster.name)
+
+    removed = Counter()
+    moved = {}
+    in_desired = desired.get
+    for key, (qos, default_account) in current.items():
+        account, user = key
+        if not user or account == "root" or (accounts is not None and account not in accounts):
+            continue
+
+        want = in_desired(key)
+        if want is None:
+            if user != "root" or (account, "") not in desired:
+                plan.remove.append(key)
+                removed[account] += 1
+                if default_account == account:
+                    moved[user] = account
+        elif user != "root":
+            qos_add = want[0] - qos
+            qos_remove = qos - want[0]
+            if qos_add or qos_remove:
+                plan.modify.append((account, user, qos_add, qos_remove))
+
+    if moved:
+        # Find the first remaining account of users losing their default account
+        removed_keys = set(plan.remove)
+        new_default = {}
+        for key in current:
+            account, user = key
+            if user in moved and user not in new_default and key not in removed_keys:
+                new_default[user] = account
+
+        for user, account in moved.items():
+            if user in new_default:
+                plan.default_account.append((user, account, new_default[user]))
+
+    for account, rec in slurm_cluster.accounts.items():
+        if account == "root" or (accounts is not None and account not in accounts):
+            continue
+
+        if (account, "") not in desired or len(rec.users) == removed[account]:
+            plan.remove.append((account, ""))
+
+    for key, (qos, _) in desired.items():
+        account, user = key
+        if account == "root" or (accounts is not None and account not in accounts):
+            continue
+
+        if key not in current:
+            plan.add.append((account, user, qos))
+
+    return plan
@@ -2,20 +2,31 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import gc
 import logging
 import os
 import sys
 import tempfile
+import time
 
 from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from coldfront.core.resource.models import ResourceAttribute
 from coldfront.core.utils.common import import_from_settings
-from coldfront.plugins.slurm.associations import SlurmCluster
+from coldfront.plugins.slurm.associations import SlurmCluster, slurm_accounts_changed_since
+from coldfront.plugins.slurm.diff import SlurmPlan, diff_clusters
 from coldfront.plugins.slurm.utils import (
     SLURM_CLUSTER_ATTRIBUTE_NAME,
+    SLURM_MAX_WORKERS,
+    SlurmCommandBatch,
     SlurmError,
     slurm_dump_cluster,
+    slurm_list_associations,
+    slurm_list_default_accounts,
+    slurm_list_user_associations,
+    slurm_map_clusters,
     slurm_remove_account,
     slurm_remove_assoc,
     slurm_remove_qos,
@@ -28,6 +39,14 @@ SLURM_NOOP = import_from_settings("SLURM_NOOP", False)
 
 logger = logging.getLogger(__name__)
 
+HEADER = [
+    "username",
+    "account",
+    "cluster",
+    "slurm_action",
+    "slurm_specs",
+]
+
 
 class Command(BaseCommand):
     help = "Check consistency between Slurm associations and ColdFront allocations"
@@ -39,9 +58,40 @@ class Command(BaseCommand):
             "-s", "--sync", help="Remove associations in Slurm that no longer exist in ColdFront", action="store_true"
         )
         parser.add_argument("-n", "--noop", help="Print commands only. Do not run any commands.", action="store_true")
+        parser.add_argument(
+            "-b", "--batch", help="Apply --sync changes in a single sacctmgr session", action="store_true"
+        )
         parser.add_argument("-u", "--username", help="Check specific username")
         parser.add_argument("-a", "--account", help="Check specific account")
         parser.add_argument("-x", "--header", help="Include header in output", action="store_true")
+        parser.add_argument(
+            "--changed-since",
+            help="Only check accounts of allocations changed since this ISO 8601 time. Requires --cluster",
+        )
+        parser.add_argument(
+            "--watermark",
+            help="Path to file with the time of the last successful incremental sync. Only accounts of allocations "
+            "changed since then are checked, and the file is updated after a successful --sync. Requires --cluster",
+        )
+        parser.add_argument("-p", "--plan", help="Write the plan of changes as JSON to this file")
+        parser.add_argument(
+            "--all-clusters",
+            help="Dump and check all Slurm clusters in parallel. Requires --output",
+            action="store_true",
+        )
+        parser.add_argument(
+            "-o", "--output", help="Directory for the report and plan of each cluster with --all-clusters"
+        )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            default=SLURM_MAX_WORKERS,
+            help="Number of clusters to check in parallel with --all-clusters. Default {}".format(SLURM_MAX_WORKERS),
+        )
+        parser.add_argument(
+            "--apply-plan", help="Apply the removals in a plan written by --plan instead of checking the cluster"
+        )
 
     def write(self, data):
         try:
@@ -85,10 +135,13 @@ class Command(BaseCommand):
         if self._skip_user(user, account):
             return
 
-        if self.sync:
+        if self.sync and self.batch:
+            self.pending_users.append((user, account))
+        elif self.sync:
             try:
                 slurm_remove_assoc(user, cluster, account, noop=self.noop)
             except SlurmError as e:
+                self.failed = True
                 logger.error(
                     "Failed removing Slurm association user %s account %s cluster %s: %s", user, account, cluster, e
                 )
@@ -110,10 +163,13 @@ class Command(BaseCommand):
         if self._skip_account(account):
             return
 
-        if self.sync:
+        if self.sync and self.batch:
+            self.pending_accounts.append(account)
+        elif self.sync:
             try:
                 slurm_remove_account(cluster, account, noop=self.noop)
             except SlurmError as e:
+                self.failed = True
                 logger.error("Failed removing Slurm account %s cluster %s: %s", account, cluster, e)
             else:
                 logger.error("Removed Slurm account %s cluster %s successfully", account, cluster)
@@ -131,11 +187,14 @@ class Command(BaseCommand):
         if self._skip_user(user, account):
             return
 
-        if self.sync:
+        if self.sync and self.batch:
+            self.pending_qos.append((user, account, qos))
+        elif self.sync:
             try:
                 slurm_remove_qos(user, cluster, account, qos, noop=self.noop)
                 pass
             except SlurmError as e:
+                self.failed = True
                 logger.error(
                     "Failed removing Slurm qos %s for user %s account %s cluster %s: %s", qos, user, account, cluster, e
                 )
@@ -148,86 +207,54 @@ class Command(BaseCommand):
 
         self.write("\t".join(row))
 
-    def _parse_qos(self, qos):
-        if qos.startswith("QOS+="):
-            qos = qos.replace("QOS+=", "")
-            qos = qos.replace("'", "")
-            return qos.split(",")
-        elif qos.startswith("QOS="):
-            qos = qos.replace("QOS=", "")
-            qos = qos.replace("'", "")
-            lst = []
-            for q in qos.split(","):
-                if q.startswith("+"):
-                    lst.append(q.replace("+", ""))
-            return lst
-
-        return []
-
-    def _diff_qos(self, account_name, cluster_name, user_a, user_b):
-        logger.debug(
-            "diff qos: cluster=%s account=%s uid=%s a=%s b=%s",
-            cluster_name,
-            account_name,
-            user_a.name,
-            user_a.spec_list(),
-            user_b.spec_list(),
-        )
+    def sync_batch(self, plan):
+        """Apply all pending removals in a single sacctmgr process. Users
+        whose default account is being removed are first moved to another
+        of their accounts that is not being removed."""
+        batch = SlurmCommandBatch()
+        defaults = {(uid, name): new for uid, name, new in plan.default_account}
+        for uid, name in self.pending_users:
+            if (uid, name) in defaults:
+                batch.change_default_account(uid, plan.cluster, defaults[(uid, name)])
 
-        specs_a = []
-        for s in user_a.spec_list():
-            if s.startswith("QOS"):
-                specs_a += self._parse_qos(s)
-
-        specs_b = []
-        for s in user_b.spec_list():
-            if s.startswith("QOS"):
-                specs_b += self._parse_qos(s)
-
-        specs_set_a = set(specs_a)
-        specs_set_b = set(specs_b)
-
-        diff = specs_set_a.difference(specs_set_b)
-        logger.debug(
-            "diff qos: cluster=%s account=%s uid=%s a=%s b=%s diff=%s",
-            cluster_name,
-            account_name,
-            user_a.name,
-            specs_set_a,
-            specs_set_b,
-            diff,
-        )
+            batch.remove_assoc(uid, plan.cluster, name)
 
-        if len(diff) > 0:
-            self.remove_qos(user_a.name, account_name, cluster_name, "QOS-=" + ",".join([x for x in list(diff)]))
+        for uid, name, qos in self.pending_qos:
+            batch.remove_qos(uid, plan.cluster, name, qos)
 
-    def _diff(self, cluster_a, cluster_b):
-        for name, account in cluster_a.accounts.items():
-            if name == "root":
-                continue
+        for name in self.pending_accounts:
+            batch.remove_account(plan.cluster, name)
 
-            if name in cluster_b.accounts:
-                total = 0
-                for uid, user in account.users.items():
-                    if uid == "root":
-                        continue
-                    if uid not in cluster_b.accounts[name].users:
-                        self.remove_user(uid, name, cluster_a.name)
-                        total += 1
-                    else:
-                        self._diff_qos(name, cluster_a.name, user, cluster_b.accounts[name].users[uid])
-
-                if total == len(account.users):
-                    self.remove_account(name, cluster_a.name)
+        for cmd, err in batch.run(noop=self.noop):
+            if err:
+                self.failed = True
+                logger.error("Failed Slurm batch cmd on cluster %s: %s: %s", plan.cluster, cmd, err)
             else:
-                for uid, user in account.users.items():
-                    self.remove_user(uid, name, cluster_a.name)
+                logger.error("Applied Slurm batch cmd on cluster %s successfully: %s", plan.cluster, cmd)
 
-                self.remove_account(name, cluster_a.name)
+    def apply_plan(self, plan):
+        for name, uid in plan.remove:
+            if uid:
+                self.remove_user(uid, name, plan.cluster)
+            else:
+                self.remove_account(name, plan.cluster)
+
+        for name, uid, _, qos_remove in plan.modify:
+            if qos_remove:
+                self.remove_qos(uid, name, plan.cluster, "QOS-=" + ",".join(sorted(qos_remove)))
+
+        if self.sync and self.batch:
+            self.sync_batch(plan)
 
     def check_consistency(self, slurm_cluster, coldfront_cluster):
         # Check for accounts in Slurm NOT in ColdFront
-        self._diff(slurm_cluster, coldfront_cluster)
+        plan = diff_clusters(slurm_cluster, coldfront_cluster, accounts=self.accounts)
+        if self.plan_file:
+            with open(self.plan_file, "w") as fh:
+                plan.to_json(fh)
+
+        self.apply_plan(plan)
+        return plan
 
     def _cluster_from_dump(self, cluster):
         slurm_cluster = None
@@ -242,7 +269,122 @@ class Command(BaseCommand):
 
         return slurm_cluster
 
+    def _cluster_from_changes(self, cluster, since):
+        accounts = slurm_accounts_changed_since(since)
+        self.accounts = accounts
+        logger.info("Found %s Slurm accounts with allocation changes since %s", len(accounts), since)
+        try:
+            lines = slurm_list_associations(cluster, accounts)
+            # Users losing their default account are moved to one of their
+            # other accounts, so list all of their accounts and their default
+            users = {line.split("|")[1] for line in lines if line.count("|") == 2} - {""}
+            lines = list(dict.fromkeys(lines + slurm_list_user_associations(cluster, users)))
+            default_accounts = slurm_list_default_accounts(cluster, users)
+            return SlurmCluster.new_from_associations(cluster, lines, default_accounts)
+        except SlurmError as e:
+            logger.error("Failed to list Slurm associations for cluster %s: %s", cluster, e)
+
+        return None
+
+    def _read_watermark(self, fname):
+        if not os.path.exists(fname):
+            return None
+
+        with open(fname) as fh:
+            since = parse_datetime(fh.read().strip())
+
+        if not since:
+            logger.warning("Invalid watermark in %s", fname)
+
+        return since
+
+    def _init_state(self, options):
+        self.sync = options["sync"]
+        self.noop = SLURM_NOOP or options["noop"]
+        self.batch = options["batch"]
+        self.failed = False
+        self.pending_users = []
+        self.pending_qos = []
+        self.pending_accounts = []
+        self.accounts = None
+        self.plan_file = options["plan"]
+        self.filter_user = options["username"]
+        self.filter_account = options["account"]
+
+    def _check_cluster(self, attr):
+        """Dump and check a single cluster for --all-clusters. Each cluster is
+        checked by a separate Command so no state is shared between threads."""
+        start = time.monotonic()
+        name = attr.value
+        with open(os.path.join(self.out_dir, "{}.tsv".format(name)), "w") as fh:
+            cmd = Command(stdout=fh)
+            cmd._init_state(self.options)
+            cmd.plan_file = os.path.join(self.out_dir, "{}.json".format(name))
+            if self.options["header"]:
+                cmd.write("\t".join(HEADER))
+
+            slurm_cluster = cmd._cluster_from_dump(name)
+            if not slurm_cluster:
+                raise SlurmError("Failed to dump Slurm cluster {}".format(name))
+
+            plan = cmd.check_consistency(slurm_cluster, SlurmCluster.new_from_resource(attr.resource))
+
+        return plan, cmd.failed, time.monotonic() - start
+
+    def check_all_clusters(self, options):
+        self.options = options
+        self.out_dir = options["output"]
+        if not os.path.isdir(self.out_dir):
+            os.mkdir(self.out_dir, 0o0700)
+
+        attrs = []
+        for attr in ResourceAttribute.objects.filter(
+            resource_attribute_type__name=SLURM_CLUSTER_ATTRIBUTE_NAME
+        ).select_related("resource"):
+            if attr.value in SLURM_IGNORE_CLUSTERS:
+                logger.warning("Ignoring cluster %s", attr.value)
+                continue
+
+            if attr.resource.is_available:
+                attrs.append(attr)
+
+        failed = False
+        for attr, result, error in slurm_map_clusters(self._check_cluster, attrs, options["workers"]):
+            if error:
+                failed = True
+                logger.error("Failed checking Slurm cluster %s: %s", attr.value, error)
+                self.write("\t".join([attr.value, "", "", "", "failed", ""]))
+                continue
+
+            plan, cluster_failed, elapsed = result
+            failed = failed or cluster_failed
+            row = [
+                attr.value,
+                str(len(plan.remove)),
+                str(len(plan.modify)),
+                str(len(plan.add)),
+                "failed" if cluster_failed else "ok",
+                "{:.2f}".format(elapsed),
+            ]
+            self.write("\t".join(row))
+
+        if failed:
+            sys.exit(1)
+
     def handle(self, *args, **options):
+        # Parsing and diffing large dumps creates many long lived objects, so
+        # pause the garbage collector for the whole run rather than have it
+        # repeatedly scan them. This is process wide, so it is done here
+        # rather than in the (possibly threaded) parsing code.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self._handle(options)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _handle(self, options):
         verbosity = int(options["verbosity"])
         root_logger = logging.getLogger("")
         if verbosity == 0:
@@ -254,17 +396,59 @@ class Command(BaseCommand):
         else:
             root_logger.setLevel(logging.WARNING)
 
-        self.sync = False
-        if options["sync"]:
-            self.sync = True
+        self._init_state(options)
+        if self.sync:
             logger.warning("Syncing Slurm with ColdFront")
-
-        self.noop = SLURM_NOOP
-        if options["noop"]:
-            self.noop = True
+        if self.noop:
             logger.warning("NOOP enabled")
+        if self.batch:
+            logger.warning("Batching sacctmgr commands")
+
+        if options["apply_plan"]:
+            with open(options["apply_plan"]) as fh:
+                plan = SlurmPlan.from_json(fh)
+
+            if plan.cluster in SLURM_IGNORE_CLUSTERS:
+                logger.warning("Ignoring cluster %s. Nothing to do.", plan.cluster)
+                sys.exit(0)
 
-        if options["cluster"]:
+            self.apply_plan(plan)
+            return
+
+        if options["all_clusters"]:
+            if options["cluster"] or options["input"] or options["changed_since"] or options["watermark"]:
+                logger.error("--all-clusters can not be combined with --cluster, --input or incremental checks")
+                sys.exit(1)
+
+            if not options["output"]:
+                logger.error("--all-clusters requires --output")
+                sys.exit(1)
+
+            self.check_all_clusters(options)
+            return
+
+        started = timezone.now()
+        since = None
+        if options["changed_since"] or options["watermark"]:
+            if not options["cluster"]:
+                logger.error("--changed-since and --watermark require --cluster")
+                sys.exit(1)
+
+            if options["changed_since"]:
+                since = parse_datetime(options["changed_since"])
+                if not since:
+                    logger.error("Invalid --changed-since time: %s", options["changed_since"])
+                    sys.exit(1)
+            else:
+                since = self._read_watermark(options["watermark"])
+                if not since:
+                    logger.warning("No watermark found, checking all accounts")
+
+        if since:
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            slurm_cluster = self._cluster_from_changes(options["cluster"], since)
+        elif options["cluster"]:
             slurm_cluster = self._cluster_from_dump(options["cluster"])
         elif options["input"]:
             with open(options["input"]) as fh:
@@ -292,20 +476,13 @@ class Command(BaseCommand):
             )
             sys.exit(1)
 
-        header = [
-            "username",
-            "account",
-            "cluster",
-            "slurm_action",
-            "slurm_specs",
-        ]
-
         if options["header"]:
-            self.write("\t".join(header))
-
-        self.filter_user = options["username"]
-        self.filter_account = options["account"]
+            self.write("\t".join(HEADER))
 
         coldfront_cluster = SlurmCluster.new_from_resource(resource)
 
         self.check_consistency(slurm_cluster, coldfront_cluster)
+
+        if options["watermark"] and self.sync and not self.noop and not self.failed:
+            with open(options["watermark"], "w") as fh:
+                fh.write(started.isoformat())
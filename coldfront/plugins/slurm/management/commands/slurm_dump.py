@@ -4,12 +4,14 @@
 
 import logging
 import os
+import sys
+import time
 
 from django.core.management.base import BaseCommand
 
 from coldfront.core.resource.models import ResourceAttribute
 from coldfront.plugins.slurm.associations import SlurmCluster
-from coldfront.plugins.slurm.utils import SLURM_CLUSTER_ATTRIBUTE_NAME
+from coldfront.plugins.slurm.utils import SLURM_CLUSTER_ATTRIBUTE_NAME, SLURM_MAX_WORKERS, slurm_map_clusters
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +22,22 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("-o", "--output", help="Path to output directory")
         parser.add_argument("-c", "--cluster", help="Only output specific Slurm cluster")
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            default=SLURM_MAX_WORKERS,
+            help="Number of clusters to build in parallel. Default {}".format(SLURM_MAX_WORKERS),
+        )
+
+    def _build_cluster(self, resource):
+        start = time.monotonic()
+        cluster = SlurmCluster.new_from_resource(resource)
+        if self.out_dir:
+            with open(os.path.join(self.out_dir, "{}.cfg".format(cluster.name)), "w") as fh:
+                cluster.write(fh)
+
+        return cluster, time.monotonic() - start
 
     def handle(self, *args, **options):
         verbosity = int(options["verbosity"])
@@ -33,25 +51,46 @@ class Command(BaseCommand):
         else:
             root_logger.setLevel(logging.WARNING)
 
-        out_dir = None
+        self.out_dir = None
         if options["output"]:
-            out_dir = options["output"]
-            if not os.path.isdir(out_dir):
-                os.mkdir(out_dir, 0o0700)
+            self.out_dir = options["output"]
+            if not os.path.isdir(self.out_dir):
+                os.mkdir(self.out_dir, 0o0700)
 
-            logger.warning("Writing output to directory: %s", out_dir)
+            logger.warning("Writing output to directory: %s", self.out_dir)
 
-        for attr in ResourceAttribute.objects.filter(resource_attribute_type__name=SLURM_CLUSTER_ATTRIBUTE_NAME):
+        resources = []
+        for attr in ResourceAttribute.objects.filter(
+            resource_attribute_type__name=SLURM_CLUSTER_ATTRIBUTE_NAME
+        ).select_related("resource"):
             if options["cluster"] and options["cluster"] != attr.value:
                 continue
 
             if not attr.resource.is_available:
                 continue
 
-            cluster = SlurmCluster.new_from_resource(attr.resource)
-            if not out_dir:
+            resources.append(attr.resource)
+
+        failed = False
+        for resource, result, error in slurm_map_clusters(self._build_cluster, resources, options["workers"]):
+            if error:
+                failed = True
+                logger.error("Failed to dump Slurm cluster for resource %s: %s", resource.name, error)
+                continue
+
+            cluster, elapsed = result
+            if not self.out_dir:
                 cluster.write(self.stdout)
                 continue
 
-            with open(os.path.join(out_dir, "{}.cfg".format(cluster.name)), "w") as fh:
-                cluster.write(fh)
+            self.stdout.write(
+                "{}\t{} accounts\t{} users\t{:.2f}s".format(
+                    cluster.name,
+                    len(cluster.accounts),
+                    sum(len(a.users) for a in cluster.accounts.values()),
+                    elapsed,
+                )
+            )
+
+        if failed:
+            sys.exit(1)
@@ -2,13 +2,39 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import json
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
 from io import StringIO
+from unittest.mock import patch
 
 from django.core.management import call_command
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
 
-from coldfront.core.resource.models import Resource
-from coldfront.plugins.slurm.associations import SlurmCluster
+from coldfront.core.allocation.models import AllocationAttributeType
+from coldfront.core.resource.models import AttributeType, Resource, ResourceAttribute, ResourceAttributeType
+from coldfront.core.test_helpers.decorators import runs_benchmarks
+from coldfront.core.test_helpers.factories import (
+    AAttributeTypeFactory,
+    AllocationAttributeFactory,
+    AllocationFactory,
+    AllocationUserFactory,
+    AllocationUserStatusChoiceFactory,
+    ResourceFactory,
+    ResourceTypeFactory,
+)
+from coldfront.plugins.slurm.associations import (
+    SlurmCluster,
+    SlurmParserError,
+    SlurmUser,
+    slurm_accounts_changed_since,
+)
+
+logger = logging.getLogger(__name__)
 
 
 class AssociationTest(TestCase):
@@ -78,3 +104,313 @@ User - 'larry':DefaultAccount='physics':Fairshare=parent
         self.assertEqual(len(cluster2.accounts["physics"].users), 3)
         for u in ["jane", "john", "larry"]:
             self.assertIn(u, cluster2.accounts["physics"].users)
+
+
+class SlurmAllocationTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        text_type, _ = AttributeType.objects.get_or_create(name="Text")
+        cluster_type = ResourceAttributeType.objects.create(name="slurm_cluster", attribute_type=text_type)
+        cls.resource = ResourceFactory(name="hpc", resource_type=ResourceTypeFactory(name="Cluster"))
+        ResourceAttribute.objects.create(resource=cls.resource, resource_attribute_type=cluster_type, value="hpc")
+        cls.partition = ResourceFactory(
+            name="hpc-gpu", parent_resource=cls.resource, resource_type=ResourceTypeFactory(name="Cluster Partition")
+        )
+        cls.account_type = AllocationAttributeType.objects.create(
+            name="slurm_account_name", attribute_type=AAttributeTypeFactory(name="Text")
+        )
+        cls.active = AllocationUserStatusChoiceFactory(name="Active")
+        cls.removed = AllocationUserStatusChoiceFactory(name="Removed")
+
+    def add_allocation(self, resource, account, users):
+        allocation = AllocationFactory()
+        allocation.resources.add(resource)
+        AllocationAttributeFactory(allocation=allocation, allocation_attribute_type=self.account_type, value=account)
+        for u in users:
+            AllocationUserFactory(allocation=allocation, status=self.active, user__username=u)
+        AllocationUserFactory(allocation=allocation, status=self.removed, user__username=account + "-removed")
+        return allocation
+
+
+class NewFromResourceQueryTest(SlurmAllocationTestCase):
+    def test_query_count_independent_of_allocations(self):
+        self.add_allocation(self.resource, "physics", ["jane", "john"])
+        self.add_allocation(self.partition, "chem", ["larry"])
+        with self.assertNumQueries(8):
+            cluster = SlurmCluster.new_from_resource(self.resource)
+
+        self.assertEqual(set(cluster.accounts), {"physics", "chem"})
+        self.assertEqual(set(cluster.accounts["physics"].users), {"jane", "john"})
+        self.assertEqual(set(cluster.accounts["chem"].users), {"larry"})
+
+        self.add_allocation(self.resource, "bio", ["ann", "bob", "carl"])
+        self.add_allocation(self.partition, "math", ["dave"])
+        with self.assertNumQueries(8):
+            cluster = SlurmCluster.new_from_resource(self.resource)
+
+        self.assertEqual(len(cluster.accounts), 4)
+        self.assertEqual(set(cluster.accounts["bio"].users), {"ann", "bob", "carl"})
+
+
+class AccountsChangedSinceTest(SlurmAllocationTestCase):
+    def test_changed_accounts(self):
+        physics = self.add_allocation(self.resource, "physics", ["jane"])
+        self.add_allocation(self.resource, "chem", ["larry"])
+        since = timezone.now()
+        self.assertEqual(slurm_accounts_changed_since(since), set())
+
+        AllocationUserFactory(allocation=physics, status=self.active, user__username="john")
+        self.assertEqual(slurm_accounts_changed_since(since), {"physics"})
+
+    def test_renamed_account_includes_old_name(self):
+        allocation = self.add_allocation(self.resource, "physics", ["jane"])
+        since = timezone.now()
+        attribute = allocation.allocationattribute_set.get(allocation_attribute_type=self.account_type)
+        attribute.value = "physics2"
+        attribute.save()
+        self.assertEqual(slurm_accounts_changed_since(since), {"physics", "physics2"})
+
+
+class SlurmCheckPlanTest(SlurmAllocationTestCase):
+    def test_plan_and_apply_plan(self):
+        self.add_allocation(self.resource, "physics", ["jane"])
+        dump = "\n".join(
+            [
+                "Cluster - 'hpc'",
+                "Parent - 'root'",
+                "User - 'root':DefaultAccount='root'",
+                "Account - 'physics'",
+                "Account - 'bio'",
+                "Parent - 'physics'",
+                "User - 'jane':QOS+=gpu",
+                "User - 'john'",
+                "Parent - 'bio'",
+                "User - 'ann'",
+            ]
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dump_file = os.path.join(tmpdir, "hpc.cfg")
+            plan_file = os.path.join(tmpdir, "plan.json")
+            with open(dump_file, "w") as fh:
+                fh.write(dump)
+
+            out = StringIO()
+            call_command("slurm_check", input=dump_file, plan=plan_file, stdout=out)
+            self.assertEqual(
+                out.getvalue().splitlines(),
+                [
+                    "john\tphysics\thpc\tRemove",
+                    "ann\tbio\thpc\tRemove",
+                    "\tbio\thpc\tRemove",
+                    "jane\tphysics\thpc\tRemove\tQOS-=gpu",
+                ],
+            )
+
+            with open(plan_file) as fh:
+                plan = json.load(fh)
+            self.assertEqual(plan["cluster"], "hpc")
+            self.assertEqual(
+                plan["modify"], [{"account": "physics", "user": "jane", "qos_add": [], "qos_remove": ["gpu"]}]
+            )
+
+            applied = StringIO()
+            call_command("slurm_check", apply_plan=plan_file, account="bio", stdout=applied)
+            self.assertEqual(applied.getvalue().splitlines(), ["ann\tbio\thpc\tRemove", "\tbio\thpc\tRemove"])
+
+
+class SlurmCheckIncrementalTest(SlurmAllocationTestCase):
+    def sacctmgr(self, cmd, noop=False):
+        if "Account=physics" in cmd:
+            return b"physics||\nphysics|jane|\nphysics|john|\n"
+        if "User=jane,john" in cmd and "list associations" in cmd:
+            return b"physics|jane|\nphysics|john|\nchem|john|\n"
+        if "User=jane,john" in cmd and "show user" in cmd:
+            return b"jane|physics\njohn|physics\n"
+        raise AssertionError("Unexpected sacctmgr command: {}".format(cmd))
+
+    def test_default_account_moved_in_batch(self):
+        since = timezone.now()
+        self.add_allocation(self.resource, "physics", ["jane"])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            plan_file = os.path.join(tmpdir, "plan.json")
+            with (
+                patch("coldfront.plugins.slurm.utils._run_slurm_cmd", self.sacctmgr),
+                self.assertLogs("coldfront.plugins.slurm.utils", "WARNING") as logs,
+            ):
+                call_command(
+                    "slurm_check",
+                    cluster="hpc",
+                    changed_since=since.isoformat(),
+                    sync=True,
+                    batch=True,
+                    noop=True,
+                    plan=plan_file,
+                    stdout=StringIO(),
+                )
+
+            with open(plan_file) as fh:
+                plan = json.load(fh)
+
+        self.assertEqual(plan["remove"], [{"account": "physics", "user": "john"}])
+        self.assertEqual(plan["default_account"], [{"user": "john", "account": "physics", "new_account": "chem"}])
+        self.assertEqual(
+            [r.getMessage() for r in logs.records],
+            [
+                "NOOP - Slurm batch cmd: modify user where name=john cluster=hpc set DefaultAccount=chem",
+                "NOOP - Slurm batch cmd: delete user where name=john cluster=hpc account=physics",
+            ],
+        )
+
+
+class SlurmCheckAllClustersTest(SlurmAllocationTestCase):
+    def test_all_clusters(self):
+        cluster_type = ResourceAttributeType.objects.get(name="slurm_cluster")
+        other = ResourceFactory(name="other", resource_type=ResourceTypeFactory(name="Cluster"))
+        ResourceAttribute.objects.create(resource=other, resource_attribute_type=cluster_type, value="other")
+        self.add_allocation(self.resource, "physics", ["jane"])
+
+        def dump(cluster, fname, noop=False):
+            with open(fname, "w") as fh:
+                fh.write("Cluster - '{}'\nParent - 'root'\nAccount - 'physics'\n".format(cluster))
+                fh.write("Parent - 'physics'\nUser - 'jane'\nUser - 'john'\n")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out = StringIO()
+            with patch("coldfront.plugins.slurm.management.commands.slurm_check.slurm_dump_cluster", dump):
+                call_command("slurm_check", all_clusters=True, output=tmpdir, workers=1, stdout=out)
+
+            summary = [line.split("\t")[:5] for line in out.getvalue().splitlines()]
+            self.assertEqual(summary, [["hpc", "1", "0", "0", "ok"], ["other", "3", "0", "0", "ok"]])
+            with open(os.path.join(tmpdir, "hpc.tsv")) as fh:
+                self.assertEqual(fh.read().splitlines(), ["john\tphysics\thpc\tRemove"])
+            with open(os.path.join(tmpdir, "other.json")) as fh:
+                self.assertEqual(json.load(fh)["cluster"], "other")
+
+
+class SlurmDumpTest(SlurmAllocationTestCase):
+    def test_dump_to_directory(self):
+        self.add_allocation(self.resource, "physics", ["jane", "john"])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out = StringIO()
+            call_command("slurm_dump", output=tmpdir, workers=1, stdout=out)
+            self.assertEqual(out.getvalue().split("\t")[:3], ["hpc", "1 accounts", "2 users"])
+            with open(os.path.join(tmpdir, "hpc.cfg")) as fh:
+                cluster = SlurmCluster.new_from_stream(fh)
+            self.assertEqual(set(cluster.accounts["physics"].users), {"jane", "john"})
+
+    def test_failed_cluster_exits_with_error(self):
+        self.add_allocation(self.resource, "physics", ["jane"])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out = StringIO()
+            with (
+                patch.object(SlurmCluster, "new_from_resource", side_effect=ValueError("boom")),
+                self.assertLogs("coldfront.plugins.slurm.management.commands.slurm_dump", "ERROR"),
+                self.assertRaises(SystemExit) as cm,
+            ):
+                call_command("slurm_dump", output=tmpdir, workers=1, stdout=out)
+
+        self.assertEqual(cm.exception.code, 1)
+        self.assertEqual(out.getvalue(), "")
+
+
+class NewFromAssociationsTest(SimpleTestCase):
+    def test_user_qos_relative_to_account(self):
+        lines = [
+            "physics||debug,normal",
+            "physics|jane|debug,normal,gpu",
+            "physics|john|debug,normal",
+            "chem||normal",
+        ]
+        cluster = SlurmCluster.new_from_associations("alpha", lines)
+        self.assertEqual(set(cluster.accounts), {"physics", "chem"})
+        self.assertEqual(cluster.accounts["physics"].users["jane"].spec_list(), ["QOS+=gpu"])
+        self.assertEqual(cluster.accounts["physics"].users["john"].spec_list(), [])
+        self.assertEqual(cluster.accounts["chem"].users, {})
+
+    def test_default_accounts(self):
+        lines = ["physics||", "physics|jane|", "chem|jane|"]
+        cluster = SlurmCluster.new_from_associations("alpha", lines, {"jane": "chem"})
+        self.assertEqual(cluster.accounts["physics"].users["jane"].spec_list(), ["DefaultAccount='chem'"])
+        self.assertEqual(cluster.accounts["chem"].users["jane"].spec_list(), ["DefaultAccount='chem'"])
+
+    def test_invalid_line(self):
+        with self.assertRaises(SlurmParserError):
+            SlurmCluster.new_from_associations("alpha", ["physics|jane"])
+
+
+def synthetic_dump(accounts, users_per_account):
+    """Generate lines of a sacctmgr dump with the given number of accounts and users per account"""
+    yield "# ColdFront synthetic dump"
+    yield "Cluster - 'alpha':DefaultQOS='general-compute':Fairshare=1:QOS='normal'"
+    yield "Parent - 'root'"
+    yield "User - 'root':DefaultAccount='root':AdminLevel='Administrator':Fairshare=1"
+    for a in range(accounts):
+        yield "Account - 'account{}':Description='account {}':Organization='org':Fairshare=100".format(a, a)
+    for a in range(accounts):
+        yield "Parent - 'account{}'".format(a)
+        for u in range(users_per_account):
+            yield "User - 'user{}':DefaultAccount='account{}':Fairshare=parent:QOS='+debug,+general-compute'".format(
+                (a * users_per_account + u) % 50000, a
+            )
+
+
+class SacctmgrParserTest(SimpleTestCase):
+    def test_parse_specs_and_names(self):
+        cluster = SlurmCluster.new_from_stream(synthetic_dump(3, 4))
+        self.assertEqual(cluster.name, "alpha")
+        self.assertEqual(set(cluster.specs), {"DefaultQOS='general-compute'", "Fairshare=1", "QOS='normal'"})
+        self.assertEqual(len(cluster.accounts), 4)
+        self.assertEqual(len(cluster.accounts["account2"].users), 4)
+        user = cluster.accounts["account0"].users["user0"]
+        self.assertEqual(
+            set(user.spec_list()), {"DefaultAccount='account0'", "Fairshare=parent", "QOS='+debug,+general-compute'"}
+        )
+
+    def test_spec_list_tracks_added_specs(self):
+        user = SlurmUser("jane", specs=["Fairshare=parent"])
+        self.assertEqual(user.spec_list(), ["Fairshare=parent"])
+        user.specs += ["QOS+=debug:MaxJobs=10"]
+        self.assertEqual(set(user.spec_list()), {"Fairshare=parent", "QOS+=debug", "MaxJobs=10"})
+
+    def test_user_names_are_interned(self):
+        dump = [
+            "Cluster - 'alpha'",
+            "Parent - 'root'",
+            "Account - 'a'",
+            "Account - 'b'",
+            "Parent - 'a'",
+            "User - 'jane'",
+            "Parent - 'b'",
+            "User - 'jane'",
+        ]
+        cluster = SlurmCluster.new_from_stream(line + "\n" for line in dump)
+        [name_a] = cluster.accounts["a"].users
+        [name_b] = cluster.accounts["b"].users
+        self.assertIs(name_a, name_b)
+
+    def test_invalid_lines(self):
+        with self.assertRaises(SlurmParserError):
+            SlurmCluster.new_from_stream(StringIO("# only comments\n"))
+        with self.assertRaises(SlurmParserError):
+            SlurmCluster.new_from_stream(StringIO("Cluster - 'alpha'\nUser - 'jane'\n"))
+        with self.assertRaises(SlurmParserError):
+            SlurmUser.new_from_sacctmgr("Account - 'physics'")
+
+    @runs_benchmarks()
+    def test_benchmark_parse_1m_lines(self):
+        start = time.perf_counter()
+        cluster = SlurmCluster.new_from_stream(synthetic_dump(10000, 99))
+        elapsed = time.perf_counter() - start
+
+        # Measure memory separately as tracing slows down parsing
+        tracemalloc.start()
+        SlurmCluster.new_from_stream(synthetic_dump(10000, 99))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        total = sum(len(a.users) for a in cluster.accounts.values())
+        logger.info("Parsed %s associations in %.2fs, peak memory %.1f MB", total, elapsed, peak / 2**20)
+        self.assertEqual(len(cluster.accounts), 10001)
+        self.assertLess(elapsed, 30)
+        self.assertLess(peak, 1024 * 2**20)
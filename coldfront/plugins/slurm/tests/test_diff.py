@@ -0,0 +1,123 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import logging
+import time
+from io import StringIO
+
+from django.test import SimpleTestCase
+
+from coldfront.core.test_helpers.decorators import runs_benchmarks
+from coldfront.plugins.slurm.associations import SlurmAccount, SlurmCluster, SlurmUser
+from coldfront.plugins.slurm.diff import SlurmPlan, diff_clusters, normalize_specs
+
+logger = logging.getLogger(__name__)
+
+
+def make_cluster(name, accounts):
+    """Build a SlurmCluster from a dict of account name to dict of user name
+    to list of specs"""
+    cluster = SlurmCluster(name)
+    for account_name, users in accounts.items():
+        account = SlurmAccount(account_name)
+        for uid, specs in users.items():
+            account.add_user(SlurmUser(uid, specs=list(specs)))
+        cluster.accounts[account_name] = account
+
+    return cluster
+
+
+class NormalizeSpecsTest(SimpleTestCase):
+    def test_qos_forms(self):
+        self.assertEqual(normalize_specs(frozenset(["QOS+='gpu,debug'"])), (frozenset(["gpu", "debug"]), None))
+        self.assertEqual(normalize_specs(frozenset(["QOS='+gpu,-debug'"])), (frozenset(["gpu"]), None))
+        self.assertEqual(
+            normalize_specs(frozenset(["DefaultAccount='physics'", "Fairshare=1"])), (frozenset(), "physics")
+        )
+
+
+class DiffClustersTest(SimpleTestCase):
+    def setUp(self):
+        self.slurm = make_cluster(
+            "alpha",
+            {
+                "root": {"root": []},
+                "physics": {
+                    "root": [],
+                    "jane": ["DefaultAccount='physics'", "QOS+='gpu,debug'"],
+                    "john": ["DefaultAccount='chem'"],
+                },
+                "chem": {"john": ["DefaultAccount='chem'"], "jane": []},
+                "bio": {"ann": []},
+            },
+        )
+        self.coldfront = make_cluster(
+            "alpha",
+            {
+                "physics": {"john": [], "mary": []},
+                "chem": {"jane": ["QOS+=debug"]},
+            },
+        )
+
+    def test_plan(self):
+        plan = diff_clusters(self.slurm, self.coldfront)
+        self.assertEqual(plan.cluster, "alpha")
+        self.assertEqual(
+            plan.remove,
+            [("physics", "jane"), ("chem", "john"), ("bio", "ann"), ("bio", "")],
+        )
+        self.assertEqual(plan.modify, [("chem", "jane", frozenset(["debug"]), frozenset())])
+        self.assertEqual(plan.add, [("physics", "mary", frozenset())])
+        self.assertEqual(plan.default_account, [("jane", "physics", "chem"), ("john", "chem", "physics")])
+
+    def test_account_without_remaining_users_is_removed(self):
+        self.coldfront.accounts["chem"].users.clear()
+        plan = diff_clusters(self.slurm, self.coldfront)
+        self.assertIn(("chem", ""), plan.remove)
+        self.assertIn(("chem", "jane"), plan.remove)
+
+    def test_scoped_to_accounts(self):
+        plan = diff_clusters(self.slurm, self.coldfront, accounts={"chem"})
+        self.assertEqual(plan.remove, [("chem", "john")])
+        self.assertEqual(plan.add, [])
+
+    def test_json_roundtrip(self):
+        plan = diff_clusters(self.slurm, self.coldfront)
+        out = StringIO()
+        plan.to_json(out)
+        out.seek(0)
+        loaded = SlurmPlan.from_json(out)
+        self.assertEqual(loaded.to_dict(), plan.to_dict())
+        self.assertEqual(loaded.modify, plan.modify)
+
+    def test_unsupported_version(self):
+        with self.assertRaises(ValueError):
+            SlurmPlan.from_dict({"version": 0, "cluster": "alpha"})
+
+    @runs_benchmarks()
+    def test_benchmark_diff_1m_associations(self):
+        accounts = {}
+        for i in range(10000):
+            accounts["account{}".format(i)] = {
+                "user{}".format(i * 100 + j): ["DefaultAccount='account{}'".format(i), "QOS+=normal"]
+                for j in range(100)
+            }
+        slurm = make_cluster("alpha", accounts)
+
+        # Drop one user from each account and change the QOS of another
+        for users in accounts.values():
+            uid = next(iter(users))
+            del users[uid]
+            users[next(iter(users))] = ["QOS+=gpu"]
+        coldfront = make_cluster("alpha", accounts)
+
+        start = time.perf_counter()
+        plan = diff_clusters(slurm, coldfront)
+        elapsed = time.perf_counter() - start
+
+        logger.info("Diffed 1000000 associations in %.2fs", elapsed)
+        self.assertLess(elapsed, 30)
+        self.assertEqual(len(plan.remove), 10000)
+        self.assertEqual(len(plan.modify), 10000)
+        self.assertEqual(len(plan.default_account), 0)
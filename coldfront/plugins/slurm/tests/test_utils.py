@@ -0,0 +1,143 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import subprocess
+import threading
+import time
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+
+from coldfront.plugins.slurm.utils import SLURM_CMD_BATCH_SINGLE, SlurmCommandBatch, slurm_map_clusters
+
+
+class SlurmCommandBatchTest(SimpleTestCase):
+    def setUp(self):
+        self.batch = SlurmCommandBatch()
+        self.batch.change_default_account("jane", "alpha", "chem")
+        self.batch.remove_assoc("jane", "alpha", "physics")
+        self.batch.remove_qos("john", "alpha", "physics", "QOS-=debug")
+        self.batch.remove_account("alpha", "physics")
+
+    @patch("coldfront.plugins.slurm.utils.subprocess.run")
+    def test_run_single_process(self, mock_run):
+        mock_run.return_value = subprocess.CompletedProcess(
+            [],
+            0,
+            stdout=(
+                b" Modified user associations...\n  C = alpha A = chem U = jane\n"
+                b" Deleting user associations...\n  C = alpha A = physics U = jane\n"
+                b" Modified user associations...\n  C = alpha A = physics U = john\n"
+                b" Deleting account(s)...\n  physics\n"
+            ),
+            stderr=b"",
+        )
+        results = self.batch.run()
+
+        mock_run.assert_called_once()
+        script = mock_run.call_args.kwargs["input"].decode("UTF-8")
+        self.assertEqual(
+            script.splitlines(),
+            [
+                "modify user where name=jane cluster=alpha set DefaultAccount=chem",
+                "delete user where name=jane cluster=alpha account=physics",
+                "modify user where name=john cluster=alpha account=physics set QOS-=debug",
+                "delete account where name=physics cluster=alpha",
+            ],
+        )
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(err is None for _, err in results))
+
+    @patch("coldfront.plugins.slurm.utils.subprocess.run")
+    def test_run_noop(self, mock_run):
+        results = self.batch.run(noop=True)
+
+        mock_run.assert_not_called()
+        self.assertEqual(len(results), 4)
+
+    @patch("coldfront.plugins.slurm.utils.subprocess.run")
+    def test_run_nothing_deleted_is_not_retried(self, mock_run):
+        mock_run.return_value = subprocess.CompletedProcess(
+            [],
+            1,
+            stdout=(
+                b" Modified user associations...\n  C = alpha A = chem U = jane\n"
+                b" Nothing deleted\n"
+                b" Modified user associations...\n  C = alpha A = physics U = john\n"
+                b" Deleting account(s)...\n  physics\n"
+            ),
+            stderr=b"",
+        )
+        results = self.batch.run()
+
+        mock_run.assert_called_once()
+        self.assertTrue(all(err is None for _, err in results))
+
+    def failing_run(self, batch_stdout):
+        """Return a subprocess.run replacement where the batch process prints
+        batch_stdout and the removal of jane from physics fails when run on
+        its own"""
+
+        def run(cmd, **kwargs):
+            if "input" in kwargs:
+                return subprocess.CompletedProcess(cmd, 1, stdout=batch_stdout, stderr=b" Error: Problem deleting")
+            if "name=jane cluster=alpha account=physics" in " ".join(cmd):
+                raise subprocess.CalledProcessError(1, cmd, output=b"", stderr=b" Error: Problem deleting")
+            return subprocess.CompletedProcess(cmd, 0, stdout=b"")
+
+        return run
+
+    @patch("coldfront.plugins.slurm.utils.subprocess.run")
+    def test_run_failing_middle_command(self, mock_run):
+        # sacctmgr goes on after the failing command, which prints no output,
+        # so the output of the commands after it would be off by one
+        mock_run.side_effect = self.failing_run(
+            b" Modified user associations...\n  C = alpha A = chem U = jane\n"
+            b" Modified user associations...\n  C = alpha A = physics U = john\n"
+            b" Deleting account(s)...\n  physics\n"
+        )
+        with self.assertLogs("coldfront.plugins.slurm.utils", "WARNING"):
+            results = self.batch.run()
+
+        # One batch process plus one run for each command
+        self.assertEqual(mock_run.call_count, 5)
+        self.assertEqual(mock_run.call_args_list[1].args[0][:4], SLURM_CMD_BATCH_SINGLE.split()[:3] + ["modify"])
+        self.assertEqual([cmd for cmd, _ in results], self.batch.commands)
+        errors = [cmd for cmd, err in results if err]
+        self.assertEqual(errors, ["delete user where name=jane cluster=alpha account=physics"])
+
+    @patch("coldfront.plugins.slurm.utils.subprocess.run")
+    def test_run_failure_stops_batch(self, mock_run):
+        mock_run.side_effect = self.failing_run(b" Modified user associations...\n  C = alpha A = chem U = jane\n")
+        with self.assertLogs("coldfront.plugins.slurm.utils", "WARNING"):
+            results = self.batch.run()
+
+        self.assertEqual(mock_run.call_count, 5)
+        errors = [cmd for cmd, err in results if err]
+        self.assertEqual(errors, ["delete user where name=jane cluster=alpha account=physics"])
+
+    def test_run_empty(self):
+        self.assertEqual(SlurmCommandBatch().run(), [])
+
+
+class SlurmMapClustersTest(SimpleTestCase):
+    def test_results_in_order_with_errors(self):
+        def check(cluster):
+            if cluster == "beta":
+                raise ValueError("boom")
+            time.sleep(0.05 if cluster == "alpha" else 0)
+            return cluster.upper()
+
+        results = slurm_map_clusters(check, ["alpha", "beta", "gamma"], max_workers=3)
+        self.assertEqual([(c, r) for c, r, _ in results], [("alpha", "ALPHA"), ("beta", None), ("gamma", "GAMMA")])
+        self.assertIsInstance(results[1][2], ValueError)
+
+    def test_runs_in_parallel(self):
+        barrier = threading.Barrier(3, timeout=5)
+        results = slurm_map_clusters(lambda c: barrier.wait() is not None, ["a", "b", "c"], max_workers=3)
+        self.assertEqual([r for _, r, _ in results], [True, True, True])
+
+    def test_single_worker_runs_inline(self):
+        results = slurm_map_clusters(lambda c: threading.current_thread(), ["a", "b"], max_workers=1)
+        self.assertEqual({r for _, r, _ in results}, {threading.current_thread()})
@@ -6,8 +6,11 @@ import csv
 import logging
 import shlex
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 
+from django.db import connections
+
 from coldfront.core.utils.common import import_from_settings
 
 SLURM_CLUSTER_ATTRIBUTE_NAME = import_from_settings("SLURM_CLUSTER_ATTRIBUTE_NAME", "slurm_cluster")
@@ -15,6 +18,7 @@ SLURM_ACCOUNT_ATTRIBUTE_NAME = import_from_settings("SLURM_ACCOUNT_ATTRIBUTE_NAM
 SLURM_SPECS_ATTRIBUTE_NAME = import_from_settings("SLURM_SPECS_ATTRIBUTE_NAME", "slurm_specs")
 SLURM_USER_SPECS_ATTRIBUTE_NAME = import_from_settings("SLURM_USER_SPECS_ATTRIBUTE_NAME", "slurm_user_specs")
 SLURM_SACCTMGR_PATH = import_from_settings("SLURM_SACCTMGR_PATH", "/usr/bin/sacctmgr")
+SLURM_MAX_WORKERS = import_from_settings("SLURM_MAX_WORKERS", 4)
 SLURM_CMD_REMOVE_USER = SLURM_SACCTMGR_PATH + " -Q -i delete user where name={} cluster={} account={}"
 SLURM_CMD_REMOVE_QOS = SLURM_SACCTMGR_PATH + " -Q -i modify user where name={} cluster={} account={} set {}"
 SLURM_CMD_REMOVE_ACCOUNT = SLURM_SACCTMGR_PATH + " -Q -i delete account where name={} cluster={}"
@@ -24,12 +28,29 @@ SLURM_CMD_CHECK_ASSOCIATION = (
     SLURM_SACCTMGR_PATH + " list associations User={} Cluster={} Account={} Format=Cluster,Account,User,QOS -P"
 )
 SLURM_CMD_LIST_ACCOUNTS = SLURM_SACCTMGR_PATH + " list associations User={} Cluster={} Format=Account -Pn"
+SLURM_CMD_LIST_ACCOUNT_ASSOCIATIONS = (
+    SLURM_SACCTMGR_PATH + " list associations Cluster={} Account={} Format=Account,User,QOS -Pn"
+)
+SLURM_CMD_LIST_USER_ASSOCIATIONS = (
+    SLURM_SACCTMGR_PATH + " list associations Cluster={} User={} Format=Account,User,QOS -Pn"
+)
+SLURM_CMD_LIST_DEFAULT_ACCOUNTS = SLURM_SACCTMGR_PATH + " show user User={} Cluster={} Format=User,DefaultAccount -Pn"
+# Maximum number of accounts or users to list in one sacctmgr command
+SLURM_LIST_ACCOUNTS_CHUNK_SIZE = 100
 SLURM_CMD_CHECK_DEFAULT_ACCOUNT = SLURM_SACCTMGR_PATH + " show user User={} Cluster={} Format=DefaultAccount -Pn"
 SLURM_CMD_CHANGE_DEFAULT_ACCOUNT = (
     SLURM_SACCTMGR_PATH + " -Q -i modify user User={} where Cluster={} set DefaultAccount={}"
 )
 SLURM_CMD_BLOCK_ACCOUNT = SLURM_SACCTMGR_PATH + " -Q -i modify account {} where Cluster={} set GrpSubmitJobs=0"
 SLURM_CMD_DUMP_CLUSTER = SLURM_SACCTMGR_PATH + " dump {} file={}"
+# Not quiet, as the output of each command is parsed to report per command
+# results
+SLURM_CMD_BATCH = SLURM_SACCTMGR_PATH + " -i"
+SLURM_CMD_BATCH_SINGLE = SLURM_SACCTMGR_PATH + " -Q -i {}"
+SLURM_BATCH_REMOVE_USER = "delete user where name={} cluster={} account={}"
+SLURM_BATCH_REMOVE_QOS = "modify user where name={} cluster={} account={} set {}"
+SLURM_BATCH_REMOVE_ACCOUNT = "delete account where name={} cluster={}"
+SLURM_BATCH_CHANGE_DEFAULT_ACCOUNT = "modify user where name={} cluster={} set DefaultAccount={}"
 
 logger = logging.getLogger(__name__)
 
@@ -148,6 +169,205 @@ def slurm_check_assoc(user, cluster, account):
     return False
 
 
+def _slurm_list_chunked(cmd, names):
+    """Run cmd, formatted with each chunk of comma separated names, and
+    return the lines of output of all chunks"""
+    names = sorted(names)
+    lines = []
+    for i in range(0, len(names), SLURM_LIST_ACCOUNTS_CHUNK_SIZE):
+        chunk = ",".join(names[i : i + SLURM_LIST_ACCOUNTS_CHUNK_SIZE])
+        output = _run_slurm_cmd(cmd(shlex.quote(chunk)), noop=False)
+        lines += output.decode("UTF-8").splitlines()
+
+    return lines
+
+
+def slurm_list_associations(cluster, accounts):
+    """Return the lines of sacctmgr list associations output (Account|User|QOS)
+    for the given accounts on cluster"""
+    return _slurm_list_chunked(
+        lambda chunk: SLURM_CMD_LIST_ACCOUNT_ASSOCIATIONS.format(shlex.quote(cluster), chunk), accounts
+    )
+
+
+def slurm_list_user_associations(cluster, users):
+    """Return the lines of sacctmgr list associations output (Account|User|QOS)
+    for all accounts of the given users on cluster"""
+    return _slurm_list_chunked(
+        lambda chunk: SLURM_CMD_LIST_USER_ASSOCIATIONS.format(shlex.quote(cluster), chunk), users
+    )
+
+
+def slurm_list_default_accounts(cluster, users):
+    """Return a dict mapping each of the given users on cluster to their
+    default account"""
+    lines = _slurm_list_chunked(
+        lambda chunk: SLURM_CMD_LIST_DEFAULT_ACCOUNTS.format(chunk, shlex.quote(cluster)), users
+    )
+    default_accounts = {}
+    for line in lines:
+        user, _, account = line.strip().partition("|")
+        if user and account:
+            default_accounts[user] = account
+
+    return default_accounts
+
+
 def slurm_dump_cluster(cluster, fname, noop=False):
     cmd = SLURM_CMD_DUMP_CLUSTER.format(shlex.quote(cluster), shlex.quote(fname))
     _run_slurm_cmd(cmd, noop=noop)
+
+
+def _run_in_thread(func, item):
+    try:
+        return func(item)
+    finally:
+        # Each thread has its own database connections
+        connections.close_all()
+
+
+def slurm_map_clusters(func, clusters, max_workers=None):
+    """Call func(cluster) for each cluster in a pool of at most max_workers
+    threads (SLURM_MAX_WORKERS by default) and return a list of (cluster,
+    result, error) tuples in the order of clusters. error is the exception
+    raised by func, if any. A single cluster or worker runs in the calling
+    thread."""
+    if max_workers is None:
+        max_workers = SLURM_MAX_WORKERS
+
+    clusters = list(clusters)
+    results = []
+    if max_workers <= 1 or len(clusters) <= 1:
+        for cluster in clusters:
+            try:
+                results.append((cluster, func(cluster), None))
+            except Exception as e:
+                results.append((cluster, None, e))
+        return results
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(clusters))) as executor:
+        futures = [executor.submit(_run_in_thread, func, cluster) for cluster in clusters]
+        for cluster, future in zip(clusters, futures):
+            try:
+                results.append((cluster, future.result(), None))
+            except Exception as e:
+                results.append((cluster, None, e))
+
+    return results
+
+
+class SlurmCommandBatch:
+    """Collects sacctmgr commands and runs them in one sacctmgr process
+    reading from stdin, instead of one sacctmgr process per command. With -i
+    each command is committed as soon as it runs, so a batch is not atomic:
+    commands before a failure stay applied."""
+
+    def __init__(self):
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def remove_assoc(self, user, cluster, account):
+        self.commands.append(
+            SLURM_BATCH_REMOVE_USER.format(shlex.quote(user), shlex.quote(cluster), shlex.quote(account))
+        )
+
+    def remove_qos(self, user, cluster, account, qos):
+        self.commands.append(
+            SLURM_BATCH_REMOVE_QOS.format(
+                shlex.quote(user), shlex.quote(cluster), shlex.quote(account), shlex.quote(qos)
+            )
+        )
+
+    def remove_account(self, cluster, account):
+        self.commands.append(SLURM_BATCH_REMOVE_ACCOUNT.format(shlex.quote(account), shlex.quote(cluster)))
+
+    def change_default_account(self, user, cluster, account):
+        self.commands.append(
+            SLURM_BATCH_CHANGE_DEFAULT_ACCOUNT.format(shlex.quote(user), shlex.quote(cluster), shlex.quote(account))
+        )
+
+    @staticmethod
+    def parse_output(output):
+        """Split sacctmgr output into the output of each command. Each
+        command prints a header line (e.g. ' Deleting users...' or ' Nothing
+        deleted') followed by the affected entities indented further."""
+        blocks = []
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            if line.startswith("  ") and blocks:
+                blocks[-1].append(line.strip())
+            else:
+                blocks.append([line.strip()])
+
+        return blocks
+
+    def run(self, noop=False):
+        """Run the collected commands in one sacctmgr process. Returns a list
+        of (command, error) tuples in the order the commands were added,
+        where error is None if the command succeeded.
+
+        The output of each command is parsed to get its result. Commands
+        that did nothing, e.g. deleting an association that no longer
+        exists, are not errors. A failing command prints its error on stderr
+        and no output, so the output can no longer be matched to the
+        commands. If anything is printed on stderr or the output does not
+        match the commands, the results are unknown and every command is
+        run again one at a time. The batched commands only remove
+        associations or set values, so running them twice is harmless."""
+        if len(self.commands) == 0:
+            return []
+
+        if noop:
+            for c in self.commands:
+                logger.warning("NOOP - Slurm batch cmd: %s", c)
+            return [(c, None) for c in self.commands]
+
+        script = "\n".join(self.commands) + "\n"
+        result = subprocess.run(
+            shlex.split(SLURM_CMD_BATCH),
+            input=script.encode("UTF-8"),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        stdout = result.stdout.decode("UTF-8", errors="replace")
+        stderr = result.stderr.decode("UTF-8", errors="replace").strip()
+        logger.debug("Slurm batch cmds: %s", self.commands)
+        logger.debug("Slurm batch output: %s", stdout)
+
+        blocks = self.parse_output(stdout)
+        if stderr or len(blocks) != len(self.commands):
+            logger.warning(
+                "Slurm batch results unknown (return_value=%s stderr=%s), running %s cmds one at a time",
+                result.returncode,
+                stderr,
+                len(self.commands),
+            )
+            return self._run_each(self.commands)
+
+        results = []
+        for c, block in zip(self.commands, blocks):
+            if block[0].startswith("Nothing"):
+                logger.warning("%s: %s", block[0], c)
+                results.append((c, None))
+            elif "error" in block[0].lower():
+                logger.error("Slurm batch cmd failed: %s: %s", c, " ".join(block))
+                results.append((c, " ".join(block)))
+            else:
+                results.append((c, None))
+
+        return results
+
+    def _run_each(self, commands):
+        results = []
+        for c in commands:
+            try:
+                _run_slurm_cmd(SLURM_CMD_BATCH_SINGLE.format(c), noop=False)
+            except SlurmError as e:
+                results.append((c, str(e)))
+            else:
+                results.append((c, None))
+
+        return results
@@ -0,0 +1,10 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+from coldfront.plugins.system_monitor.utils import refresh_system_monitor_data
+
+
+def refresh_system_monitor():
+    """Refresh the cached system monitor snapshot shown on the home page"""
+    refresh_system_monitor_data()
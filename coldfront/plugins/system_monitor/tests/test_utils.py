@@ -0,0 +1,271 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import datetime
+import io
+import json
+import logging
+import time
+import tracemalloc
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from django_q.models import Schedule
+
+from coldfront.core.test_helpers.decorators import runs_benchmarks
+from coldfront.plugins.system_monitor import utils
+from coldfront.plugins.system_monitor.utils import SystemMonitor, SystemMonitorTableParser, get_system_monitor_context
+
+logger = logging.getLogger(__name__)
+
+STATUS_PAGE = """<html><body>
+<div>Last updated: Mon Oct 10 10:00:00</div>
+<table>
+  <tr><th>Processors Utilized</th><th>Nodes</th></tr>
+  <tr><td>750 of 1000</td><td>20</td></tr>
+</table>
+<table>
+  <tr><th>Partition</th><th>Running</th><th>Queued</th></tr>
+  <tr><td>debug</td><td>1 jobs</td><td>2 jobs</td></tr>
+  <tr><td></td><td><b>10</b> jobs</td><td>5 jobs</td></tr>
+</table>
+{}
+</body></html>"""
+
+NODE_ROW = "<tr><td>node{0}</td><td>allocated</td><td>{0}</td></tr>"
+
+
+def status_page(nodes=0):
+    """Return a status page with a node usage table of the given size"""
+    rows = "".join(NODE_ROW.format(i) for i in range(nodes))
+    extra = (
+        "<table><tr><th>Cores</th></tr></table>"
+        "<table><tr><th>Node</th><th>State</th><th>Cores</th></tr>{}</table>".format(rows)
+    )
+    return STATUS_PAGE.format(extra)
+
+
+def status_json(nodes=0):
+    """Return the JSON equivalent of status_page(nodes)"""
+    return json.dumps(
+        {
+            "last_updated": "Mon Oct 10 10:00:00",
+            "tables": {
+                "utilization": [{"Processors Utilized": "750 of 1000", "Nodes": "20"}],
+                "jobs": [
+                    {"Partition": "debug", "Running": "1 jobs", "Queued": "2 jobs"},
+                    {"Partition": "", "Running": "10 jobs", "Queued": "5 jobs"},
+                ],
+                "core_usage": [],
+                "node_usage": [{"Node": "node{}".format(i), "State": "allocated", "Cores": i} for i in range(nodes)],
+            },
+        }
+    )
+
+
+def system_monitor(parser, text):
+    response = mock.Mock(status_code=200, text=text)
+    response.json.side_effect = lambda: json.loads(text)
+    with (
+        override_settings(
+            SYSTEM_MONITOR_ENDPOINT="https://localhost/status",
+            SYSTEM_MONITOR_PANEL_TITLE="HPC Cluster Status",
+            SYSTEM_MONITOR_RESPONSE_PARSER=parser,
+        ),
+        mock.patch("coldfront.plugins.system_monitor.utils.requests.get", return_value=response),
+    ):
+        return SystemMonitor()
+
+
+@override_settings(SYSTEM_MONITOR_PANEL_TITLE="HPC Cluster Status")
+class SystemMonitorParserTest(SimpleTestCase):
+    def assert_status_data(self, data):
+        self.assertEqual(data["last_updated"], "Mon Oct 10 10:00:00")
+        self.assertEqual(
+            data["utilization_data"]["columns"],
+            [["Processors Utilized: 750 (75.0%)", 750], ["Processors Free: 250 (25.0%)", 250]],
+        )
+        self.assertEqual(data["jobs_data"]["columns"], [["Running: 10 jobs", 10], ["Queued: 5 jobs", 5]])
+
+    def test_beautiful_soup(self):
+        self.assert_status_data(system_monitor("parse_html_using_beautiful_soup", status_page(10)).get_data())
+
+    def test_html_parser(self):
+        self.assert_status_data(system_monitor("parse_html_using_html_parser", status_page(10)).get_data())
+
+    def test_parsers_agree(self):
+        text = status_page(100)
+        self.assertEqual(
+            system_monitor("parse_html_using_beautiful_soup", text).get_data(),
+            system_monitor("parse_html_using_html_parser", text).get_data(),
+        )
+
+    def test_json(self):
+        self.assert_status_data(system_monitor("parse_json", status_json(10)).get_data())
+
+    def test_missing_data(self):
+        with mock.patch.object(utils.logger, "exception") as exception:
+            self.assertEqual(system_monitor("parse_html_using_html_parser", "<html></html>").get_data(), {})
+            self.assertEqual(system_monitor("parse_json", "{}").get_data(), {})
+        self.assertEqual(
+            [c.args[0] for c in exception.call_args_list],
+            ["Error in parsing Table. Maybe data is missing", "Error in parsing JSON response"],
+        )
+
+    def test_html_parser_last_updated_only_in_div(self):
+        parser = SystemMonitorTableParser()
+        parser.feed("<div><span>Last updated: Mon Oct 10 10:00:00</span></div><p>Last updated: Tue Oct 11</p>")
+        self.assertEqual(parser.last_updated, "Mon Oct 10 10:00:00")
+
+        parser = SystemMonitorTableParser()
+        parser.feed("<div><div></div>Last updated: Mon Oct 10 10:00:00</div>")
+        self.assertEqual(parser.last_updated, "Mon Oct 10 10:00:00")
+
+    def test_html_parser_omitted_end_tags(self):
+        parser = SystemMonitorTableParser()
+        parser.feed(
+            "<table><tr><th>Partition<th>Running<th>Queued"
+            "<tr><td>debug<td>1 jobs<td>2 jobs"
+            "<tr><td><td><b>10</b> jobs<td>5 jobs</table>"
+            "<table><tbody><tr><th>Node<th>State</tbody></table>"
+        )
+        self.assertEqual(
+            parser.tables,
+            [
+                [["Partition", "Running", "Queued"], ["debug", "1 jobs", "2 jobs"], ["", "10 jobs", "5 jobs"]],
+                [["Node", "State"]],
+            ],
+        )
+
+        text = STATUS_PAGE.format("").replace("</td>", "").replace("</th>", "").replace("</tr>", "")
+        self.assert_status_data(system_monitor("parse_html_using_html_parser", text).get_data())
+
+    @runs_benchmarks()
+    def test_benchmark_parse_large_status_page(self):
+        pages = {
+            "parse_html_using_beautiful_soup": status_page(10000),
+            "parse_html_using_html_parser": status_page(10000),
+            "parse_json": status_json(10000),
+        }
+        for parser, text in pages.items():
+            monitor = system_monitor(parser, text)
+
+            start = time.perf_counter()
+            data = monitor.get_data()
+            elapsed = time.perf_counter() - start
+
+            # Measure memory separately as tracing slows down parsing
+            tracemalloc.start()
+            monitor.get_data()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            logger.info(
+                "%s: %.1f MB page parsed in %.2fs, peak memory %.1f MB",
+                parser,
+                len(text) / 2**20,
+                elapsed,
+                peak / 2**20,
+            )
+            self.assert_status_data(data)
+            self.assertLess(elapsed, 30)
+
+
+@override_settings(SYSTEM_MONITOR_PANEL_TITLE="HPC Cluster Status")
+class GetSystemMonitorContextTest(SimpleTestCase):
+    def setUp(self):
+        self.cache = caches[utils.SYSTEM_MONITOR_CACHE]
+        self.cache.clear()
+        self.addCleanup(self.cache.clear)
+        patcher = mock.patch.object(utils, "SystemMonitor")
+        self.system_monitor = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def set_snapshot(self, last_updated, age):
+        snapshot = {
+            "data": {"last_updated": last_updated, "utilization_data": {}, "jobs_data": {}},
+            "fetched": timezone.now() - datetime.timedelta(seconds=age),
+        }
+        self.cache.set(utils.SYSTEM_MONITOR_CACHE_KEY, snapshot)
+
+    def test_fresh_snapshot(self):
+        self.set_snapshot("Mon Oct 10 10:00:00", 60)
+
+        context = get_system_monitor_context()
+
+        self.system_monitor.assert_not_called()
+        self.assertEqual(context["last_updated"], "Mon Oct 10 10:00:00")
+        self.assertFalse(context["system_monitor_stale"])
+        self.assertEqual(context["system_monitor_panel_title"], "HPC Cluster Status")
+
+    def test_stale_snapshot(self):
+        self.set_snapshot("Mon Oct 10 10:00:00", utils.SYSTEM_MONITOR_STALE_AFTER + 60)
+
+        context = get_system_monitor_context()
+
+        self.system_monitor.assert_not_called()
+        self.assertEqual(context["last_updated"], "Mon Oct 10 10:00:00")
+        self.assertTrue(context["system_monitor_stale"])
+
+    def test_missing_snapshot(self):
+        self.system_monitor.return_value.get_data.return_value = {"last_updated": "Mon Oct 10 11:00:00"}
+
+        context = get_system_monitor_context()
+
+        self.system_monitor.assert_called_once()
+        self.assertEqual(context["last_updated"], "Mon Oct 10 11:00:00")
+        self.assertFalse(context["system_monitor_stale"])
+        self.assertIsNotNone(self.cache.get(utils.SYSTEM_MONITOR_CACHE_KEY))
+
+    def test_missing_snapshot_and_fetch_fails(self):
+        self.system_monitor.return_value.get_data.return_value = {}
+
+        context = get_system_monitor_context()
+
+        self.assertIsNone(context["last_updated"])
+        self.assertIsNone(context["utilization_data"])
+        self.assertFalse(context["system_monitor_stale"])
+
+    def test_failed_refresh_keeps_previous_snapshot(self):
+        self.set_snapshot("Mon Oct 10 10:00:00", utils.SYSTEM_MONITOR_STALE_AFTER + 60)
+        self.system_monitor.return_value.get_data.return_value = {}
+
+        with mock.patch.object(utils.logger, "warning") as warning:
+            self.assertIsNone(utils.refresh_system_monitor_data())
+        warning.assert_called_once()
+
+        context = get_system_monitor_context()
+        self.assertEqual(context["last_updated"], "Mon Oct 10 10:00:00")
+        self.assertTrue(context["system_monitor_stale"])
+
+
+@skipUnless("coldfront.plugins.system_monitor" in settings.INSTALLED_APPS, "system_monitor plugin not enabled")
+class ScheduleRefreshTest(TestCase):
+    FUNC = "coldfront.plugins.system_monitor.tasks.refresh_system_monitor"
+
+    def add_scheduled_tasks(self, cache):
+        with mock.patch("coldfront.core.utils.management.commands.add_scheduled_tasks.caches", {"default": cache}):
+            call_command("add_scheduled_tasks", stderr=self.stderr)
+
+    def setUp(self):
+        self.stderr = io.StringIO()
+
+    def test_scheduled_once(self):
+        cache = mock.Mock()
+        self.add_scheduled_tasks(cache)
+        self.add_scheduled_tasks(cache)
+
+        self.assertEqual(Schedule.objects.filter(func=self.FUNC).count(), 1)
+        self.assertEqual(self.stderr.getvalue(), "")
+
+    def test_not_scheduled_with_local_memory_cache(self):
+        self.add_scheduled_tasks(LocMemCache("system-monitor-tests", {}))
+
+        self.assertFalse(Schedule.objects.filter(func=self.FUNC).exists())
+        self.assertIn("SYSTEM_MONITOR_CACHE", self.stderr.getvalue())
@@ -2,32 +2,137 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import datetime
+import logging
 import re
+from html.parser import HTMLParser
 
 import requests
 from bs4 import BeautifulSoup
+from django.core.cache import caches
+from django.utils import timezone
 
 from coldfront.core.utils.common import import_from_settings
 
+SYSTEM_MONITOR_CACHE = import_from_settings("SYSTEM_MONITOR_CACHE", "default")
+SYSTEM_MONITOR_STALE_AFTER = import_from_settings("SYSTEM_MONITOR_STALE_AFTER", 900)
+
+SYSTEM_MONITOR_CACHE_KEY = "coldfront.system_monitor.snapshot"
+
+logger = logging.getLogger(__name__)
+
+
+def refresh_system_monitor_data(timeout=None):
+    """Fetch and parse the system monitor endpoint and store the result in
+    the cache as a snapshot dict with the parsed data and when it was
+    fetched. A failed fetch keeps the previous snapshot, if any. The
+    snapshot is kept for timeout seconds, or until replaced if None."""
+    cache = caches[SYSTEM_MONITOR_CACHE]
+    data = SystemMonitor().get_data()
+    if not data and cache.get(SYSTEM_MONITOR_CACHE_KEY) is not None:
+        logger.warning("Failed to refresh system monitor data, keeping previous snapshot")
+        return None
+
+    snapshot = {"data": data, "fetched": timezone.now()}
+    cache.set(SYSTEM_MONITOR_CACHE_KEY, snapshot, timeout)
+    return snapshot
+
 
 def get_system_monitor_context():
+    """Return the context of the system monitor panel from the cached
+    snapshot, which is kept up to date by the refresh_system_monitor task.
+    Only if there is no snapshot at all is the endpoint fetched inline, and
+    that snapshot expires after SYSTEM_MONITOR_STALE_AFTER seconds."""
     context = {}
-    system_monitor = SystemMonitor()
-    system_monitor_data = system_monitor.get_data()
-    system_monitor_panel_title = system_monitor.get_panel_title()
+    snapshot = caches[SYSTEM_MONITOR_CACHE].get(SYSTEM_MONITOR_CACHE_KEY)
+    if snapshot is None:
+        snapshot = refresh_system_monitor_data(timeout=SYSTEM_MONITOR_STALE_AFTER)
+
+    system_monitor_data = snapshot["data"] if snapshot else {}
+    stale_before = timezone.now() - datetime.timedelta(seconds=SYSTEM_MONITOR_STALE_AFTER)
 
     context["last_updated"] = system_monitor_data.get("last_updated")
     context["utilization_data"] = system_monitor_data.get("utilization_data")
     context["jobs_data"] = system_monitor_data.get("jobs_data")
-    context["system_monitor_panel_title"] = system_monitor_panel_title
+    context["system_monitor_stale"] = bool(snapshot) and snapshot["fetched"] < stale_before
+    context["system_monitor_panel_title"] = import_from_settings("SYSTEM_MONITOR_PANEL_TITLE")
 
     return context
 
 
+class SystemMonitorTableParser(HTMLParser):
+    """Incremental parser that extracts the text of the cells of each table
+    row and the "Last updated" time of a status page as it is fed, without
+    building a document tree."""
+
+    LAST_UPDATED_PATTERN = re.compile(r"Last updated: (?P<time>[A-Za-z\t :\d.]+)")
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.tables = []
+        self.last_updated = None
+        self._div_depth = 0
+        self._row = None
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        # End tags of cells and rows may be omitted, so a new cell or row
+        # also ends the open one
+        if tag == "div":
+            self._div_depth += 1
+        elif tag == "table":
+            self.tables.append([])
+        elif tag in ("thead", "tbody", "tfoot"):
+            self._end_row()
+        elif tag == "tr" and self.tables:
+            self._end_row()
+            self._row = []
+        elif tag in ("td", "th") and self._row is not None:
+            self._end_cell()
+            self._cell = []
+
+    def handle_endtag(self, tag):
+        if tag == "div" and self._div_depth:
+            self._div_depth -= 1
+        elif tag in ("td", "th"):
+            self._end_cell()
+        elif tag in ("tr", "thead", "tbody", "tfoot", "table"):
+            self._end_row()
+
+    def _end_cell(self):
+        if self._cell is not None:
+            self._row.append("".join(self._cell).strip())
+            self._cell = None
+
+    def _end_row(self):
+        self._end_cell()
+        if self._row is not None:
+            self.tables[-1].append(self._row)
+            self._row = None
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+        elif self._div_depth:
+            m = self.LAST_UPDATED_PATTERN.search(data)
+            if m:
+                self.last_updated = m.group("time")
+
+
 class SystemMonitor:
-    """If anything fails, the home page will still work"""
+    """If anything fails, the home page will still work.
+
+    The response is parsed by the method named in SYSTEM_MONITOR_RESPONSE_PARSER:
+
+        parse_html_using_beautiful_soup: HTML status page, parsed into a tree
+        parse_html_using_html_parser: HTML status page, parsed incrementally
+        parse_json: JSON document of the form
+            {"last_updated": "...", "tables": {"utilization": [...], "jobs": [...]}}
+            where each table is a list of rows mapping column name to value
+    """
 
     RESPONSE_PARSER_FUNCTION = "parse_html_using_beautiful_soup"
+    TABLE_NAMES = ["utilization", "jobs", "core_usage", "node_usage"]
     primary_color = "#002f56"
     info_color = "#2f9fd0"
     secondary_color = "#666666"
@@ -37,7 +142,9 @@ class SystemMonitor:
         self.SYSTEM_MONITOR_PANEL_TITLE = import_from_settings("SYSTEM_MONITOR_PANEL_TITLE")
         self.response = None
         self.data = {}
-        self.parse_function = getattr(self, self.RESPONSE_PARSER_FUNCTION)
+        self.parse_function = getattr(
+            self, import_from_settings("SYSTEM_MONITOR_RESPONSE_PARSER", self.RESPONSE_PARSER_FUNCTION)
+        )
         self.fetch_data()
 
     def fetch_data(self):
@@ -53,39 +160,58 @@ class SystemMonitor:
         try:
             soup = BeautifulSoup(self.response.text, "html.parser")
         except Exception:
-            print("Error in parsing HTML response")
+            logger.exception("Error in parsing HTML response")
             return
 
         pattern = re.compile(r"Last updated: (?P<time>[A-Za-z\t :\d.]+)")
 
+        last_updated = None
         for elm in soup.find_all("div", text=pattern):
             last_updated = pattern.search(elm.text).groups()[0]
 
-        tables = soup.findAll("table")
         tables_dict = {}
-        table_names = ["utilization", "jobs", "core_usage", "node_usage"]
-
-        for table_idx, table in enumerate(tables):
-            rows = table.find_all("tr")
-            table_content = []
-            for idx, tr in enumerate(rows, 1):
-                if idx == 1:
-                    header = str(tr)
-                    header = header.replace("<tr>", "")
-                    header = header.replace("</tr>", "")
-                    header = header.replace("<th>", "")
-                    header = header.replace("</th>", ",")
-                    header = [ele.strip() for ele in header.split(",")]
-                else:
-                    table_data = str(tr)
-                    table_data = table_data.replace("<tr>", "")
-                    table_data = table_data.replace("</tr>", "")
-                    table_data = table_data.replace("<td>", "")
-                    table_data = table_data.replace("</td>", ",")
-                    table_data = [ele.strip() for ele in table_data.split(",")]
-
-                    table_content.append(dict(zip(header, table_data)))
-            tables_dict[table_names[table_idx]] = table_content
+        for name, table in zip(self.TABLE_NAMES, soup.find_all("table")):
+            rows = [[cell.get_text().strip() for cell in tr.find_all(["th", "td"])] for tr in table.find_all("tr")]
+            tables_dict[name] = self._rows_to_dicts(rows)
+
+        self._set_data(tables_dict, last_updated)
+
+    def parse_html_using_html_parser(self):
+        parser = SystemMonitorTableParser()
+        try:
+            parser.feed(self.response.text)
+            parser.close()
+        except Exception:
+            logger.exception("Error in parsing HTML response")
+            return
+
+        tables_dict = {}
+        for name, rows in zip(self.TABLE_NAMES, parser.tables):
+            tables_dict[name] = self._rows_to_dicts(rows)
+
+        self._set_data(tables_dict, parser.last_updated)
+
+    def parse_json(self):
+        try:
+            data = self.response.json()
+            tables_dict = data["tables"]
+            last_updated = data["last_updated"]
+        except Exception:
+            logger.exception("Error in parsing JSON response")
+            return
+
+        self._set_data(tables_dict, last_updated)
+
+    def _rows_to_dicts(self, rows):
+        """Convert the rows of a table, the first being the header, into a
+        list of dicts mapping column name to value"""
+        if not rows:
+            return []
+
+        header = rows[0]
+        return [dict(zip(header, row)) for row in rows[1:]]
+
+    def _set_data(self, tables_dict, last_updated):
         try:
             processors_utilized = [
                 int(ele.strip()) for ele in tables_dict["utilization"][0]["Processors Utilized"].split("of")
@@ -108,7 +234,7 @@ class SystemMonitor:
             running_value = job_numbers[0]
             queued_value = job_numbers[1]
         except Exception:
-            print("Error in parsing Table. Maybe data is missing")
+            logger.exception("Error in parsing Table. Maybe data is missing")
             return
 
         utilization_data = {
@@ -2,31 +2,43 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import functools
 import logging
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 from django.core.management.base import BaseCommand
 from django.db.models import Q
 
 from coldfront.core.allocation.models import Allocation
+from coldfront.core.allocation.utils import BULK_USAGE_BATCH_SIZE, bulk_set_usage
 from coldfront.plugins.xdmod.utils import (
     XDMOD_ACC_HOURS_ATTRIBUTE_NAME,
     XDMOD_ACCOUNT_ATTRIBUTE_NAME,
     XDMOD_CLOUD_CORE_TIME_ATTRIBUTE_NAME,
     XDMOD_CLOUD_PROJECT_ATTRIBUTE_NAME,
     XDMOD_CPU_HOURS_ATTRIBUTE_NAME,
+    XDMOD_MAX_WORKERS,
     XDMOD_RESOURCE_ATTRIBUTE_NAME,
     XDMOD_STORAGE_ATTRIBUTE_NAME,
     XDMOD_STORAGE_GROUP_ATTRIBUTE_NAME,
+    XdmodClient,
+    XdmodError,
     XdmodNotFoundError,
-    xdmod_fetch_cloud_core_time,
-    xdmod_fetch_total_cpu_hours,
-    xdmod_fetch_total_storage,
 )
 
 logger = logging.getLogger(__name__)
 
+# Prefetch everything the get_attribute() lookups below read so each
+# allocation is processed without issuing additional queries
+ALLOCATION_PREFETCH = [
+    "project__pi",
+    "allocationattribute_set__allocation_attribute_type__attribute_type",
+    "resources__resourceattribute_set__resource_attribute_type__attribute_type",
+    "resources__parent_resource__resourceattribute_set__resource_attribute_type__attribute_type",
+]
+
 
 class Command(BaseCommand):
     help = "Sync usage data from XDMoD to ColdFront"
@@ -42,6 +54,19 @@ class Command(BaseCommand):
         parser.add_argument("-x", "--header", help="Include header in output", action="store_true")
         parser.add_argument("-m", "--statistic", help="XDMoD statistic (default total_cpu_hours)", required=True)
         parser.add_argument("--expired", help="XDMoD statistic for archived projects", action="store_true")
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            default=XDMOD_MAX_WORKERS,
+            help="Number of XDMoD requests to run in parallel (default %(default)s)",
+        )
+        parser.add_argument(
+            "-b",
+            "--bulk",
+            help="Fetch usage of all accounts grouped in one request per resource and date range",
+            action="store_true",
+        )
 
     def write(self, data):
         try:
@@ -51,6 +76,137 @@ class Command(BaseCommand):
             os.dup2(devnull, sys.stdout.fileno())
             sys.exit(1)
 
+    def get_resources(self, s):
+        """Return the XDMoD resource names of the resources of an allocation"""
+        resources = []
+        for r in s.resources.all():
+            rname = r.get_attribute(XDMOD_RESOURCE_ATTRIBUTE_NAME)
+            if not rname and r.parent_resource:
+                rname = r.parent_resource.get_attribute(XDMOD_RESOURCE_ATTRIBUTE_NAME)
+
+            if not rname:
+                continue
+
+            if self.filter_resource and self.filter_resource != rname:
+                continue
+
+            resources.append(rname)
+
+        return resources
+
+    def set_usage(self, allocation_id, name, usage):
+        """Queue the usage of an allocation attribute to be written, writing
+        the queue once it holds BULK_USAGE_BATCH_SIZE usages so usage fetched
+        so far is kept if a later request fails"""
+        self.usages.append((allocation_id, name, usage))
+        if len(self.usages) >= BULK_USAGE_BATCH_SIZE:
+            self.flush_usage()
+
+    def flush_usage(self):
+        """Write the queued usages in a single transaction"""
+        if not self.usages:
+            return
+
+        self.usages_changed += bulk_set_usage(self.usages)
+        self.usages_synced += len(self.usages)
+        self.usages = []
+
+    def map(self, func, items):
+        """Map func over items, running up to self.workers at a time. Returns
+        the executor, if any, and an iterator over the results in order."""
+        if self.workers > 1 and len(items) > 1:
+            executor = ThreadPoolExecutor(max_workers=self.workers)
+            return executor, executor.map(func, items)
+
+        return None, map(func, items)
+
+    def fetch_grouped_usage(self, jobs, fetch_grouped, label):
+        """Fetch the usage of jobs with one fetch_grouped(start, end,
+        resources=resources) request per distinct set of resources and date
+        range, returning an iterator over the usage of each job in order,
+        None for jobs XDMoD has no data for or whose request failed"""
+        groups = {}
+        for s, _, _, resources in jobs:
+            groups.setdefault((tuple(sorted(resources)), s.start_date, s.end_date), None)
+
+        def run(key):
+            resources, start, end = key
+            try:
+                return fetch_grouped(start, end, resources=list(resources))
+            except XdmodNotFoundError:
+                return {}
+            except XdmodError as e:
+                logger.error(
+                    "Failed to fetch grouped usage from XDMoD for resources %s from %s to %s: %s",
+                    list(resources),
+                    start,
+                    end,
+                    e,
+                )
+                return None
+
+        keys = list(groups)
+        executor, results = self.map(run, keys)
+        try:
+            for key, values in zip(keys, results):
+                groups[key] = values
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        logger.info("Fetched usage of %s allocations in %s grouped requests", len(jobs), len(groups))
+        for s, name, _, resources in jobs:
+            values = groups[(tuple(sorted(resources)), s.start_date, s.end_date)]
+            if values is None:
+                yield None
+                continue
+
+            usage = values.get(name)
+            if usage is None:
+                logger.warning("No data in XDMoD found for allocation %s %s %s resources %s", s, label, name, resources)
+            yield usage
+
+    def fetch_usage(self, jobs, fetch, label, fetch_grouped=None):
+        """Fetch the usage of each (allocation, name, max_value, resources)
+        in jobs with fetch(start, end, name, resources=resources), running up
+        to self.workers requests at a time. With --bulk, fetch_grouped is
+        used instead to fetch the usage of all accounts at once. Yields the
+        job with the usage appended, in order, skipping allocations XDMoD has
+        no data for or whose request failed."""
+
+        def run(job):
+            s, name, _, resources = job
+            try:
+                return fetch(s.start_date, s.end_date, name, resources=resources)
+            except XdmodNotFoundError:
+                logger.warning("No data in XDMoD found for allocation %s %s %s resources %s", s, label, name, resources)
+            except XdmodError as e:
+                logger.error(
+                    "Failed to fetch usage from XDMoD for allocation %s %s %s resources %s: %s",
+                    s,
+                    label,
+                    name,
+                    resources,
+                    e,
+                )
+
+            return None
+
+        if self.bulk and fetch_grouped is not None:
+            executor, results = None, self.fetch_grouped_usage(jobs, fetch_grouped, label)
+        else:
+            executor, results = self.map(run, jobs)
+
+        try:
+            for job, usage in zip(jobs, results):
+                if usage is None:
+                    continue
+
+                yield (*job, usage)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
     def process_total_storage(self):
         header = [
             "allocation_id",
@@ -64,9 +220,7 @@ class Command(BaseCommand):
         if self.print_header:
             self.write("\t".join(header))
 
-        allocations = Allocation.objects.prefetch_related(
-            "project", "resources", "allocationattribute_set", "allocationuser_set"
-        ).filter(
+        allocations = Allocation.objects.prefetch_related(*ALLOCATION_PREFETCH).filter(
             allocationattribute__allocation_attribute_type__name__in=[
                 XDMOD_STORAGE_GROUP_ATTRIBUTE_NAME,
                 XDMOD_STORAGE_ATTRIBUTE_NAME,
@@ -91,6 +245,7 @@ class Command(BaseCommand):
                 & Q(allocationattribute__value=self.filter_account)
             )
 
+        jobs = []
         for s in allocations.distinct():
             account_name = s.get_attribute(XDMOD_STORAGE_GROUP_ATTRIBUTE_NAME)
             if not account_name:
@@ -102,19 +257,7 @@ class Command(BaseCommand):
                 logger.warning("%s attribute not found for allocation: %s", XDMOD_STORAGE_ATTRIBUTE_NAME, s)
                 continue
 
-            resources = []
-            for r in s.resources.all():
-                rname = r.get_attribute(XDMOD_RESOURCE_ATTRIBUTE_NAME)
-                if not rname and r.parent_resource:
-                    rname = r.parent_resource.get_attribute(XDMOD_RESOURCE_ATTRIBUTE_NAME)
-
-                if not rname:
-                    continue
-
-                if self.filter_resource and self.filter_resource != rname:
-                    continue
-
-                resources.append(rname)
+            resources = self.get_resources(s)
 
             if len(resources) == 0:
                 logger.warning(
@@ -122,16 +265,11 @@ class Command(BaseCommand):
                 )
                 continue
 
-            try:
-                usage = xdmod_fetch_total_storage(
-                    s.start_date, s.end_date, account_name, resources=resources, statistics="avg_physical_usage"
-                )
-            except XdmodNotFoundError:
-                logger.warning(
-                    "No data in XDMoD found for allocation %s account %s resources %s", s, account_name, resources
-                )
-                continue
+            jobs.append((s, account_name, cpu_hours, resources))
 
+        fetch = functools.partial(self.client.fetch_total_storage, statistics="avg_physical_usage")
+        fetch_grouped = functools.partial(self.client.fetch_total_storage_by_account, statistics="avg_physical_usage")
+        for s, account_name, cpu_hours, resources, usage in self.fetch_usage(jobs, fetch, "account", fetch_grouped):
             logger.warning(
                 "Total GB = %s for allocation %s account %s GB %s resources %s",
                 usage,
@@ -141,7 +279,7 @@ class Command(BaseCommand):
                 resources,
             )
             if self.sync:
-                s.set_usage(XDMOD_STORAGE_ATTRIBUTE_NAME, usage)
+                self.set_usage(s.id, XDMOD_STORAGE_ATTRIBUTE_NAME, usage)
 
             self.write(
                 "\t".join(
@@ -169,9 +307,7 @@ class Command(BaseCommand):
         if self.print_header:
             self.write("\t".join(header))
 
-        allocations = Allocation.objects.prefetch_related(
-            "project", "resources", "allocationattribute_set", "allocationuser_set"
-        ).filter(
+        allocations = Allocation.objects.prefetch_related(*ALLOCATION_PREFETCH).filter(
             allocationattribute__allocation_attribute_type__name__in=[
                 XDMOD_ACCOUNT_ATTRIBUTE_NAME,
                 XDMOD_ACC_HOURS_ATTRIBUTE_NAME,
@@ -196,6 +332,7 @@ class Command(BaseCommand):
                 & Q(allocationattribute__value=self.filter_account)
             )
 
+        jobs = []
         for s in allocations.distinct():
             account_name = s.get_attribute(XDMOD_ACCOUNT_ATTRIBUTE_NAME)
             if not account_name:
@@ -207,19 +344,7 @@ class Command(BaseCommand):
                 logger.warning("%s attribute not found for allocation: %s", XDMOD_ACC_HOURS_ATTRIBUTE_NAME, s)
                 continue
 
-            resources = []
-            for r in s.resources.all():
-                rname = r.get_attribute(XDMOD_RESOURCE_ATTRIBUTE_NAME)
-                if not rname and r.parent_resource:
-                    rname = r.parent_resource.get_attribute(XDMOD_RESOURCE_ATTRIBUTE_NAME)
-
-                if not rname:
-                    continue
-
-                if self.filter_resource and self.filter_resource != rname:
-                    continue
-
-                resources.append(rname)
+            resources = self.get_resources(s)
 
             if len(resources) == 0:
                 logger.warning(
@@ -227,16 +352,11 @@ class Command(BaseCommand):
                 )
                 continue
 
-            try:
-                usage = xdmod_fetch_total_cpu_hours(
-                    s.start_date, s.end_date, account_name, resources=resources, statistics="total_gpu_hours"
-                )
-            except XdmodNotFoundError:
-                logger.warning(
-                    "No data in XDMoD found for allocation %s account %s resources %s", s, account_name, resources
-                )
-                continue
+            jobs.append((s, account_name, cpu_hours, resources))
 
+        fetch = functools.partial(self.client.fetch_total_cpu_hours, statistics="total_gpu_hours")
+        fetch_grouped = functools.partial(self.client.fetch_total_cpu_hours_by_account, statistics="total_gpu_hours")
+        for s, account_name, cpu_hours, resources, usage in self.fetch_usage(jobs, fetch, "account", fetch_grouped):
             logger.warning(
                 "Total Accelerator hours = %s for allocation %s account %s gpu_hours %s resources %s",
                 usage,
@@ -246,7 +366,7 @@ class Command(BaseCommand):
                 resources,
             )
             if self.sync:
-                s.set_usage(XDMOD_ACC_HOURS_ATTRIBUTE_NAME, usage)
+                self.set_usage(s.id, XDMOD_ACC_HOURS_ATTRIBUTE_NAME, usage)
 
             self.write(
                 "\t".join(
@@ -275,7 +395,7 @@ class Command(BaseCommand):
             self.write("\t".join(header))
 
         allocations = (
-            Allocation.objects.prefetch_related("project", "resources", "allocationattribute_set", "allocationuser_set")
+            Allocation.objects.prefetch_related(*ALLOCATION_PREFETCH)
             .filter(
                 status__name="Active",
             )
@@ -296,6 +416,7 @@ class Command(BaseCommand):
                 & Q(allocationattribute__value=self.filter_account)
             )
 
+        jobs = []
         for s in allocations.distinct():
             account_name = s.get_attribute(XDMOD_ACCOUNT_ATTRIBUTE_NAME)
             if not account_name:
@@ -307,19 +428,7 @@ class Command(BaseCommand):
                 logger.warning("%s attribute not found for allocation: %s", XDMOD_CPU_HOURS_ATTRIBUTE_NAME, s)
                 continue
 
-            resources = []
-            for r in s.resources.all():
-                rname = r.get_attribute(XDMOD_RESOURCE_ATTRIBUTE_NAME)
-                if not rname and r.parent_resource:
-                    rname = r.parent_resource.get_attribute(XDMOD_RESOURCE_ATTRIBUTE_NAME)
-
-                if not rname:
-                    continue
-
-                if self.filter_resource and self.filter_resource != rname:
-                    continue
-
-                resources.append(rname)
+            resources = self.get_resources(s)
 
             if len(resources) == 0:
                 logger.warning(
@@ -327,14 +436,11 @@ class Command(BaseCommand):
                 )
                 continue
 
-            try:
-                usage = xdmod_fetch_total_cpu_hours(s.start_date, s.end_date, account_name, resources=resources)
-            except XdmodNotFoundError:
-                logger.warning(
-                    "No data in XDMoD found for allocation %s account %s resources %s", s, account_name, resources
-                )
-                continue
+            jobs.append((s, account_name, cpu_hours, resources))
 
+        fetch = self.client.fetch_total_cpu_hours
+        fetch_grouped = self.client.fetch_total_cpu_hours_by_account
+        for s, account_name, cpu_hours, resources, usage in self.fetch_usage(jobs, fetch, "account", fetch_grouped):
             logger.warning(
                 "Total CPU hours = %s for allocation %s account %s cpu_hours %s resources %s",
                 usage,
@@ -344,7 +450,7 @@ class Command(BaseCommand):
                 resources,
             )
             if self.sync:
-                s.set_usage(XDMOD_CPU_HOURS_ATTRIBUTE_NAME, usage)
+                self.set_usage(s.id, XDMOD_CPU_HOURS_ATTRIBUTE_NAME, usage)
 
             self.write(
                 "\t".join(
@@ -373,7 +479,7 @@ class Command(BaseCommand):
             self.write("\t".join(header))
 
         allocations = (
-            Allocation.objects.prefetch_related("project", "resources", "allocationattribute_set", "allocationuser_set")
+            Allocation.objects.prefetch_related(*ALLOCATION_PREFETCH)
             .filter(
                 status__name="Active",
             )
@@ -394,6 +500,7 @@ class Command(BaseCommand):
                 & Q(allocationattribute__value=self.filter_project)
             )
 
+        jobs = []
         for s in allocations.distinct():
             project_name = s.get_attribute(XDMOD_CLOUD_PROJECT_ATTRIBUTE_NAME)
             if not project_name:
@@ -405,19 +512,7 @@ class Command(BaseCommand):
                 logger.warning("%s attribute not found for allocation: %s", XDMOD_CLOUD_CORE_TIME_ATTRIBUTE_NAME, s)
                 continue
 
-            resources = []
-            for r in s.resources.all():
-                rname = r.get_attribute(XDMOD_RESOURCE_ATTRIBUTE_NAME)
-                if not rname and r.parent_resource:
-                    rname = r.parent_resource.get_attribute(XDMOD_RESOURCE_ATTRIBUTE_NAME)
-
-                if not rname:
-                    continue
-
-                if self.filter_resource and self.filter_resource != rname:
-                    continue
-
-                resources.append(rname)
+            resources = self.get_resources(s)
 
             if len(resources) == 0:
                 logger.warning(
@@ -425,14 +520,11 @@ class Command(BaseCommand):
                 )
                 continue
 
-            try:
-                usage = xdmod_fetch_cloud_core_time(s.start_date, s.end_date, project_name, resources=resources)
-            except XdmodNotFoundError:
-                logger.warning(
-                    "No data in XDMoD found for allocation %s project %s resources %s", s, project_name, resources
-                )
-                continue
+            jobs.append((s, project_name, core_time, resources))
 
+        fetch = self.client.fetch_cloud_core_time
+        fetch_grouped = self.client.fetch_cloud_core_time_by_project
+        for s, project_name, core_time, resources, usage in self.fetch_usage(jobs, fetch, "project", fetch_grouped):
             logger.warning(
                 "Cloud core time = %s for allocation %s project %s core_time %s resources %s",
                 usage,
@@ -442,7 +534,7 @@ class Command(BaseCommand):
                 resources,
             )
             if self.sync:
-                s.set_usage(XDMOD_CLOUD_CORE_TIME_ATTRIBUTE_NAME, usage)
+                self.set_usage(s.id, XDMOD_CLOUD_CORE_TIME_ATTRIBUTE_NAME, usage)
 
             self.write(
                 "\t".join(
@@ -474,6 +566,13 @@ class Command(BaseCommand):
             self.sync = True
             logger.warning("Syncing ColdFront with XDMoD")
 
+        self.workers = max(1, options["workers"])
+        self.bulk = options["bulk"]
+        self.usages = []
+        self.usages_changed = 0
+        self.usages_synced = 0
+        self.client = XdmodClient(pool_size=self.workers)
+
         statistic = "total_cpu_hours"
         self.filter_user = ""
         self.filter_project = ""
@@ -503,14 +602,21 @@ class Command(BaseCommand):
         if options["statistic"]:
             statistic = options["statistic"]
 
-        if statistic == "total_cpu_hours":
-            self.process_total_cpu_hours()
-        elif statistic == "cloud_core_time":
-            self.process_cloud_core_time()
-        elif statistic == "total_acc_hours":
-            self.process_total_gpu_hours()
-        elif statistic == "total_storage":
-            self.process_total_storage()
-        else:
-            logger.error("Unsupported XDMoD statistic")
-            sys.exit(1)
+        try:
+            if statistic == "total_cpu_hours":
+                self.process_total_cpu_hours()
+            elif statistic == "cloud_core_time":
+                self.process_cloud_core_time()
+            elif statistic == "total_acc_hours":
+                self.process_total_gpu_hours()
+            elif statistic == "total_storage":
+                self.process_total_storage()
+            else:
+                logger.error("Unsupported XDMoD statistic")
+                sys.exit(1)
+        finally:
+            self.client.close()
+            if self.sync:
+                # Write the usage fetched before any error too
+                self.flush_usage()
+                logger.warning("Updated usage of %s of %s allocations", self.usages_changed, self.usages_synced)
@@ -0,0 +1,254 @@
+# SPDX-FileCopyrightText: (C) ColdFront Authors
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Unit tests for fetching grouped usage from XDMoD"""
+
+import datetime
+import json
+import unittest
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import SimpleTestCase
+
+from coldfront.config.env import ENV
+
+if not ENV.bool("PLUGIN_XDMOD", default=False):
+    raise unittest.SkipTest("Only run XDMoD tests if enabled")
+
+from coldfront.plugins.xdmod.management.commands import xdmod_usage
+from coldfront.plugins.xdmod.management.commands.xdmod_usage import Command
+from coldfront.plugins.xdmod.utils import XdmodClient, XdmodError, XdmodNotFoundError
+
+# get_data response for total_cpu_hours grouped by PI, as returned by XDMoD
+GROUPED_CPU_HOURS_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<xdmod-xml-dataset>
+  <header>
+    <title>
+      <title>CPU Hours: Total: by PI</title>
+    </title>
+    <parameters>
+      <parameter>
+        <name>Resource</name>
+        <value>cluster1</value>
+      </parameter>
+    </parameters>
+    <start>2024-01-01</start>
+    <end>2024-12-31</end>
+    <columns>
+      <column>PI</column>
+      <column>CPU Hours: Total</column>
+    </columns>
+  </header>
+  <rows>
+    <row>
+      <cell><value>acct_alice</value></cell>
+      <cell><value>1234.5678</value></cell>
+    </row>
+    <row>
+      <cell><value> acct_bob </value></cell>
+      <cell><value>42</value></cell>
+    </row>
+    <row>
+      <cell><value>acct_carol</value></cell>
+      <cell><value>0.25</value></cell>
+    </row>
+  </rows>
+</xdmod-xml-dataset>
+"""
+
+
+def xdmod_response(text):
+    response = mock.Mock(text=text, url="https://xdmod.example.com/controllers/user_interface.php")
+    response.json.side_effect = json.JSONDecodeError("Expecting value", text, 0)
+    return response
+
+
+class GroupedUsageClientTests(SimpleTestCase):
+    """tests for parsing grouped XDMoD responses"""
+
+    def setUp(self):
+        self.client = XdmodClient(api_url="https://xdmod.example.com")
+        self.addCleanup(self.client.close)
+
+    def test_grouped_rows_are_parsed(self):
+        with mock.patch.object(self.client.session, "get", return_value=xdmod_response(GROUPED_CPU_HOURS_XML)) as get:
+            usage = self.client.fetch_total_cpu_hours_by_account(
+                datetime.date(2024, 1, 1), datetime.date(2024, 12, 31), resources=["cluster1"]
+            )
+
+        self.assertEqual(usage, {"acct_alice": "1234.5678", "acct_bob": "42", "acct_carol": "0.25"})
+        params = get.call_args.kwargs["params"]
+        self.assertEqual(params["group_by"], "pi")
+        self.assertEqual(params["resource_filter"], '"cluster1"')
+        self.assertNotIn("pi_filter", params)
+        self.assertGreater(params["limit"], 3)
+
+    def test_json_response_is_not_found(self):
+        response = mock.Mock(text='{"success": false}')
+        response.json.return_value = {"success": False}
+        with (
+            mock.patch.object(self.client.session, "get", return_value=response),
+            self.assertRaises(XdmodNotFoundError),
+        ):
+            self.client.fetch_total_cpu_hours_by_account(None, None, resources=["cluster1"])
+
+    def test_invalid_xml_is_an_error(self):
+        with (
+            mock.patch.object(self.client.session, "get", return_value=xdmod_response("<rows>")),
+            self.assertRaises(XdmodError),
+        ):
+            self.client.fetch_total_cpu_hours_by_account(None, None, resources=["cluster1"])
+
+
+class FetchGroupedUsageTests(SimpleTestCase):
+    """tests for xdmod_usage --bulk mapping grouped usage to allocations"""
+
+    def setUp(self):
+        self.command = Command()
+        self.command.bulk = True
+        self.command.workers = 1
+        self.client = XdmodClient(api_url="https://xdmod.example.com")
+        self.addCleanup(self.client.close)
+
+    def allocation(self, pk, start, end):
+        return mock.Mock(pk=pk, start_date=start, end_date=end)
+
+    def fetch_usage(self, jobs, fetch_grouped):
+        fetch = mock.Mock(side_effect=AssertionError("per allocation request"))
+        return list(self.command.fetch_usage(jobs, fetch, "account", fetch_grouped))
+
+    def test_one_request_per_resource_set_and_date_range(self):
+        a1 = self.allocation(1, datetime.date(2024, 1, 1), datetime.date(2024, 12, 31))
+        a2 = self.allocation(2, datetime.date(2024, 1, 1), datetime.date(2024, 12, 31))
+        a3 = self.allocation(3, datetime.date(2024, 1, 1), datetime.date(2024, 12, 31))
+        a4 = self.allocation(4, datetime.date(2023, 1, 1), datetime.date(2023, 12, 31))
+        jobs = [
+            (a1, "acct_alice", 1000, ["cluster1"]),
+            (a2, "acct_bob", 100, ["cluster1"]),
+            (a3, "acct_carol", 10, ["cluster1"]),
+            (a4, "acct_alice", 2000, ["cluster1"]),
+            (a1, "acct_alice", 1000, ["cluster2", "cluster1"]),
+        ]
+
+        with mock.patch.object(self.client.session, "get", return_value=xdmod_response(GROUPED_CPU_HOURS_XML)) as get:
+            usages = self.fetch_usage(jobs, self.client.fetch_total_cpu_hours_by_account)
+
+        self.assertEqual(
+            [(job[0].pk, job[1], job[4]) for job in usages],
+            [
+                (1, "acct_alice", "1234.5678"),
+                (2, "acct_bob", "42"),
+                (3, "acct_carol", "0.25"),
+                (4, "acct_alice", "1234.5678"),
+                (1, "acct_alice", "1234.5678"),
+            ],
+        )
+        self.assertEqual(
+            [
+                (
+                    call.kwargs["params"]["resource_filter"],
+                    call.kwargs["params"]["start_date"],
+                    call.kwargs["params"]["end_date"],
+                )
+                for call in get.call_args_list
+            ],
+            [
+                ('"cluster1"', datetime.date(2024, 1, 1), datetime.date(2024, 12, 31)),
+                ('"cluster1"', datetime.date(2023, 1, 1), datetime.date(2023, 12, 31)),
+                ('"cluster1,cluster2"', datetime.date(2024, 1, 1), datetime.date(2024, 12, 31)),
+            ],
+        )
+
+    def test_usage_counted_over_own_date_range(self):
+        a1 = self.allocation(1, datetime.date(2024, 1, 1), None)
+        a2 = self.allocation(2, datetime.date(2023, 1, 1), datetime.date(2024, 12, 31))
+        fetch_grouped = mock.Mock(return_value={"acct_alice": "1", "acct_bob": "2"})
+
+        self.fetch_usage([(a1, "acct_alice", 1, ["cluster1"]), (a2, "acct_bob", 1, ["cluster1"])], fetch_grouped)
+
+        self.assertEqual(
+            fetch_grouped.call_args_list,
+            [
+                mock.call(datetime.date(2024, 1, 1), None, resources=["cluster1"]),
+                mock.call(datetime.date(2023, 1, 1), datetime.date(2024, 12, 31), resources=["cluster1"]),
+            ],
+        )
+
+    def test_accounts_without_data_are_skipped(self):
+        a1 = self.allocation(1, datetime.date(2024, 1, 1), datetime.date(2024, 12, 31))
+        jobs = [(a1, "acct_alice", 1, ["cluster1"]), (a1, "acct_dave", 1, ["cluster1"])]
+
+        with mock.patch.object(xdmod_usage.logger, "warning") as warning:
+            usages = self.fetch_usage(jobs, mock.Mock(return_value={"acct_alice": "1"}))
+
+        warning.assert_called_once()
+        self.assertEqual([job[1] for job in usages], ["acct_alice"])
+
+    def test_resource_sets_not_found_or_failing_are_skipped(self):
+        a1 = self.allocation(1, datetime.date(2024, 1, 1), datetime.date(2024, 12, 31))
+        jobs = [
+            (a1, "acct_alice", 1, ["cluster1"]),
+            (a1, "acct_bob", 1, ["cluster2"]),
+            (a1, "acct_carol", 1, ["cluster3"]),
+        ]
+        errors = {"cluster1": XdmodNotFoundError("no data"), "cluster2": XdmodError("timed out")}
+
+        def fetch_grouped(start, end, resources):
+            if resources[0] in errors:
+                raise errors[resources[0]]
+            return {"acct_carol": "3"}
+
+        with (
+            mock.patch.object(xdmod_usage.logger, "warning") as warning,
+            mock.patch.object(xdmod_usage.logger, "error") as error,
+        ):
+            usages = self.fetch_usage(jobs, fetch_grouped)
+
+        self.assertEqual([(job[1], job[4]) for job in usages], [("acct_carol", "3")])
+        error.assert_called_once()
+        warning.assert_called_once()
+
+
+class SyncUsageTests(SimpleTestCase):
+    """tests for writing usage with xdmod_usage --sync"""
+
+    def setUp(self):
+        patcher = mock.patch.object(xdmod_usage, "bulk_set_usage", side_effect=lambda usages: len(usages))
+        self.bulk_set_usage = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_usage_is_written_in_batches(self):
+        def process(command):
+            for pk in range(5):
+                command.set_usage(pk, "Core Usage (Hours)", pk)
+
+        with (
+            mock.patch.object(xdmod_usage, "BULK_USAGE_BATCH_SIZE", 2),
+            mock.patch.object(Command, "process_total_cpu_hours", process),
+            mock.patch.object(xdmod_usage.logger, "warning"),
+        ):
+            call_command("xdmod_usage", "-m", "total_cpu_hours", "-s")
+
+        self.assertEqual([len(call.args[0]) for call in self.bulk_set_usage.call_args_list], [2, 2, 1])
+
+    def test_usage_fetched_before_an_error_is_written(self):
+        def process(command):
+            command.set_usage(1, "Core Usage (Hours)", 10)
+            raise XdmodError("connection reset")
+
+        with (
+            mock.patch.object(Command, "process_total_cpu_hours", process),
+            mock.patch.object(xdmod_usage.logger, "warning"),
+            self.assertRaises(XdmodError),
+        ):
+            call_command("xdmod_usage", "-m", "total_cpu_hours", "-s")
+
+        self.bulk_set_usage.assert_called_once_with([(1, "Core Usage (Hours)", 10)])
+
+    def test_usage_is_not_written_without_sync(self):
+        with mock.patch.object(Command, "process_total_cpu_hours"):
+            call_command("xdmod_usage", "-m", "total_cpu_hours")
+
+        self.bulk_set_usage.assert_not_called()
@@ -4,9 +4,12 @@
 
 import json
 import logging
+import threading
 import xml.etree.ElementTree as ET
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from coldfront.core.utils.common import import_from_settings
 
@@ -27,8 +30,17 @@ XDMOD_STORAGE_GROUP_ATTRIBUTE_NAME = import_from_settings("XDMOD_STORAGE_GROUP_A
 
 XDMOD_API_URL = import_from_settings("XDMOD_API_URL")
 
+XDMOD_TIMEOUT = import_from_settings("XDMOD_TIMEOUT", 60)
+XDMOD_RETRIES = import_from_settings("XDMOD_RETRIES", 3)
+XDMOD_RETRY_BACKOFF = import_from_settings("XDMOD_RETRY_BACKOFF", 1.0)
+XDMOD_MAX_WORKERS = import_from_settings("XDMOD_MAX_WORKERS", 4)
+
 _ENDPOINT_CORE_HOURS = "/controllers/user_interface.php"
 
+# Maximum number of rows returned by grouped (all accounts) requests. XDMoD
+# only returns the top 10 groups by default
+_GROUPED_LIMIT = 100000
+
 _DEFAULT_PARAMS = {
     "aggregation_unit": "Auto",
     "display_type": "bar",
@@ -49,133 +61,228 @@ class XdmodNotFoundError(XdmodError):
     pass
 
 
-def xdmod_fetch_total_cpu_hours(start, end, account, resources=None, statistics="total_cpu_hours"):
-    if resources is None:
-        resources = []
-
-    url = "{}{}".format(XDMOD_API_URL, _ENDPOINT_CORE_HOURS)
-    payload = _DEFAULT_PARAMS
-    payload["pi_filter"] = '"{}"'.format(account)
-    payload["resource_filter"] = '"{}"'.format(",".join(resources))
-    payload["start_date"] = start
-    payload["end_date"] = end
-    payload["group_by"] = "pi"
-    payload["realm"] = "Jobs"
-    payload["operation"] = "get_data"
-    payload["statistic"] = statistics
-    r = requests.get(url, params=payload)
-
-    logger.info(r.url)
-    logger.info(r.text)
-
-    try:
-        error = r.json()
-        # XXX fix me. Here we assume any json response is bad as we're
-        # expecting xml but XDMoD should just return json always.
-        raise XdmodNotFoundError("Got json response but expected XML: {}".format(error))
-    except json.decoder.JSONDecodeError:
-        pass
-    except requests.exceptions.JSONDecodeError:
-        pass
-
-    try:
-        root = ET.fromstring(r.text)
-    except ET.ParserError as e:
-        raise XdmodError("Invalid XML data returned from XDMoD API: {}".format(e))
-
-    rows = root.find("rows")
-    if len(rows) != 1:
-        raise XdmodNotFoundError("Rows not found for {} - {}".format(account, resources))
-
-    cells = rows.find("row").findall("cell")
-    if len(cells) != 2:
-        raise XdmodError("Invalid XML data returned from XDMoD API: Cells not found")
-
-    core_hours = cells[1].find("value").text
-
-    return core_hours
-
-
-def xdmod_fetch_total_storage(start, end, account, resources=None, statistics="physical_usage"):
-    if resources is None:
-        resources = []
+class XdmodClient:
+    """Client for the XDMoD user_interface.php API. Requests go through a
+    single requests.Session so connections to XDMoD are reused, with a
+    timeout on every request and retries with exponential backoff on
+    connection errors and 429/5xx responses. The session is safe to share
+    between threads; its connection pool holds up to pool_size connections."""
+
+    def __init__(
+        self,
+        api_url=None,
+        timeout=XDMOD_TIMEOUT,
+        retries=XDMOD_RETRIES,
+        backoff_factor=XDMOD_RETRY_BACKOFF,
+        pool_size=XDMOD_MAX_WORKERS,
+    ):
+        self.url = "{}{}".format(api_url or XDMOD_API_URL, _ENDPOINT_CORE_HOURS)
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=["GET"],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=max(1, pool_size))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def get_data(self, **params):
+        """Run a get_data request with the given parameters on top of the
+        defaults and return the response"""
+        payload = dict(_DEFAULT_PARAMS)
+        payload.update(params)
+        try:
+            r = self.session.get(self.url, params=payload, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            raise XdmodError("Failed to fetch data from XDMoD API: {}".format(e))
+
+        logger.info(r.url)
+        logger.info(r.text)
+        return r
+
+    def _check_not_json(self, r):
+        try:
+            error = r.json()
+            # XXX fix me. Here we assume any json response is bad as we're
+            # expecting xml but XDMoD should just return json always.
+            raise XdmodNotFoundError("Got json response but expected XML: {}".format(error))
+        except json.decoder.JSONDecodeError:
+            pass
+        except requests.exceptions.JSONDecodeError:
+            pass
+
+    def _parse_value(self, r, name, resources):
+        """Return the value of the single row in an XML get_data response"""
+        try:
+            root = ET.fromstring(r.text)
+        except ET.ParseError as e:
+            raise XdmodError("Invalid XML data returned from XDMoD API: {}".format(e))
+
+        rows = root.find("rows")
+        if rows is None or len(rows) != 1:
+            raise XdmodNotFoundError("Rows not found for {} - {}".format(name, resources))
+
+        cells = rows.find("row").findall("cell")
+        if len(cells) != 2:
+            raise XdmodError("Invalid XML data returned from XDMoD API: Cells not found")
+
+        return cells[1].find("value").text
+
+    def _parse_rows(self, r):
+        """Return a dict mapping the group (first cell) of each row in an XML
+        get_data response to its value"""
+        try:
+            root = ET.fromstring(r.text)
+        except ET.ParseError as e:
+            raise XdmodError("Invalid XML data returned from XDMoD API: {}".format(e))
+
+        values = {}
+        rows = root.find("rows")
+        if rows is None:
+            return values
+
+        for row in rows.findall("row"):
+            cells = row.findall("cell")
+            if len(cells) != 2:
+                raise XdmodError("Invalid XML data returned from XDMoD API: Cells not found")
+
+            name = cells[0].find("value").text
+            if name is not None:
+                values[name.strip()] = cells[1].find("value").text
+
+        return values
+
+    def fetch_total_cpu_hours(self, start, end, account, resources=None, statistics="total_cpu_hours"):
+        if resources is None:
+            resources = []
+
+        r = self.get_data(
+            pi_filter='"{}"'.format(account),
+            resource_filter='"{}"'.format(",".join(resources)),
+            start_date=start,
+            end_date=end,
+            group_by="pi",
+            realm="Jobs",
+            statistic=statistics,
+        )
+        self._check_not_json(r)
+        return self._parse_value(r, account, resources)
+
+    def fetch_total_storage(self, start, end, account, resources=None, statistics="physical_usage"):
+        if resources is None:
+            resources = []
+
+        payload_end = end
+        if payload_end is None:
+            payload_end = "2099-01-01"
+        r = self.get_data(
+            pi_filter='"{}"'.format(account),
+            resource_filter="{}".format(",".join(resources)),
+            start_date=start,
+            end_date=payload_end,
+            group_by="pi",
+            realm="Storage",
+            statistic=statistics,
+        )
+        return float(self._parse_value(r, account, resources)) / 1e9
+
+    def fetch_cloud_core_time(self, start, end, project, resources=None):
+        if resources is None:
+            resources = []
+
+        r = self.get_data(
+            project_filter=project,
+            resource_filter='"{}"'.format(",".join(resources)),
+            start_date=start,
+            end_date=end,
+            group_by="project",
+            realm="Cloud",
+            statistic="cloud_core_time",
+        )
+        self._check_not_json(r)
+        return self._parse_value(r, project, resources)
+
+    def fetch_total_cpu_hours_by_account(self, start, end, resources=None, statistics="total_cpu_hours"):
+        """Return a dict mapping account name to usage for every account
+        with usage on resources between start and end, in a single request"""
+        if resources is None:
+            resources = []
+
+        r = self.get_data(
+            resource_filter='"{}"'.format(",".join(resources)),
+            start_date=start,
+            end_date=end,
+            group_by="pi",
+            realm="Jobs",
+            statistic=statistics,
+            limit=_GROUPED_LIMIT,
+        )
+        self._check_not_json(r)
+        return self._parse_rows(r)
+
+    def fetch_total_storage_by_account(self, start, end, resources=None, statistics="physical_usage"):
+        if resources is None:
+            resources = []
+
+        payload_end = end
+        if payload_end is None:
+            payload_end = "2099-01-01"
+        r = self.get_data(
+            resource_filter="{}".format(",".join(resources)),
+            start_date=start,
+            end_date=payload_end,
+            group_by="pi",
+            realm="Storage",
+            statistic=statistics,
+            limit=_GROUPED_LIMIT,
+        )
+        return {k: float(v) / 1e9 for k, v in self._parse_rows(r).items()}
+
+    def fetch_cloud_core_time_by_project(self, start, end, resources=None):
+        if resources is None:
+            resources = []
+
+        r = self.get_data(
+            resource_filter='"{}"'.format(",".join(resources)),
+            start_date=start,
+            end_date=end,
+            group_by="project",
+            realm="Cloud",
+            statistic="cloud_core_time",
+            limit=_GROUPED_LIMIT,
+        )
+        self._check_not_json(r)
+        return self._parse_rows(r)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_xdmod_client():
+    """Return the XdmodClient shared by the xdmod_fetch_* functions"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = XdmodClient()
+
+    return _client
 
-    payload_end = end
-    if payload_end is None:
-        payload_end = "2099-01-01"
-    url = "{}{}".format(XDMOD_API_URL, _ENDPOINT_CORE_HOURS)
-    payload = _DEFAULT_PARAMS
-    payload["pi_filter"] = '"{}"'.format(account)
-    payload["resource_filter"] = "{}".format(",".join(resources))
-    payload["start_date"] = start
-    payload["end_date"] = payload_end
-    payload["group_by"] = "pi"
-    payload["realm"] = "Storage"
-    payload["operation"] = "get_data"
-    payload["statistic"] = statistics
-    r = requests.get(url, params=payload)
 
-    logger.info(r.url)
-    logger.info(r.text)
-
-    try:
-        root = ET.fromstring(r.text)
-    except ET.ParserError as e:
-        raise XdmodError("Invalid XML data returned from XDMoD API: {}".format(e))
-
-    rows = root.find("rows")
-    if len(rows) != 1:
-        raise XdmodNotFoundError("Rows not found for {} - {}".format(account, resources))
-
-    cells = rows.find("row").findall("cell")
-    if len(cells) != 2:
-        raise XdmodError("Invalid XML data returned from XDMoD API: Cells not found")
+def xdmod_fetch_total_cpu_hours(start, end, account, resources=None, statistics="total_cpu_hours"):
+    return get_xdmod_client().fetch_total_cpu_hours(start, end, account, resources=resources, statistics=statistics)
 
-    physical_usage = float(cells[1].find("value").text) / 1e9
 
-    return physical_usage
+def xdmod_fetch_total_storage(start, end, account, resources=None, statistics="physical_usage"):
+    return get_xdmod_client().fetch_total_storage(start, end, account, resources=resources, statistics=statistics)
 
 
 def xdmod_fetch_cloud_core_time(start, end, project, resources=None):
-    if resources is None:
-        resources = []
-
-    url = "{}{}".format(XDMOD_API_URL, _ENDPOINT_CORE_HOURS)
-    payload = _DEFAULT_PARAMS
-    payload["project_filter"] = project
-    payload["resource_filter"] = '"{}"'.format(",".join(resources))
-    payload["start_date"] = start
-    payload["end_date"] = end
-    payload["group_by"] = "project"
-    payload["realm"] = "Cloud"
-    payload["operation"] = "get_data"
-    payload["statistic"] = "cloud_core_time"
-    r = requests.get(url, params=payload)
-
-    logger.info(r.url)
-    logger.info(r.text)
-
-    try:
-        error = r.json()
-        # XXX fix me. Here we assume any json response is bad as we're
-        # expecting xml but XDMoD should just return json always.
-        raise XdmodNotFoundError("Got json response but expected XML: {}".format(error))
-    except json.decoder.JSONDecodeError:
-        pass
-
-    try:
-        root = ET.fromstring(r.text)
-    except ET.ParserError as e:
-        raise XdmodError("Invalid XML data returned from XDMoD API: {}".format(e))
-
-    rows = root.find("rows")
-    if len(rows) != 1:
-        raise XdmodNotFoundError("Rows not found for {} - {}".format(project, resources))
-
-    cells = rows.find("row").findall("cell")
-    if len(cells) != 2:
-        raise XdmodError("Invalid XML data returned from XDMoD API: Cells not found")
-
-    core_hours = cells[1].find("value").text
-
-    return core_hours
+    return get_xdmod_client().fetch_cloud_core_time(start, end, project, resources=resources)